@@ -0,0 +1,170 @@
+import time
+import hashlib
+import argparse
+import threading
+import email.utils
+import numpy
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Synthetic datasets in the getDatasets field order: name, layername, years, folder, file_prefix, max_resolution, bit_depth, producer, metadata_URL
+# The names match rows of karttatasot.csv, so the scripts make the same collections as from the real GeoCubes
+DATASETS = [
+    ("Valtakunta", "valtakunta", "2019.2020", "/geocubes/valtakunta/", "valtakunta", "100", "8", "MML", "https://example.org/valtakunta"),
+    ("Sentinel-1 GBM-kuvamosaiikki 2017", "s1_gbm", "2017", "/geocubes/s1_gbm/", "sentinel-1", "100", "16", "ESA", "https://example.org/s1_gbm")
+]
+RESOLUTIONS = [100, 200] # Every tile has the full resolution COG and one overview file
+
+class FakeGeoCubes:
+
+    """
+        In-memory GeoCubes tree with the given number of tiles in each year folder. The rasters are small tiled GeoTIFFs
+        that are generated on the first request and then kept in memory.
+
+        tiles - Number of tiles in each year folder
+        latency - Seconds added to every response
+        capacity - Optional number of requests served at the same time, the requests over it are answered 503 with a Retry-After
+    """
+
+    def __init__(self, tiles, latency=0.0, capacity=None):
+        self.tiles = tiles
+        self.latency = latency
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.files = {}
+        self.requests = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+        self.last_modified = email.utils.formatdate(time.time(), usegmt=True)
+        self.folders = {}
+        for name, layername, years, folder, prefix, *_ in DATASETS:
+            for year in years.split("."):
+                self.folders[f"{folder}{year}/"] = [
+                    (f"{prefix}_100m_{year}_{tile}" + ("" if res == 100 else f"_{res}m") + ".tif", tile, res)
+                    for tile in range(1, tiles + 1) for res in RESOLUTIONS
+                ]
+        self.paths = {f"{folder}{name}": (tile, res) for folder, names in self.folders.items() for name, tile, res in names}
+
+    def datasets(self):
+        return ";".join(",".join(dataset) for dataset in DATASETS).encode()
+
+    def listing(self, folder):
+        links = "".join(f'<a href="{name}">{name}</a>                2024-01-01 00:00  12K\n' for name, tile, res in self.folders[folder])
+        return f"<html><head><title>Index of {folder}</title></head><body><h1>Index of {folder}</h1><pre>{links}</pre></body></html>".encode()
+
+    def raster(self, path):
+        with self.lock:
+            if path in self.files:
+                return self.files[path]
+        tile, res = self.paths[path]
+        size = 25600 // res
+        x0 = 300000 + (tile % 50) * 25600
+        y0 = 7000000 - (tile // 50) * 25600
+        with MemoryFile() as memfile:
+            with memfile.open(driver="GTiff", width=size, height=size, count=1, dtype="uint8", crs="EPSG:3067",
+                              transform=from_origin(x0, y0, res, res), tiled=True, blockxsize=128, blockysize=128) as dst:
+                dst.write(numpy.full((1, size, size), tile % 255, dtype="uint8"))
+            data = memfile.read()
+        with self.lock:
+            self.files[path] = data
+        return data
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def send(self, code, body, content_type, head=False, headers=()):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+            with self.server.geocubes.lock:
+                self.server.geocubes.bytes_sent += len(body)
+
+    def handle_request(self, head=False):
+        geocubes = self.server.geocubes
+        path = self.path.split("?")[0]
+        if path == "/stats":
+            stats = f'{{"requests": {geocubes.requests}, "bytes": {geocubes.bytes_sent}, "rejected": {geocubes.rejected}}}'
+            return self.send(200, stats.encode(), "application/json")
+
+        with geocubes.lock:
+            geocubes.requests += 1
+            rejected = geocubes.capacity is not None and geocubes.in_flight >= geocubes.capacity
+            if rejected:
+                geocubes.rejected += 1
+            else:
+                geocubes.in_flight += 1
+        if rejected:
+            return self.send(503, b"Busy", "text/plain", head, [("Retry-After", "1")])
+        try:
+            self.respond(path, head)
+        finally:
+            with geocubes.lock:
+                geocubes.in_flight -= 1
+
+    def respond(self, path, head):
+        geocubes = self.server.geocubes
+        if geocubes.latency:
+            time.sleep(geocubes.latency)
+
+        if path == "/geocubes/info/getDatasets":
+            return self.send(200, geocubes.datasets(), "text/plain", head)
+        if path in geocubes.folders:
+            body, content_type = geocubes.listing(path), "text/html"
+        elif path in geocubes.paths:
+            body, content_type = geocubes.raster(path), "image/tiff"
+        else:
+            return self.send(404, b"Not found", "text/plain", head)
+
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self.send(304, b"", content_type, True, [("ETag", etag)])
+        headers = [("ETag", etag), ("Last-Modified", geocubes.last_modified), ("Accept-Ranges", "bytes")]
+
+        requested = self.headers.get("Range")
+        if requested and requested.startswith("bytes="):
+            start, end = requested[6:].split("-")
+            start, end = int(start), min(int(end) if end else len(body) - 1, len(body) - 1)
+            headers.append(("Content-Range", f"bytes {start}-{end}/{len(body)}"))
+            return self.send(206, body[start:end + 1], content_type, head, headers)
+        return self.send(200, body, content_type, head, headers)
+
+def serve(port, tiles, latency=0.0, capacity=None):
+
+    """
+        Returns a server for the synthetic GeoCubes tree, start it with serve_forever()
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.geocubes = FakeGeoCubes(tiles, latency, capacity)
+    return server
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the GeoCubes server with a synthetic dataset tree")
+    parser.add_argument("--port", type=int, default=8081, help="Port to listen on (default 8081)")
+    parser.add_argument("--tiles", type=int, default=10, help="Number of tiles in each year folder (default 10)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Milliseconds added to every response (default 0)")
+    parser.add_argument("--capacity", type=int, help="Number of requests served at the same time, the rest are answered 503 with a Retry-After (default no limit)")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.tiles, args.latency / 1000, args.capacity)
+    print(f"GeoCubes stand-in at http://127.0.0.1:{args.port} with {len(server.geocubes.paths)} rasters", flush=True)
+    server.serve_forever()
@@ -0,0 +1,236 @@
+import json
+import time
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REST = "/geoserver/rest/oseo/"
+STAC = "/geoserver/ogc/stac/v1"
+
+class FakeGeoServer:
+
+    """
+        In-memory stand-in for the GeoServer OSEO REST API and the STAC API on top of it. The collections and products
+        sent to the REST API are listed by the STAC API, paged with limit and startIndex like GeoServer does.
+
+        latency - Seconds added to every response
+    """
+
+    def __init__(self, port, latency=0.0):
+        self.base = f"http://127.0.0.1:{port}{STAC}"
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.collections = {}
+        self.products = {}
+        self.requests = {}
+        self.bytes_received = 0
+
+    def stac_collection(self, collection_id):
+        properties = self.collections[collection_id]["properties"]
+        return {
+            "type": "Collection",
+            "stac_version": "1.0.0",
+            "id": collection_id,
+            "title": properties["title"],
+            "description": properties["description"],
+            "license": properties.get("license", "proprietary"),
+            "providers": properties.get("providers", []),
+            "summaries": properties.get("summaries", {}),
+            "extent": {
+                "spatial": {"bbox": [list(self.collections[collection_id].get("bbox", [19.0, 59.0, 32.0, 71.0]))]},
+                "temporal": {"interval": [[properties["timeStart"], properties["timeEnd"]]]}
+            },
+            "links": [
+                {"rel": "self", "href": f"{self.base}/collections/{collection_id}"},
+                {"rel": "items", "href": f"{self.base}/collections/{collection_id}/items", "type": "application/geo+json"},
+                {"rel": "root", "href": f"{self.base}/"},
+                {"rel": "parent", "href": f"{self.base}/"}
+            ]
+        }
+
+    def stac_item(self, collection_id, product):
+        properties = product["properties"]
+        return {
+            "type": "Feature",
+            "stac_version": "1.0.0",
+            "id": properties["eop:identifier"],
+            "collection": collection_id,
+            "geometry": product["geometry"],
+            "properties": {"datetime": None, "start_datetime": properties["timeStart"], "end_datetime": properties["timeEnd"]},
+            "assets": properties.get("assets", {}),
+            "links": []
+        }
+
+    def landing_page(self):
+        return {
+            "type": "Catalog",
+            "id": "geoserver",
+            "stac_version": "1.0.0",
+            "description": "GeoServer stand-in",
+            "conformsTo": [
+                "https://api.stacspec.org/v1.0.0/core",
+                "https://api.stacspec.org/v1.0.0/collections",
+                "https://api.stacspec.org/v1.0.0/item-search",
+                "https://api.stacspec.org/v1.0.0/ogcapi-features",
+                "http://www.opengis.net/spec/ogcapi-features-1/1.0/conf/core"
+            ],
+            "links": [
+                {"rel": "self", "href": f"{self.base}/"},
+                {"rel": "root", "href": f"{self.base}/"},
+                {"rel": "data", "href": f"{self.base}/collections"},
+                {"rel": "search", "href": f"{self.base}/search", "type": "application/geo+json", "method": "GET"}
+            ] + [{"rel": "child", "href": f"{self.base}/collections/{collection_id}"} for collection_id in self.collections]
+        }
+
+    def item_page(self, collection_ids, query, href):
+        limit = int(query.get("limit", ["10"])[0])
+        start = int(query.get("startIndex", ["0"])[0])
+        fields = query.get("fields", [None])[0]
+        with self.lock:
+            products = [(collection_id, product) for collection_id in collection_ids for product in self.products.get(collection_id, {}).values()]
+        features = [self.stac_item(collection_id, product) for collection_id, product in products[start:start + limit]]
+        if fields == "id":
+            features = [{"type": "Feature", "id": feature["id"]} for feature in features]
+        links = []
+        if start + limit < len(products):
+            extra = f"&fields={fields}" if fields else ""
+            links.append({
+                "rel": "next",
+                "href": f"{href}?collections={','.join(collection_ids)}&limit={limit}&startIndex={start + limit}{extra}",
+                "type": "application/geo+json"
+            })
+        return {"type": "FeatureCollection", "features": features, "links": links, "numberMatched": len(products), "numberReturned": len(features)}
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, content=None):
+        body = json.dumps(content).encode() if content is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length) if length else b""
+        with self.server.geoserver.lock:
+            self.server.geoserver.bytes_received += len(data)
+        return json.loads(data) if data else None
+
+    def do_GET(self):
+        self.route()
+
+    def do_HEAD(self):
+        self.route()
+
+    def do_POST(self):
+        self.route()
+
+    def do_PUT(self):
+        self.route()
+
+    def route(self):
+        geoserver = self.server.geoserver
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        query = parse_qs(url.query)
+
+        if path == "/stats":
+            with geoserver.lock:
+                return self.reply(200, {
+                    "requests": geoserver.requests,
+                    "bytes": geoserver.bytes_received,
+                    "collections": len(geoserver.collections),
+                    "products": sum(len(products) for products in geoserver.products.values())
+                })
+        if path == "/reset":
+            with geoserver.lock:
+                geoserver.collections.clear()
+                geoserver.products.clear()
+                geoserver.requests.clear()
+                geoserver.bytes_received = 0
+            return self.reply(200, {})
+
+        with geoserver.lock:
+            geoserver.requests[self.command] = geoserver.requests.get(self.command, 0) + 1
+        if geoserver.latency:
+            time.sleep(geoserver.latency)
+
+        if path.startswith(REST.rstrip("/")):
+            parts = path[len(REST):].split("/")
+            if parts == ["collections"] and self.command == "POST":
+                content = self.body()
+                with geoserver.lock:
+                    geoserver.collections[content["properties"]["name"]] = content
+                    geoserver.products.setdefault(content["properties"]["name"], {})
+                return self.reply(201)
+            if len(parts) == 2 and parts[0] == "collections" and self.command == "PUT":
+                content = self.body()
+                with geoserver.lock:
+                    geoserver.collections[parts[1]] = content
+                    geoserver.products.setdefault(parts[1], {})
+                return self.reply(200)
+            if len(parts) == 3 and parts[2] == "products" and self.command == "POST":
+                content = self.body()
+                with geoserver.lock:
+                    geoserver.products[parts[1]][content["properties"]["eop:identifier"]] = content
+                return self.reply(201)
+            if len(parts) == 4 and parts[2] == "products":
+                if self.command == "PUT":
+                    content = self.body()
+                    with geoserver.lock:
+                        geoserver.products[parts[1]][parts[3]] = content
+                    return self.reply(200)
+                if self.command in ("GET", "HEAD"):
+                    found = parts[3] in geoserver.products.get(parts[1], {})
+                    return self.reply(200 if found else 404, {})
+            return self.reply(404, {})
+
+        if path.startswith(STAC):
+            rest = path[len(STAC):]
+            if rest == "":
+                return self.reply(200, geoserver.landing_page())
+            if rest == "/collections":
+                return self.reply(200, {"collections": [geoserver.stac_collection(collection_id) for collection_id in geoserver.collections], "links": []})
+            if rest == "/search":
+                collection_ids = query.get("collections", [",".join(geoserver.collections)])[0].split(",")
+                return self.reply(200, geoserver.item_page(collection_ids, query, f"{geoserver.base}/search"))
+            if rest.startswith("/collections/"):
+                parts = rest.split("/")[2:]
+                if parts[0] not in geoserver.collections:
+                    return self.reply(404, {})
+                if len(parts) == 1:
+                    return self.reply(200, geoserver.stac_collection(parts[0]))
+                if parts[1] == "items":
+                    return self.reply(200, geoserver.item_page([parts[0]], query, f"{geoserver.base}/collections/{parts[0]}/items"))
+        return self.reply(404, {})
+
+def serve(port, latency=0.0):
+
+    """
+        Returns a server for the GeoServer stand-in, start it with serve_forever()
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.geoserver = FakeGeoServer(port, latency)
+    return server
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the GeoServer OSEO REST API and STAC API")
+    parser.add_argument("--port", type=int, default=8082, help="Port to listen on (default 8082)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Milliseconds added to every response (default 0)")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency / 1000)
+    print(f"GeoServer stand-in at http://127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()
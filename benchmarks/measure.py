@@ -0,0 +1,34 @@
+import sys
+import json
+import time
+import runpy
+import resource
+from pathlib import Path
+
+"""
+    Runs a script in this process and writes its wall time and peak memory as JSON:
+    python measure.py result.json script.py [arguments of the script]
+"""
+
+if __name__ == "__main__":
+
+    output, script, *arguments = sys.argv[1:]
+    sys.argv = [script, *arguments]
+    sys.path.insert(0, str(Path(script).resolve().parent))
+
+    exit_code = 0
+    start = time.perf_counter()
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    seconds = time.perf_counter() - start
+
+    with open(output, "w") as f:
+        json.dump({
+            "seconds": seconds,
+            "exit_code": exit_code,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "children_max_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        }, f)
+    sys.exit(exit_code)
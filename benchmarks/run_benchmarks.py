@@ -0,0 +1,204 @@
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import requests
+from pathlib import Path
+from fake_geocubes import DATASETS
+
+BENCHMARKS = Path(__file__).resolve().parent
+REPO = BENCHMARKS.parent
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(script, port, *arguments):
+
+    """
+        Starts a stand-in server as a subprocess and waits until it answers. Returns the process and its address
+    """
+
+    process = subprocess.Popen([sys.executable, str(BENCHMARKS / script), "--port", str(port), *arguments], stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/stats", timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{script} did not start")
+
+def geocubes_requests(url):
+    return requests.get(f"{url}/stats").json()["requests"]
+
+def geoserver_requests(url):
+    return sum(requests.get(f"{url}/stats").json()["requests"].values())
+
+def prepare_workdir(workdir):
+
+    """
+        Writes the CSV rows of the synthetic datasets and a password file into the working directory of the scripts
+    """
+
+    names = {dataset[0] for dataset in DATASETS}
+    with open(REPO / "karttatasot.csv", newline="") as src, open(workdir / "karttatasot.csv", "w", newline="") as dst:
+        reader = csv.reader(src)
+        writer = csv.writer(dst)
+        writer.writerow(next(reader))
+        writer.writerows(row for row in reader if row[0] in names)
+    (workdir / "passwords.txt").write_text("benchmark\n")
+
+def count_items(folder):
+
+    """
+        Returns the number of item JSON files in a GeoCubes catalog folder
+    """
+
+    return sum(1 for _ in Path(folder).glob("*/*/*.json"))
+
+def run_script(script, arguments, workdir, password=False):
+
+    """
+        Runs a script of the repository in the working directory under measure.py. Returns its wall time and peak memory
+    """
+
+    result_path = workdir / "measure.json"
+    env = dict(os.environ, NO_PROXY="127.0.0.1", no_proxy="127.0.0.1")
+    # Without a controlling terminal getpass reads the password from stdin
+    completed = subprocess.run(
+        [sys.executable, str(BENCHMARKS / "measure.py"), str(result_path), str(REPO / script), *arguments],
+        cwd=workdir, env=env, input="benchmark\n" if password else None, text=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"{script} {' '.join(arguments)} failed:\n{completed.stderr[-2000:]}")
+    with open(result_path) as f:
+        return json.load(f)
+
+def measure(name, script, arguments, workdir, geocubes_url, geoserver_url, items=None, password=False):
+
+    """
+        Runs a scenario and returns its row of the report. The number of items is counted from the written catalog unless given.
+    """
+
+    geocubes_before = geocubes_requests(geocubes_url)
+    geoserver_before = geoserver_requests(geoserver_url)
+    measured = run_script(script, arguments, workdir, password)
+    if items is None:
+        items = count_items(workdir / "GeoCubes")
+    geocubes_count = geocubes_requests(geocubes_url) - geocubes_before
+    geoserver_count = geoserver_requests(geoserver_url) - geoserver_before
+    return {
+        "scenario": name,
+        "items": items,
+        "seconds": round(measured["seconds"], 3),
+        "items_per_second": round(items / measured["seconds"], 2) if measured["seconds"] else None,
+        "geocubes_requests": geocubes_count,
+        "geocubes_requests_per_item": round(geocubes_count / items, 2) if items else None,
+        "geoserver_requests": geoserver_count,
+        "geoserver_requests_per_item": round(geoserver_count / items, 2) if items else None,
+        "peak_rss_mb": round(max(measured["max_rss_kb"], measured["children_max_rss_kb"]) / 1024, 1)
+    }
+
+def seed_geoserver(geoserver_url, ndjson_files, hold_back):
+
+    """
+        Sends the converted collections to the GeoServer stand-in, leaving out every hold_back:th item so that the update has something to add.
+        Returns the number of items left out
+    """
+
+    sys.path.insert(0, str(REPO))
+    from geoserver_convert import read_ndjson, payload_id
+
+    requests.get(f"{geoserver_url}/reset").raise_for_status()
+    app_host = f"{geoserver_url}/geoserver/rest/oseo/"
+    session = requests.Session()
+    left_out = 0
+    for path in ndjson_files:
+        payloads = read_ndjson(path)
+        collection = next(payloads)
+        session.post(f"{app_host}collections/", json=collection).raise_for_status()
+        for n, payload in enumerate(payloads):
+            if n % hold_back == 0:
+                left_out += 1
+                continue
+            session.post(f"{app_host}collections/{payload_id(collection)}/products", json=payload).raise_for_status()
+    return left_out
+
+def run_size(tiles, latency, workers):
+
+    """
+        Runs every scenario against fresh stand-in servers with the given number of tiles in each year folder. Returns the rows of the report
+    """
+
+    geocubes, geocubes_url = start_server("fake_geocubes.py", free_port(), "--tiles", str(tiles), "--latency", str(latency))
+    geoserver, geoserver_url = start_server("fake_geoserver.py", free_port(), "--latency", str(latency))
+    registry = ["--geocubes-url", geocubes_url, "--datasets-ttl", "0"]
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            workdir = Path(tmp)
+            prepare_workdir(workdir)
+
+            rows.append(measure("build", "geocubes_stac.py", [*registry, "--workers", str(workers)], workdir, geocubes_url, geoserver_url))
+            rows.append(measure("build (cached)", "geocubes_stac.py", [*registry, "--workers", str(workers)], workdir, geocubes_url, geoserver_url))
+            rows.append(measure("build (stream)", "geocubes_stac.py", [*registry, "--workers", str(workers), "--stream", "--no-cache"],
+                                workdir, geocubes_url, geoserver_url))
+
+            collections = sorted(str(path) for path in (workdir / "GeoCubes").iterdir() if path.is_dir())
+            rows.append(measure("convert", "geoserver_convert.py", [*collections, "--output", str(workdir)], workdir, geocubes_url, geoserver_url))
+            ndjson_files = sorted(workdir.glob("*.ndjson"))
+
+            # geocubes_to_geoserver.py sends one collection, the one with the most items is used
+            largest = max(ndjson_files, key=lambda path: sum(1 for _ in open(path)))
+            items = sum(1 for _ in open(largest)) - 1
+            rows.append(measure("upload", "geocubes_to_geoserver.py", ["--host", geoserver_url, "--ndjson", str(largest), "--workers", str(workers)],
+                                workdir, geocubes_url, geoserver_url, items, password=True))
+
+            # The update adds the items missing from the catalog, read with a cold cache and state like on a new machine
+            items = seed_geoserver(geoserver_url, ndjson_files, 10)
+            rows.append(measure("update", "update_geocubes.py", ["--host", geoserver_url, *registry, "--workers", str(workers),
+                                "--cache", "update_cache.sqlite", "--state", "update_state.sqlite"], workdir, geocubes_url, geoserver_url, items))
+    finally:
+        geocubes.kill()
+        geoserver.kill()
+    for row in rows:
+        row["tiles"] = tiles
+    return rows
+
+def print_table(rows):
+    columns = [
+        ("tiles", "Tiles"), ("scenario", "Scenario"), ("items", "Items"), ("seconds", "Seconds"), ("items_per_second", "Items/s"),
+        ("geocubes_requests_per_item", "GeoCubes req/item"), ("geoserver_requests_per_item", "GeoServer req/item"), ("peak_rss_mb", "Peak MB")
+    ]
+    widths = [max(len(title), *(len(str(row[key])) for row in rows)) for key, title in columns]
+    print("  ".join(title.ljust(width) for (key, title), width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[key]).ljust(width) for (key, title), width in zip(columns, widths)))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the harvest, conversion, upload and update scripts against local GeoCubes and GeoServer stand-ins")
+    parser.add_argument("--sizes", type=str, default="10,50,200", help="Comma separated numbers of tiles in each year folder (default 10,50,200)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Milliseconds added to every response of the stand-ins (default 0)")
+    parser.add_argument("--workers", type=int, default=8, help="Value of --workers given to the scripts (default 8)")
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="JSON file of the results (default benchmark_results.json)")
+    args = parser.parse_args()
+
+    rows = []
+    for tiles in (int(size) for size in args.sizes.split(",")):
+        print(f"Running with {tiles} tiles in each year folder...", flush=True)
+        rows.extend(run_size(tiles, args.latency, args.workers))
+
+    print_table(rows)
+    with open(args.output, "w") as f:
+        json.dump({"latency_ms": args.latency, "workers": args.workers, "results": rows}, f, indent=2)
+    print(f"Results written to {args.output}")
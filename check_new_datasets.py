@@ -1,62 +1,199 @@
-import requests
 import pandas as pd
 import re
+import sys
+import json
 import argparse
+import requests
 import pystac_client
+from concurrent.futures import ThreadPoolExecutor
+from geocubes_registry import add_registry_arguments, datasets_from_args
+from geocubes_cache import RasterCache, DEFAULT_CACHE
+from geocubes_listing import list_tifs
+from geocubes_filenames import index_listing, group_items, collection_id
+from geocubes_state import CatalogState, DEFAULT_STATE, add_state_arguments, state_max_age
+from geocubes_index import ItemIndex, DEFAULT_INDEX
+from geoserver_catalog import fetch_item_ids
+from geotiff_header import HEADER_BYTES
+from geocubes_throttle import governor, add_throttle_arguments, configure_throttle
+from geocubes_metrics import add_metrics_arguments, start_metrics
+
+EXIT_NEW_DATA = 2 # Exit status of --deep when there is something new to harvest
+
+def check_folder(year_path, name, known_ids, cache=None):
+
+    """
+        Lists a year folder, with a conditional request if the listing is cached, and compares its items to the known item IDs.
+        Returns a dictionary of whether the listing changed, the number of items in the folder and the new item IDs with their numbers of files
+
+        year_path - URL of the year folder
+        name - English name of the collection from the CSV
+        known_ids - Set of the item IDs already in the catalog
+        cache - Optional RasterCache of the folder listings
+    """
+
+    hrefs, changed = list_tifs(year_path, cache)
+    grouped_items = group_items(index_listing(hrefs, year_path, name))
+    new_items = {
+        item_id: len(dict.fromkeys([key] + files))
+        for key, (item_id, files) in grouped_items.items() if item_id not in known_ids
+    }
+    return {"changed": changed, "items": len(grouped_items), "new_items": new_items}
+
+def deep_check(collections, known_ids, cache=None, workers=8):
+
+    """
+        Checks the year folders of all the collections concurrently for new years and new items.
+        A year folder is new if none of its items are in the catalog.
+        Returns a list of reports, one for each collection, with the new years, the new item IDs and the number of their files
+
+        collections - List of tuples of the collection ID, the English name and the GeoCubes dataset
+        known_ids - Dictionary from collection ID to the set of item IDs already in the catalog
+        cache - Optional RasterCache of the folder listings
+        workers - Number of folders listed concurrently
+    """
+
+    folders = [(collection, name, year, path) for collection, name, dataset in collections for year, path in zip(dataset.years, dataset.paths)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda folder: check_folder(folder[3], folder[1], known_ids[folder[0]], cache), folders))
+
+    reports = {collection: {"collection": collection, "folders": 0, "changed_folders": 0, "new_years": [], "new_items": [], "new_files": 0} for collection, _, _ in collections}
+    for (collection, name, year, path), result in zip(folders, results):
+        report = reports[collection]
+        report["folders"] += 1
+        report["changed_folders"] += result["changed"]
+        if result["items"] and len(result["new_items"]) == result["items"]:
+            report["new_years"].append(year)
+        report["new_items"] += list(result["new_items"])
+        report["new_files"] += sum(result["new_items"].values())
+    return list(reports.values())
+
+def harvest_cost(reports, workers):
 
-def get_datasets():
     """
-        Datasets can be obtained from an API endpoint.
-        Returns a dictionary containing the GeoCubes datasets and their relevant information.
+        Estimates the cost of harvesting and uploading the new items: one range request for each new file, one upload for each new item
+        and one collection update for each changed collection. The time is estimated from the smoothed latency of the GeoCubes requests of the check.
+        Returns the estimate as a dictionary
     """
 
-    data = requests.get("https://vm0160.kaj.pouta.csc.fi/geocubes/info/getDatasets")
-    const_url = "https://vm0160.kaj.pouta.csc.fi"
-    raw_datasets = data.text.split(";")
-    split_datasets = [x.split(",") for x in raw_datasets]
-
-    dataset_dict = {}
-    for split in split_datasets:
-        dataset_dict[split[0]] = dict(zip(["name", "layername", "years", "folder", "file_prefix", "max_resolution", "bit_depth", "producer", "metadata_URL"], split))
-
-    for d in dataset_dict:
-        year_split = dataset_dict[d]['years'].split(".")
-        dataset_dict[d]['paths'] = []
-        if len(year_split) == 1:
-            dataset_dict[d]['paths'].append(f"{const_url}{dataset_dict[d]['folder']}{year_split[0]}/")
-        else:
-            for year in year_split:
-                dataset_dict[d]['paths'].append(f"{const_url}{dataset_dict[d]['folder']}{year}/")
-    
-    return dataset_dict
+    files = sum(report["new_files"] for report in reports)
+    items = sum(len(report["new_items"]) for report in reports)
+    collections = sum(1 for report in reports if report["new_items"])
+    latency = governor.smoothed
+    return {
+        "items": items,
+        "geocubes_requests": files,
+        "header_bytes": files * HEADER_BYTES,
+        "uploads": items + collections,
+        "seconds": round(files * latency / workers, 1) if latency is not None else None
+    }
 
 if __name__ == "__main__":
 
     pw_filename = 'passwords.txt'
     parser = argparse.ArgumentParser()
-    parser.add_argument("--host", type=str, help="Hostname of the selected STAC API", required=True)
+    parser.add_argument("--host", type=str, help="Hostname of the selected STAC API, required unless --deep --against index")
+    parser.add_argument("--deep", action="store_true", help="Also check the year folders of the known datasets for new years and new items, and estimate the cost of harvesting them")
+    parser.add_argument("--against", choices=["stac", "index"], default="stac",
+                        help="Compare the year folders with the item IDs in the STAC API (stac) or in the local item index of geocubes_stac.py (index)")
+    parser.add_argument("--workers", type=int, default=8, help="Number of year folders listed concurrently (default 8)")
+    parser.add_argument("--cache", type=str, default=DEFAULT_CACHE, help=f"Cache of the folder listings, an unchanged folder is not downloaded again (default {DEFAULT_CACHE})")
+    parser.add_argument("--no-cache", action="store_true", help="Download every folder listing")
+    parser.add_argument("--state", type=str, default=DEFAULT_STATE, help=f"Local snapshot of the remote item IDs used with --against stac (default {DEFAULT_STATE})")
+    add_state_arguments(parser)
+    parser.add_argument("--no-state", action="store_true", help="List the item IDs of every collection from the STAC API without the snapshot")
+    parser.add_argument("--index", type=str, default=DEFAULT_INDEX, help=f"Item index used with --against index (default {DEFAULT_INDEX})")
+    parser.add_argument("--json", type=str, help="Also write the report of the deep check as JSON to this file")
+    add_registry_arguments(parser)
+    add_throttle_arguments(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    start_metrics(args)
+    configure_throttle(args)
+    if args.host is None and not (args.deep and args.against == "index"):
+        parser.error("--host is required unless --deep --against index is given")
+
+    collection_csv = pd.read_csv('karttatasot.csv', index_col='Nimi').to_dict('index')
 
-    app_host = f"{args.host}/geoserver/rest/oseo/"
-    csc_catalog_client = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/", headers={"User-Agent":"update-script"})
+    titles_and_ids = {}
+    if args.host is not None:
+        stac_url = f"{args.host}/geoserver/ogc/stac/v1/"
+        csc_catalog_client = pystac_client.Client.open(stac_url, headers={"User-Agent":"update-script"})
 
-    title_regex_pattern = r" \(GeoCubes\)"
+        title_regex_pattern = r" \(GeoCubes\)"
 
-    # Get all Geocubes collections from the app_host
-    csc_collections = [col for col in csc_catalog_client.get_collections() if col.id.endswith("at_geocubes")]
+        # Get all Geocubes collections from the STAC API
+        csc_collections = [col for col in csc_catalog_client.get_collections() if col.id.endswith("at_geocubes")]
 
-    csc_title_id_map = {c.title: c.id for c in csc_collections}
-    collection_csv = pd.read_csv('karttatasot.csv', index_col='Nimi').to_dict('index')
+        csc_title_id_map = {c.title: c.id for c in csc_collections}
 
-    # Get the titles and IDs from CSC STAC and make the title correspond them to the ones in the CSV
-    titles_and_ids = {}
-    for title in csc_title_id_map:
-        fixed_title = re.sub(title_regex_pattern, '', title)
-        titles_and_ids[fixed_title] = csc_title_id_map[title]
+        # Get the titles and IDs from CSC STAC and make the title correspond them to the ones in the CSV
+        for title in csc_title_id_map:
+            fixed_title = re.sub(title_regex_pattern, '', title)
+            titles_and_ids[fixed_title] = csc_title_id_map[title]
 
-    geocubes_datasets = get_datasets()
+    geocubes_datasets = datasets_from_args(args)
+    new_datasets = 0
     for dataset in geocubes_datasets:
         if dataset not in collection_csv.keys():
-            print(f"New dataset in GeoCubes: {geocubes_datasets[dataset]["name"]}")
-            print(f"Folder: {geocubes_datasets[dataset]['folder']}")
-            print(f"Metadata: {geocubes_datasets[dataset]['metadata_URL']}")
\ No newline at end of file
+            new_datasets += 1
+            print(f"New dataset in GeoCubes: {geocubes_datasets[dataset].name}")
+            print(f"Folder: {geocubes_datasets[dataset].folder}")
+            print(f"Metadata: {geocubes_datasets[dataset].metadata_URL}")
+
+    if not args.deep:
+        sys.exit(0)
+
+    # The collections of the known datasets, named like in the STAC API or, if they are not there, like geocubes_stac.py names them
+    collections = [
+        (titles_and_ids.get(collection_csv[dataset]["Name"], collection_id(collection_csv[dataset]["Name"])), collection_csv[dataset]["Name"], geocubes_datasets[dataset])
+        for dataset in geocubes_datasets if dataset in collection_csv
+    ]
+
+    known_ids = {}
+    if args.against == "index":
+        index = ItemIndex(args.index)
+        for collection, _, _ in collections:
+            known_ids[collection] = index.item_ids(collection)
+        index.close()
+    else:
+        session = requests.Session()
+        session.headers.update({"User-Agent": "update-script"})
+        state = None if args.no_state else CatalogState(args.state, state_max_age(args))
+        remote_collections = set(titles_and_ids.values())
+        for collection, _, _ in collections:
+            if collection not in remote_collections:
+                known_ids[collection] = set()
+            elif state is not None:
+                state.refresh(stac_url, collection, session)
+                known_ids[collection] = state.item_ids(collection)
+            else:
+                known_ids[collection] = fetch_item_ids(stac_url, collection, session)
+        if state is not None:
+            state.close()
+
+    cache = None if args.no_cache else RasterCache(args.cache)
+    reports = deep_check(collections, known_ids, cache, args.workers)
+    if cache is not None:
+        cache.close()
+
+    for report in reports:
+        if not report["new_items"]:
+            print(f"{report['collection']}: no new items ({report['changed_folders']}/{report['folders']} folders changed)")
+            continue
+        years = f", new years {', '.join(report['new_years'])}" if report["new_years"] else ""
+        print(f"{report['collection']}: {len(report['new_items'])} new items with {report['new_files']} files{years} ({report['changed_folders']}/{report['folders']} folders changed)")
+
+    cost = harvest_cost(reports, args.workers)
+    if cost["items"]:
+        seconds = f", about {cost['seconds']} seconds with {args.workers} workers" if cost["seconds"] is not None else ""
+        print(f"Estimated harvest: {cost['items']} items, {cost['geocubes_requests']} GeoCubes requests ({cost['header_bytes'] / 1e6:.1f} MB of headers), "
+              f"{cost['uploads']} uploads{seconds}")
+    else:
+        print("Nothing new to harvest.")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"new_datasets": new_datasets, "collections": reports, "cost": cost}, f, indent=2)
+
+    # The exit status tells a scheduler whether a harvest is needed, distinct from the status 1 of a failed run
+    sys.exit(EXIT_NEW_DATA if new_datasets or cost["items"] else 0)
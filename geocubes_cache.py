@@ -0,0 +1,247 @@
+import json
+import time
+import sqlite3
+import argparse
+import requests
+import threading
+from geocubes_throttle import governor
+
+DEFAULT_CACHE = "geocubes_cache.sqlite"
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60 # Seconds, entries older than this are read again from the file
+DEFAULT_MAX_ENTRIES = 500000
+
+class RasterCache:
+
+    """
+        On-disk cache of raster header snapshots keyed by URL. The headers are stored with the server's validators (ETag and Last-Modified),
+        and a cached header is only used after a conditional HEAD request confirms that the file has not changed.
+        The .tif links of the year folder listings are cached the same way, see geocubes_listing.py.
+        The cache can be shared between the threads of a harvest.
+
+        path - Path of the SQLite database
+        max_age - Entries older than this many seconds are evicted
+        max_entries - Number of entries kept when the cache is evicted, the least recently used are removed first
+    """
+
+    def __init__(self, path=DEFAULT_CACHE, max_age=DEFAULT_MAX_AGE, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False) # Worker processes may share the same file
+        # With write-ahead logging the worker processes read while another one writes, and a commit is not synced to disk on its own
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.used = {"headers": {}, "listings": {}} # Use times of the cache hits by table and URL, written by flush
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS headers (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                header TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS listings (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                hrefs TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self.connection.commit()
+
+    def validate(self, url):
+
+        """
+            Revalidates the cached header of the URL with a conditional HEAD request.
+            Returns a tuple of the cached header (None if not cached or changed) and the current validators of the file.
+            If the URL has no usable entry, no request is made and the validators are None.
+        """
+
+        with self.lock:
+            row = self.connection.execute("SELECT etag, last_modified, header, stored_at FROM headers WHERE url = ?", (url,)).fetchone()
+        if row is None or time.time() - row[3] >= self.max_age:
+            return None, None
+
+        request_headers = {}
+        if row[0]:
+            request_headers["If-None-Match"] = row[0]
+        if row[1]:
+            request_headers["If-Modified-Since"] = row[1]
+
+        r = governor.request(self.session, "HEAD", url, headers=request_headers, allow_redirects=True)
+        if r.status_code == 304:
+            validators = (r.headers.get("ETag", row[0]), r.headers.get("Last-Modified", row[1]))
+        else:
+            r.raise_for_status()
+            validators = (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+            if validators == (None, None) or validators != (row[0], row[1]):
+                return None, validators
+
+        with self.lock:
+            self.used["headers"][url] = time.time()
+        return json.loads(row[2]), validators
+
+    def validators(self, url):
+
+        """
+            Returns the ETag and Last-Modified of the URL from a HEAD request
+        """
+
+        r = governor.request(self.session, "HEAD", url, allow_redirects=True)
+        r.raise_for_status()
+        return (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+
+    def store(self, url, header, validators):
+
+        """
+            Stores the header of the URL with its validators. Files without an ETag or a Last-Modified cannot be revalidated, so they are not cached.
+        """
+
+        if validators == (None, None):
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+                (url, validators[0], validators[1], json.dumps(header), now, now)
+            )
+            self.connection.commit()
+
+    def listing(self, url):
+
+        """
+            Returns a tuple of the cached hrefs of a folder listing and their validators, or (None, None) if the listing is not cached
+        """
+
+        with self.lock:
+            row = self.connection.execute("SELECT etag, last_modified, hrefs FROM listings WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None, None
+            self.used["listings"][url] = time.time()
+        return json.loads(row[2]), (row[0], row[1])
+
+    def store_listing(self, url, hrefs, validators):
+
+        """
+            Stores the hrefs of a folder listing with its validators. Listings without an ETag or a Last-Modified are not cached.
+        """
+
+        if validators == (None, None):
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)",
+                (url, validators[0], validators[1], json.dumps(hrefs), now, now)
+            )
+            self.connection.commit()
+
+    def flush(self):
+
+        """
+            Writes the use times of the cache hits in one transaction, instead of a write for every hit. harvest_headers flushes after each folder.
+        """
+
+        with self.lock:
+            used, self.used = self.used, {"headers": {}, "listings": {}}
+            for table, times in used.items():
+                self.connection.executemany(f"UPDATE {table} SET used_at = ? WHERE url = ?", ((used_at, url) for url, used_at in times.items()))
+            self.connection.commit()
+
+    def evict(self):
+
+        """
+            Removes the header entries older than max_age, the least recently used entries over max_entries and the listings not used within max_age.
+            Returns the number of removed entries
+        """
+
+        self.flush()
+        with self.lock:
+            removed = self.connection.execute("DELETE FROM headers WHERE stored_at < ?", (time.time() - self.max_age,)).rowcount
+            removed += self.connection.execute(
+                "DELETE FROM headers WHERE url NOT IN (SELECT url FROM headers ORDER BY used_at DESC LIMIT ?)",
+                (self.max_entries,)
+            ).rowcount
+            removed += self.connection.execute("DELETE FROM listings WHERE used_at < ?", (time.time() - self.max_age,)).rowcount
+            self.connection.commit()
+        return removed
+
+    def purge(self):
+
+        """
+            Removes every entry from the cache. Returns the number of removed entries
+        """
+
+        with self.lock:
+            removed = self.connection.execute("DELETE FROM headers").rowcount
+            removed += self.connection.execute("DELETE FROM listings").rowcount
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+        return removed
+
+    def info(self):
+
+        """
+            Returns a dictionary with the number of header entries, their age range, the number of cached listings and the database size
+        """
+
+        with self.lock:
+            entries, oldest, newest = self.connection.execute("SELECT COUNT(*), MIN(stored_at), MAX(stored_at) FROM headers").fetchone()
+            listings = self.connection.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+            page_count = self.connection.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "listings": listings,
+            "oldest": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(oldest)) if oldest else None,
+            "newest": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(newest)) if newest else None,
+            "size_bytes": page_count * page_size
+        }
+
+    @property
+    def session(self):
+        # The harvest threads revalidate concurrently, each thread keeps its own pooled session like geotiff_header does
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            with self.lock:
+                self.sessions.append(self.local.session)
+        return self.local.session
+
+    def close(self):
+
+        """
+            Writes the use times, evicts the old entries and closes the database
+        """
+
+        self.evict()
+        for session in self.sessions:
+            session.close()
+        self.connection.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Inspect or purge the GeoCubes raster header cache")
+    parser.add_argument("command", choices=["info", "evict", "purge"], help="info shows the cache contents, evict removes old entries, purge empties the cache")
+    parser.add_argument("--cache", type=str, default=DEFAULT_CACHE, help=f"Path of the cache database (default {DEFAULT_CACHE})")
+    parser.add_argument("--max-age", type=float, default=DEFAULT_MAX_AGE / 86400, help="Maximum age of the entries in days, used by evict")
+    parser.add_argument("--max-entries", type=int, default=DEFAULT_MAX_ENTRIES, help="Maximum number of entries, used by evict")
+    args = parser.parse_args()
+
+    cache = RasterCache(args.cache, max_age=args.max_age * 86400, max_entries=args.max_entries)
+    if args.command == "info":
+        for key, value in cache.info().items():
+            print(f"{key}: {value}")
+    elif args.command == "evict":
+        print(f"Removed {cache.evict()} entries")
+    elif args.command == "purge":
+        print(f"Removed {cache.purge()} entries")
+    cache.connection.close()
@@ -0,0 +1,150 @@
+import os
+import json
+import argparse
+from pathlib import Path
+from geoserver_convert import loads, dumps, read_collection_folder
+from geocubes_metrics import metrics, add_metrics_arguments, start_metrics
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    from stac_geoparquet.arrow import parse_stac_ndjson_to_parquet, stac_table_to_items
+except ImportError:
+    pyarrow = None
+
+FORMATS = ("ndjson", "parquet")
+
+def export_paths(output, collection_id):
+
+    """
+        Returns the paths of the exported collection, NDJSON and stac-geoparquet files of a collection as a dictionary
+    """
+
+    output = Path(output)
+    return {
+        "collection": output / f"{collection_id}.collection.json",
+        "ndjson": output / f"{collection_id}.items.ndjson",
+        "parquet": output / f"{collection_id}.items.parquet"
+    }
+
+def export_collection(collection_folder, output=".", formats=FORMATS):
+
+    """
+        Writes the items of a collection into a single newline delimited JSON file, one STAC item per line,
+        and a stac-geoparquet file with one row per item. The collection is written next to them as JSON and
+        also kept in the metadata of the Parquet file. The Parquet file is converted from the NDJSON in chunks,
+        so neither of them is held in memory at once.
+        Returns the number of exported items
+
+        collection_folder - Folder of the collection.json
+        output - Folder of the written files
+        formats - "ndjson", "parquet" or both, the Parquet file needs the stac-geoparquet package
+    """
+
+    if "parquet" in formats and pyarrow is None:
+        raise ImportError("The stac-geoparquet export needs the stac-geoparquet package, install it with pip install stac-geoparquet")
+
+    with metrics.timer("export"):
+        stac_objects = read_collection_folder(collection_folder)
+        collection = next(stac_objects)
+        paths = export_paths(output, collection["id"])
+        with open(paths["collection"], "wb") as f:
+            f.write(dumps(collection) + b"\n")
+
+        count = 0
+        with open(paths["ndjson"], "wb") as f:
+            for item in stac_objects:
+                f.write(dumps(item) + b"\n")
+                count += 1
+
+        if "parquet" in formats:
+            if count:
+                parse_stac_ndjson_to_parquet(paths["ndjson"], paths["parquet"], collections={collection["id"]: collection})
+            elif paths["parquet"].exists():
+                # An empty collection has no schema to write, a file of an earlier export would be out of date
+                paths["parquet"].unlink()
+        if "ndjson" not in formats:
+            os.remove(paths["ndjson"])
+    return count
+
+def read_export(path):
+
+    """
+        Reads an exported collection from its NDJSON or stac-geoparquet file, the Parquet file is read one row group at a time.
+        Yields the STAC dictionary of the collection first and then those of its items, the same as read_collection_folder
+
+        path - .items.ndjson or .items.parquet file written by export_collection
+    """
+
+    path = Path(path)
+    if path.suffix == ".parquet":
+        if pyarrow is None:
+            raise ImportError("Reading a stac-geoparquet file needs the stac-geoparquet package, install it with pip install stac-geoparquet")
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        collections = json.loads(parquet_file.schema_arrow.metadata[b"stac-geoparquet"])["collections"]
+        yield next(iter(collections.values()))
+        batches = pyarrow.RecordBatchReader.from_batches(parquet_file.schema_arrow, parquet_file.iter_batches())
+        for item in stac_table_to_items(batches):
+            yield _restore_item(item)
+        return
+
+    with open(path.with_name(path.name.replace(".items.ndjson", ".collection.json")), "rb") as f:
+        yield loads(f.read())
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+def _restore_item(item):
+    # The properties and the other fields share the columns of the table, so the top level gsd of the items comes back among the properties
+    if "gsd" not in item and "gsd" in item["properties"]:
+        item["gsd"] = item["properties"].pop("gsd")
+    # The timestamps are stored with microseconds, the whole seconds are written back as in the catalog, e.g. 2019-01-01T00:00:00Z
+    for key in ("datetime", "start_datetime", "end_datetime"):
+        if isinstance(item["properties"].get(key), str):
+            item["properties"][key] = item["properties"][key].replace(".000000Z", "Z")
+    # The links and assets are stored as structs with a field for every key of the file, the keys an item does not have come back as None
+    item["links"] = [{key: value for key, value in link.items() if value is not None} for link in item["links"]]
+    item["assets"] = {
+        asset_id: {key: value for key, value in asset.items() if value is not None}
+        for asset_id, asset in item["assets"].items() if asset is not None
+    }
+    return item
+
+def add_export_arguments(parser):
+
+    """
+        Adds the export options to the argument parser of a script
+    """
+
+    parser.add_argument("--export-format", choices=["ndjson", "parquet", "both"],
+                        help="Exported files, both by default if stac-geoparquet is installed and otherwise ndjson")
+
+def export_formats(args, parser):
+
+    """
+        Returns the export formats selected by the options of add_export_arguments, stops with an error if Parquet is selected without stac-geoparquet
+    """
+
+    if args.export_format is None:
+        return FORMATS if pyarrow is not None else ("ndjson",)
+    formats = FORMATS if args.export_format == "both" else (args.export_format,)
+    if "parquet" in formats and pyarrow is None:
+        parser.error("the parquet export needs the stac-geoparquet package, install it with pip install stac-geoparquet")
+    return formats
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export collections of the STAC catalog into a single NDJSON file of items and a stac-geoparquet file for each collection")
+    parser.add_argument("collections", nargs="+", help="Collection folders, e.g. GeoCubes/sentinel_1_global_backscatter_at_geocubes")
+    parser.add_argument("--output", type=str, default=".", help="Folder of the written files (default current folder)")
+    add_export_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    start_metrics(args)
+    formats = export_formats(args, parser)
+
+    os.makedirs(args.output, exist_ok=True)
+    for collection_folder in args.collections:
+        count = export_collection(collection_folder, args.output, formats)
+        print(f"{Path(collection_folder).name}: {count} items exported as {' and '.join(formats)}")
@@ -0,0 +1,70 @@
+import pystac
+
+class ExtentAccumulator:
+
+    """
+        Running spatial and temporal extent and GSD summary of a collection. The accumulator is updated as each item is added,
+        so the collection can be finalized without walking its items again.
+    """
+
+    def __init__(self):
+        self.bbox = None
+        self.start_datetime = None
+        self.end_datetime = None
+        self.gsd = []
+
+    @classmethod
+    def from_collection(cls, collection):
+
+        """
+            Seeds the accumulator from the current extents and GSD summary of an existing collection, e.g. one fetched from the STAC API.
+            Returns the accumulator
+        """
+
+        accumulator = cls()
+        accumulator.add_bbox(collection.extent.spatial.bboxes[0])
+        start, end = collection.extent.temporal.intervals[0]
+        accumulator.add_interval(start, end)
+        for gsd in collection.summaries.lists.get("gsd", []):
+            accumulator.add_gsd(gsd)
+        return accumulator
+
+    def add_bbox(self, bbox):
+        if self.bbox is None:
+            self.bbox = list(bbox)
+        else:
+            self.bbox = [
+                min(self.bbox[0], bbox[0]),
+                min(self.bbox[1], bbox[1]),
+                max(self.bbox[2], bbox[2]),
+                max(self.bbox[3], bbox[3])
+            ]
+
+    def add_interval(self, start, end):
+        if start is not None and (self.start_datetime is None or start < self.start_datetime):
+            self.start_datetime = start
+        if end is not None and (self.end_datetime is None or end > self.end_datetime):
+            self.end_datetime = end
+
+    def add_gsd(self, gsd):
+        if gsd not in self.gsd:
+            self.gsd.append(gsd)
+
+    def add_item(self, item):
+
+        """
+            Adds the bbox and the start and end times of an ItemRecord to the extents
+        """
+
+        self.add_bbox(item.bbox)
+        self.add_interval(item.start_datetime, item.end_datetime)
+
+    def apply(self, collection):
+
+        """
+            Sets the accumulated extents and the sorted GSD summary to the collection
+        """
+
+        collection.extent.spatial = pystac.SpatialExtent([self.bbox])
+        collection.extent.temporal = pystac.TemporalExtent([[self.start_datetime, self.end_datetime]])
+        collection.summaries.lists["gsd"] = sorted(self.gsd)
@@ -0,0 +1,96 @@
+import re
+import pandas
+
+COLUMNS = ["file", "asset_id", "prefix", "name", "info"]
+
+def collection_slug(name):
+
+    """
+        Returns the name in the form used in the item IDs, e.g. "Country land" as country_land
+    """
+
+    return name.lower().replace(" ", "_").replace(",", "")
+
+def collection_id(name):
+
+    """
+        Returns the ID of the collection made from a dataset by geocubes_stac.py, e.g. "Country" as country_at_geocubes
+
+        name - English name of the collection from the CSV
+    """
+
+    # For sentinel and NDVI collections, the name is specified a bit different as the names contain the years/months of the data
+    col_name = re.sub(r'\W+','_', name.lower())
+    if "sentinel" in col_name:
+        col_name = "_".join(col_name.split("_")[:-2])
+    elif "ndvi" in col_name:
+        col_name = "_".join(col_name.split("_")[:-1])
+    return f"{col_name}_at_geocubes"
+
+def parse_filename(href):
+
+    """
+        Splits a .tif name into the columns of index_listing. The first four underscore separated fields of the name are the prefix that groups the files of an item,
+        e.g. valtakunta_100m_2019_1, its first field is the dataset name and the rest is the item information of the item ID.
+        The last field of the name is the asset ID of the file, e.g. 200m in valtakunta_100m_2019_1_200m.
+        Returns a tuple of the file name without the extension, asset ID, prefix, dataset name and item information
+    """
+
+    file = href.split(".")[0]
+    fields = file.split("_")
+    return (file, fields[-1], "_".join(fields[:4]), fields[0], "_".join(fields[1:4]))
+
+def parse_asset_id(file):
+
+    """
+        Returns the asset ID of a single file name, the same as the asset_id column of index_listing
+    """
+
+    return file.split(".")[0].split("_")[-1]
+
+def index_listing(hrefs, year_path, collection_name):
+
+    """
+        Parses the .tif names of a year folder listing and derives the item IDs column by column, once for each item. The sentinel and NDVI items are named from the file names, and the rest from the English name of the collection.
+        Returns a pandas.DataFrame with one row per file in listing order and the columns
+        file (name without the extension), prefix, item_id, asset_id and year
+
+        hrefs - File names of the listing, e.g. from geocubes_listing.list_tifs
+        year_path - URL of the year folder, the year is its last part
+        collection_name - English name of the collection from the CSV
+    """
+
+    parts = pandas.DataFrame([parse_filename(href) for href in hrefs], columns=COLUMNS, dtype=object)
+
+    # The item ID depends only on the prefix, so it is derived once for each item from the first file of the item
+    codes, _ = pandas.factorize(parts["prefix"])
+    items = parts.drop_duplicates("prefix")
+
+    # The sentinel and NDVI items are named a bit differently from the rest
+    info = "_" + items["info"]
+    sentinel = items["prefix"].str.contains("sentinel", regex=False)
+    ndvi = ~sentinel & items["prefix"].str.contains("ndvi", regex=False)
+    item_ids = collection_slug(collection_name) + info
+    if sentinel.any():
+        item_ids[sentinel] = items["name"][sentinel].map(lambda name: collection_slug(name.replace("-", "_"))) + info[sentinel]
+    if ndvi.any():
+        item_ids[ndvi] = items["name"][ndvi].str.lower() + info[ndvi]
+
+    index = parts[["file", "prefix"]].assign(item_id=item_ids.to_numpy()[codes], asset_id=parts["asset_id"])
+    index["year"] = year_path.rstrip("/").split("/")[-1]
+    return index
+
+def group_items(index):
+
+    """
+        Groups the files of an index by their prefix, in the order the prefixes first appear in the listing.
+        The first file of a group is the COG of the item and the rest are its other assets.
+        Returns a dictionary from prefix to a tuple of the item ID and the list of its file names
+    """
+
+    groups = {}
+    for prefix, item_id, file in zip(index["prefix"].tolist(), index["item_id"].tolist(), index["file"].tolist()):
+        if prefix not in groups:
+            groups[prefix] = (item_id, [])
+        groups[prefix][1].append(file)
+    return groups
@@ -0,0 +1,226 @@
+import re
+import rasterio
+import requests
+import datetime
+import warnings
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+from rasterio.io import DatasetReader
+from rasterio.errors import RasterioIOError
+from rasterio.transform import Affine
+from pystac.utils import str_to_datetime
+from rio_stac.stac import get_dataset_geom, get_projection_info
+from geotiff_header import fetch_geotiff_header, GeoTIFFHeaderError
+from geocubes_metrics import metrics
+from geocubes_throttle import governor
+from geocubes_filenames import parse_asset_id
+from geocubes_item import AssetRecord, ItemRecord
+
+COG_MEDIA_TYPE = "image/tiff; application=geotiff; profile=cloud-optimized"
+GEOTIFF_MEDIA_TYPE = "image/tiff; application=geotiff"
+GDAL_HTTP_STATUS = re.compile(r"HTTP response code: (\d+)")
+
+_local = threading.local()
+
+class HeaderDataset:
+
+    """
+        Read-only view of a header snapshot with the attributes that rio_stac reads from an opened dataset
+    """
+
+    def __init__(self, header):
+        self.crs = CRS.from_wkt(header["wkt"]) if header["wkt"] is not None else None
+        self.bounds = BoundingBox(*header["bounds"])
+        self.height, self.width = header["shape"]
+        self.transform = Affine(*header["transform"][:6])
+
+def read_header(source, cache=None, range_reader=True):
+
+    """
+        Captures a snapshot of the raster header. The snapshot holds everything the assets and the item
+        need, so the file does not have to be opened again when the item is made.
+        Returns the header as a dictionary
+
+        source - Raster URL or an already opened rasterio dataset
+        cache - Optional RasterCache, a cached header of an unchanged file is returned without opening it with GDAL
+        range_reader - Parse the header from a single range request, rasterio is used if the header cannot be read from it
+    """
+
+    if not isinstance(source, DatasetReader):
+        with metrics.timer("raster_open"):
+            header, validators = None, None
+            if cache is not None:
+                header, validators = cache.validate(source)
+                # A header cached before the date was kept is read again
+                if header is not None and "datetime" not in header:
+                    header, validators = None, None
+                if header is not None:
+                    metrics.count("header_cache_hit")
+                    return header
+            if range_reader and source.startswith(("http://", "https://")):
+                try:
+                    header, validators = fetch_geotiff_header(source)
+                    metrics.count("header_range_request")
+                except GeoTIFFHeaderError:
+                    pass
+            if header is None:
+                metrics.count("header_gdal")
+                # GDAL makes its own requests, the open is counted as one request to the server
+                with governor.slot() as slot:
+                    try:
+                        with rasterio.open(source) as src:
+                            header = read_header(src)
+                    except RasterioIOError as e:
+                        slot.failure(*gdal_failure(e))
+                        raise
+            if cache is not None:
+                if validators is None:
+                    validators = cache.validators(source)
+                cache.store(source, header, validators)
+            return header
+
+    return {
+        "res": list(source.res),
+        "shape": [source.height, source.width],
+        "transform": list(source.transform),
+        "bounds": list(source.bounds),
+        "wkt": source.crs.to_wkt() if source.crs is not None else None,
+        # The date rio_stac gives the item, the items made without one are dated when they are made
+        "datetime": source.get_tag_item("ACQUISITIONDATETIME", "IMAGERY") or source.get_tag_item("TIFFTAG_DATETIME")
+    }
+
+def gdal_failure(error):
+
+    """
+        Classifies a failed GDAL open of a remote raster from its error message, e.g. "HTTP response code: 404" or "CURL error: Failed to connect".
+        Returns a tuple of the HTTP status, None if the server did not answer, and whether the connection failed or timed out
+    """
+
+    message = str(error)
+    match = GDAL_HTTP_STATUS.search(message)
+    if match is not None:
+        return int(match.group(1)), False
+    return None, message.startswith("CURL error") or "timed out" in message.lower()
+
+def harvest_headers(hrefs, workers=1, cache=None, range_reader=True):
+
+    """
+        Reads the raster headers of all the given hrefs. With more than one worker the headers are fetched
+        concurrently with a thread pool, GDAL releases the GIL while it waits for the network.
+        Returns a dictionary from href to header snapshot, in the same order as the given hrefs.
+
+        hrefs - List of raster URLs, duplicates are read only once
+        workers - Number of concurrent header fetches
+        cache - Optional RasterCache used by read_header
+        range_reader - Use the range request header reader before rasterio
+    """
+
+    hrefs = list(dict.fromkeys(hrefs))
+    if workers > 1 and len(hrefs) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            headers = list(executor.map(partial(read_header, cache=cache, range_reader=range_reader), hrefs))
+    else:
+        headers = [read_header(href, cache, range_reader) for href in hrefs]
+    if cache is not None:
+        cache.flush()
+
+    return dict(zip(hrefs, headers))
+
+def read_fingerprint(url):
+
+    """
+        Reads the size, Last-Modified and ETag of a file with a HEAD request, without reading the file.
+        A file that is processed again in place gets a new fingerprint.
+        Returns the fingerprint as a tuple
+    """
+
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    with metrics.timer("fingerprint"):
+        r = governor.request(_local.session, "HEAD", url, allow_redirects=True)
+    r.raise_for_status()
+    size = r.headers.get("Content-Length")
+    return (int(size) if size is not None else None, r.headers.get("Last-Modified"), r.headers.get("ETag"))
+
+def harvest_fingerprints(hrefs, workers=1):
+
+    """
+        Reads the fingerprints of all the given hrefs, concurrently with more than one worker.
+        Returns a dictionary from href to fingerprint, in the same order as the given hrefs
+    """
+
+    hrefs = list(dict.fromkeys(hrefs))
+    if workers > 1 and len(hrefs) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fingerprints = list(executor.map(read_fingerprint, hrefs))
+    else:
+        fingerprints = [read_fingerprint(href) for href in hrefs]
+
+    return dict(zip(hrefs, fingerprints))
+
+def header_datetime(header):
+
+    """
+        Returns the date of the raster from its header snapshot as a datetime, None if it has no date or the date cannot be parsed, like rio_stac does
+    """
+
+    if not header.get("datetime"):
+        return None
+    try:
+        return str_to_datetime(header["datetime"])
+    except ValueError as e:
+        warnings.warn(f"Could not parse the date {header['datetime']}: {e}")
+        return None
+
+@metrics.timed("item_create")
+def create_record(item_id, year_path, key, files, headers):
+
+    """
+        Makes the record of an item from the header snapshots of its files, without opening the rasters again.
+        The geometry and the projection properties come from the same rio_stac functions that create_stac_item uses with with_proj=True.
+        The first file is the COG asset and the others are named by their resolution, the item covers the year of the folder.
+        The item is dated with the date tag of its source raster like create_stac_item does, or with the current time if the raster has none.
+        Returns the item as ItemRecord
+
+        item_id - ID of the item
+        year_path - URL of the year folder
+        key - File name of the item's source raster, without the .tif suffix
+        files - File names of the item's assets, without the .tif suffix
+        headers - Dictionary of the header snapshots keyed by href, from harvest_headers
+    """
+
+    assets = []
+    for n, file in enumerate(files):
+        header = headers[year_path+file+".tif"]
+        assets.append(AssetRecord(
+            key="COG" if n == 0 else parse_asset_id(file),
+            href=year_path+file+".tif",
+            media_type=COG_MEDIA_TYPE if n == 0 else GEOTIFF_MEDIA_TYPE,
+            gsd=int(header["res"][0]),
+            shape=tuple(header["shape"]),
+            transform=tuple(header["transform"])
+        ))
+
+    dataset = HeaderDataset(headers[year_path+key+".tif"])
+    dataset_geom = get_dataset_geom(dataset)
+    projection = get_projection_info(dataset)
+
+    # Takes the year from the path
+    year = int(year_path.split('/')[-2])
+    return ItemRecord(
+        id=item_id,
+        bbox=tuple(dataset_geom["bbox"]),
+        footprint=tuple(tuple(point) for point in dataset_geom["footprint"]["coordinates"][0]),
+        proj_bbox=tuple(projection["bbox"]),
+        shape=tuple(projection["shape"]),
+        transform=tuple(projection["transform"]),
+        start_datetime=datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc),
+        end_datetime=datetime.datetime(year, 12, 31, tzinfo=datetime.timezone.utc),
+        item_datetime=header_datetime(headers[year_path+key+".tif"]) or datetime.datetime.now(datetime.timezone.utc),
+        gsd=min(asset.gsd for asset in assets),
+        assets=tuple(assets),
+        wkt2=projection.get("wkt2")
+    )
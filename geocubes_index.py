@@ -0,0 +1,340 @@
+import sys
+import time
+import sqlite3
+import argparse
+import datetime
+import requests
+import threading
+from pathlib import Path
+from geocubes_state import CatalogState, DEFAULT_STATE, add_state_arguments, state_max_age
+from geoserver_convert import read_collection_folder
+from geocubes_item import ItemRecord
+
+DEFAULT_INDEX = "geocubes_index.sqlite"
+
+class ItemIndex:
+
+    """
+        Local spatial and temporal index of the harvested items, so the items covering an area and a time can be found without reading the item files.
+        Each item has a row with its collection, ID, bbox, time range and GSD, and its bbox and time range are also kept in an SQLite R*Tree.
+        The R*Tree stores its coordinates as 32-bit floats rounded outwards, so its matches are checked against the exact values of the rows.
+
+        path - Path of the SQLite database
+    """
+
+    def __init__(self, path=DEFAULT_INDEX):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False) # Worker processes may share the same file
+        # With write-ahead logging the worker processes read while another one writes, and a commit is not synced to disk on its own
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                rowid INTEGER PRIMARY KEY,
+                collection TEXT NOT NULL,
+                id TEXT NOT NULL,
+                min_x REAL NOT NULL,
+                min_y REAL NOT NULL,
+                max_x REAL NOT NULL,
+                max_y REAL NOT NULL,
+                start_time REAL,
+                end_time REAL,
+                gsd REAL,
+                indexed_at REAL NOT NULL,
+                UNIQUE (collection, id)
+            )
+        """)
+        self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS item_bounds USING rtree(id, min_x, max_x, min_y, max_y, start_time, end_time)")
+        self.connection.commit()
+
+    def add_items(self, rows):
+
+        """
+            Adds or replaces items in one transaction
+
+            rows - Rows from item_row
+        """
+
+        now = time.time()
+        with self.lock:
+            for collection_id, item_id, min_x, min_y, max_x, max_y, start, end, gsd in rows:
+                rowid = self.connection.execute("""
+                    INSERT INTO items (collection, id, min_x, min_y, max_x, max_y, start_time, end_time, gsd, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (collection, id) DO UPDATE SET
+                        min_x = excluded.min_x, min_y = excluded.min_y, max_x = excluded.max_x, max_y = excluded.max_y,
+                        start_time = excluded.start_time, end_time = excluded.end_time, gsd = excluded.gsd, indexed_at = excluded.indexed_at
+                    RETURNING rowid
+                """, (collection_id, item_id, min_x, min_y, max_x, max_y, start, end, gsd, now)).fetchone()[0]
+                # An item without a time range covers all times in the tree
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO item_bounds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (rowid, min_x, max_x, min_y, max_y, start if start is not None else -1e12, end if end is not None else 1e12)
+                )
+            self.connection.commit()
+
+    def retain(self, collection_id, item_ids):
+
+        """
+            Removes the items of the collection that are not in item_ids, e.g. items whose files were removed from GeoCubes.
+            Returns the number of removed items
+        """
+
+        removed = self.item_ids(collection_id) - set(item_ids)
+        with self.lock:
+            for item_id in removed:
+                row = self.connection.execute("DELETE FROM items WHERE collection = ? AND id = ? RETURNING rowid", (collection_id, item_id)).fetchone()
+                self.connection.execute("DELETE FROM item_bounds WHERE id = ?", (row[0],))
+            self.connection.commit()
+        return len(removed)
+
+    def query(self, bbox=None, start=None, end=None, collection_id=None, max_gsd=None):
+
+        """
+            Finds the items that intersect the bbox and overlap the time range.
+            Returns a list of dictionaries with the collection, id, bbox, start, end (as datetimes) and gsd of the items, ordered by collection and ID
+
+            bbox - Optional [min_x, min_y, max_x, max_y] in WGS84
+            start - Optional datetime, the items that end before it are left out
+            end - Optional datetime, the items that start after it are left out
+            collection_id - Optional collection of the items
+            max_gsd - Optional coarsest GSD of the items in meters
+        """
+
+        conditions, parameters = [], []
+        if bbox is not None:
+            conditions.append("b.min_x <= ? AND b.max_x >= ? AND b.min_y <= ? AND b.max_y >= ? AND i.min_x <= ? AND i.max_x >= ? AND i.min_y <= ? AND i.max_y >= ?")
+            parameters += [bbox[2], bbox[0], bbox[3], bbox[1]] * 2
+        if start is not None:
+            conditions.append("b.end_time >= ? AND (i.end_time IS NULL OR i.end_time >= ?)")
+            parameters += [_timestamp(start)] * 2
+        if end is not None:
+            conditions.append("b.start_time <= ? AND (i.start_time IS NULL OR i.start_time <= ?)")
+            parameters += [_timestamp(end)] * 2
+        if collection_id is not None:
+            conditions.append("i.collection = ?")
+            parameters.append(collection_id)
+        if max_gsd is not None:
+            conditions.append("i.gsd <= ?")
+            parameters.append(max_gsd)
+
+        with self.lock:
+            rows = self.connection.execute(f"""
+                SELECT i.collection, i.id, i.min_x, i.min_y, i.max_x, i.max_y, i.start_time, i.end_time, i.gsd
+                FROM item_bounds b JOIN items i ON i.rowid = b.id
+                {"WHERE " + " AND ".join(conditions) if conditions else ""}
+                ORDER BY i.collection, i.id
+            """, parameters).fetchall()
+        return [
+            {"collection": row[0], "id": row[1], "bbox": list(row[2:6]), "start": _datetime(row[6]), "end": _datetime(row[7]), "gsd": row[8]}
+            for row in rows
+        ]
+
+    def extent(self, collection_id):
+
+        """
+            Returns the extent of the indexed items of the collection as a dictionary of the bbox, the start and end datetimes,
+            the sorted GSDs of the items and the number of items, None if the collection has no items
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MIN(min_x), MIN(min_y), MAX(max_x), MAX(max_y), MIN(start_time), MAX(end_time), COUNT(*) FROM items WHERE collection = ?",
+                (collection_id,)
+            ).fetchone()
+            gsd = [value for value, in self.connection.execute("SELECT DISTINCT gsd FROM items WHERE collection = ? AND gsd IS NOT NULL ORDER BY gsd", (collection_id,))]
+        if row[6] == 0:
+            return None
+        return {"bbox": list(row[:4]), "start": _datetime(row[4]), "end": _datetime(row[5]), "gsd": gsd, "items": row[6]}
+
+    def item_ids(self, collection_id):
+
+        """
+            Returns the IDs of the indexed items of the collection as a set
+        """
+
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT id FROM items WHERE collection = ?", (collection_id,))}
+
+    def diff(self, collection_id, remote_ids):
+
+        """
+            Compares the indexed items of the collection with the item IDs of another catalog, e.g. the STAC API.
+            Returns a tuple of the sorted IDs only in the index and the sorted IDs only in the other catalog
+        """
+
+        local_ids = self.item_ids(collection_id)
+        return sorted(local_ids - set(remote_ids)), sorted(set(remote_ids) - local_ids)
+
+    def collections(self):
+
+        """
+            Returns the IDs of the collections in the index
+        """
+
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT DISTINCT collection FROM items ORDER BY collection")]
+
+    def purge(self):
+
+        """
+            Removes the whole index. Returns the number of removed items
+        """
+
+        with self.lock:
+            removed = self.connection.execute("DELETE FROM items").rowcount
+            self.connection.execute("DELETE FROM item_bounds")
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+        return removed
+
+    def info(self):
+
+        """
+            Returns a dictionary of the collections in the index with their item counts and last index times
+        """
+
+        with self.lock:
+            rows = self.connection.execute("SELECT collection, COUNT(*), MAX(indexed_at) FROM items GROUP BY collection ORDER BY collection").fetchall()
+        return {
+            collection_id: {"items": count, "indexed_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(indexed_at))}
+            for collection_id, count, indexed_at in rows
+        }
+
+    def close(self):
+        self.connection.close()
+
+def _timestamp(value):
+    # The times are kept as UTC seconds, naive datetimes like those of geocubes_stac.py are taken as UTC
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+def _datetime(value):
+    return None if value is None else datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+
+def item_row(collection_id, item):
+
+    """
+        Returns the index row of an item, given as an ItemRecord or as a STAC dictionary.
+        The time range is the start and end datetime of the item, or its datetime if it has no range.
+    """
+
+    if isinstance(item, ItemRecord):
+        return (collection_id, item.id, *item.bbox[:4], _timestamp(item.start_datetime), _timestamp(item.end_datetime), item.gsd)
+
+    properties = item["properties"]
+    start = properties.get("start_datetime") or properties.get("datetime")
+    end = properties.get("end_datetime") or properties.get("datetime")
+    return (collection_id, item["id"], *item["bbox"][:4], _timestamp(start), _timestamp(end), item.get("gsd", properties.get("gsd")))
+
+def index_catalog(index, root="GeoCubes"):
+
+    """
+        Indexes the collections of a catalog written by geocubes_stac.py, e.g. an existing backup, and removes the items that are no longer in it.
+        Returns a dictionary from collection ID to the number of indexed items
+    """
+
+    counts = {}
+    for collection_file in sorted(Path(root).glob("*/collection.json")):
+        stac_objects = read_collection_folder(collection_file.parent)
+        collection = next(stac_objects)
+        rows = [item_row(collection["id"], item) for item in stac_objects]
+        index.add_items(rows)
+        index.retain(collection["id"], [row[1] for row in rows])
+        counts[collection["id"]] = len(rows)
+    return counts
+
+def parse_time(value, end=False):
+
+    """
+        Parses a year, e.g. 2019, or a date or a datetime in ISO format. The end of a year or a date is its last moment when end is True.
+    """
+
+    if len(value) == 4:
+        return datetime.datetime(int(value) + end, 1, 1, tzinfo=datetime.timezone.utc) - datetime.timedelta(microseconds=end)
+    parsed = datetime.datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        parsed += datetime.timedelta(days=1, microseconds=-1)
+    return parsed
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Query, rebuild or compare the local index of the harvested items")
+    parser.add_argument("command", choices=["info", "query", "extent", "diff", "rebuild", "purge"],
+                        help="info shows the indexed collections, query finds items, extent shows the extents of the collections, "
+                             "diff compares the index with the STAC API, rebuild indexes the GeoCubes folder, purge empties the index")
+    parser.add_argument("--index", type=str, default=DEFAULT_INDEX, help=f"Path of the index database (default {DEFAULT_INDEX})")
+    parser.add_argument("--collection", type=str, help="Only this collection")
+    parser.add_argument("--bbox", type=str, help="Items that intersect this WGS84 bbox, given as min_x,min_y,max_x,max_y")
+    parser.add_argument("--start", type=str, help="Items that end at or after this year, date or datetime, e.g. 2019 or 2019-06-01")
+    parser.add_argument("--end", type=str, help="Items that start at or before this year, date or datetime")
+    parser.add_argument("--year", type=str, help="Items that overlap this year, the same as --start and --end with the same year")
+    parser.add_argument("--max-gsd", type=float, help="Items with a GSD of at most this many meters")
+    parser.add_argument("--root", type=str, default="GeoCubes", help="Catalog folder indexed by rebuild (default GeoCubes)")
+    parser.add_argument("--host", type=str, help="Hostname of the STAC API, required by diff")
+    parser.add_argument("--state", type=str, default=DEFAULT_STATE, help=f"Snapshot of the remote item IDs used by diff, see geocubes_state.py (default {DEFAULT_STATE})")
+    add_state_arguments(parser)
+    args = parser.parse_args()
+
+    index = ItemIndex(args.index)
+    collections = [args.collection] if args.collection else index.collections()
+
+    if args.command == "query":
+        start = parse_time(args.start or args.year) if args.start or args.year else None
+        end = parse_time(args.end or args.year, end=True) if args.end or args.year else None
+        bbox = [float(value) for value in args.bbox.split(",")] if args.bbox else None
+        items = index.query(bbox, start, end, args.collection, args.max_gsd)
+        for item in items:
+            print(f"{item['collection']} {item['id']} {item['start']:%Y-%m-%d} - {item['end']:%Y-%m-%d} {item['gsd']:g}m")
+        print(f"{len(items)} items")
+    elif args.command == "extent":
+        for collection_id in collections:
+            extent = index.extent(collection_id)
+            if extent is None:
+                print(f"{collection_id}: no items")
+                continue
+            bbox = ", ".join(f"{value:.6f}" for value in extent["bbox"])
+            gsd = ", ".join(f"{value:g}" for value in extent["gsd"])
+            print(f"{collection_id}: {extent['items']} items, bbox [{bbox}], {extent['start']:%Y-%m-%d} - {extent['end']:%Y-%m-%d}, gsd {gsd}")
+    elif args.command == "diff":
+        if not args.host:
+            parser.error("diff requires --host")
+        # The remote IDs come from the same snapshot as update_geocubes.py uses, it is listed again only if the item counts differ
+        stac_url = f"{args.host}/geoserver/ogc/stac/v1/"
+        session = requests.Session()
+        session.headers.update({"User-Agent": "update-script"})
+        state = CatalogState(args.state, state_max_age(args))
+        different = 0
+        for collection_id in collections:
+            try:
+                state.refresh(stac_url, collection_id, session)
+                remote_ids = state.item_ids(collection_id)
+            except requests.HTTPError as e:
+                # A collection that has not been uploaded yet
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                remote_ids = set()
+            only_local, only_remote = index.diff(collection_id, remote_ids)
+            different += len(only_local) + len(only_remote)
+            print(f"{collection_id}: {len(only_local)} items only in the index, {len(only_remote)} only in the STAC API")
+            for item_id in only_local:
+                print(f" + {item_id}")
+            for item_id in only_remote:
+                print(f" - {item_id}")
+        state.close()
+        index.close()
+        sys.exit(1 if different else 0)
+    else:
+        if args.command == "rebuild":
+            for collection_id, count in index_catalog(index, args.root).items():
+                print(f"{collection_id}: {count} items indexed")
+        elif args.command == "purge":
+            print(f"Removed {index.purge()} items")
+        for collection_id, info in index.info().items():
+            print(f"{collection_id}: {info['items']} items, indexed {info['indexed_at']}")
+    index.close()
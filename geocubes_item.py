@@ -0,0 +1,107 @@
+import pystac
+import datetime
+from dataclasses import dataclass
+from pystac.utils import datetime_to_str
+from rio_stac.stac import bbox_to_geom, PROJECTION_EXT_VERSION
+
+PROJECTION_EXTENSION = f"https://stac-extensions.github.io/projection/{PROJECTION_EXT_VERSION}/schema.json"
+
+@dataclass(slots=True, frozen=True)
+class AssetRecord:
+
+    """
+        One raster file of an item, with the fields of the STAC asset that differ between the files. The key is also the title of the asset.
+    """
+
+    key: str
+    href: str
+    media_type: str
+    gsd: int
+    shape: tuple
+    transform: tuple
+
+    def to_dict(self):
+
+        """
+            Returns the asset as a STAC dictionary, with the same keys in the same order as pystac.Asset.to_dict
+        """
+
+        return {
+            "href": self.href,
+            "type": self.media_type,
+            "title": self.key,
+            "gsd": self.gsd,
+            "proj:shape": list(self.shape),
+            "proj:transform": list(self.transform),
+            "roles": ["data"]
+        }
+
+@dataclass(slots=True, frozen=True)
+class ItemRecord:
+
+    """
+        Compact record of a harvested item, used instead of pystac.Item while the items are made, written and uploaded.
+        The record has no links, parent pointers or asset objects, and the geometries are kept as tuples of coordinates.
+        The STAC dictionary is made only when the item is written or uploaded.
+    """
+
+    id: str
+    bbox: tuple
+    footprint: tuple # Exterior ring of the geometry in WGS84
+    proj_bbox: tuple
+    shape: tuple
+    transform: tuple
+    start_datetime: datetime.datetime
+    end_datetime: datetime.datetime
+    item_datetime: datetime.datetime # Date of the source raster, or the time the item was made if the raster has none
+    gsd: int
+    assets: tuple
+    epsg: int = 3067
+    wkt2: str = None
+
+    def to_dict(self, collection_id=None, links=()):
+
+        """
+            Returns the item as a STAC dictionary, with the same keys in the same order as pystac.Item.to_dict,
+            so the streamed files are the same as those written by normalize_and_save.
+
+            collection_id - ID of the collection of the item, None leaves out the collection field
+            links - Link dictionaries of the item
+        """
+
+        properties = {
+            "proj:epsg": self.epsg,
+            "proj:geometry": bbox_to_geom(self.proj_bbox),
+            "proj:bbox": list(self.proj_bbox),
+            "proj:shape": list(self.shape),
+            "proj:transform": list(self.transform)
+        }
+        if self.wkt2 is not None:
+            properties["proj:wkt2"] = self.wkt2
+        properties["start_datetime"] = datetime_to_str(self.start_datetime)
+        properties["end_datetime"] = datetime_to_str(self.end_datetime)
+        properties["datetime"] = datetime_to_str(self.item_datetime)
+
+        item = {
+            "type": "Feature",
+            "stac_version": pystac.get_stac_version(),
+            "stac_extensions": [PROJECTION_EXTENSION],
+            "id": self.id,
+            "geometry": {"type": "Polygon", "coordinates": [[list(point) for point in self.footprint]]},
+            "bbox": list(self.bbox),
+            "properties": properties,
+            "links": list(links),
+            "assets": {asset.key: asset.to_dict() for asset in self.assets}
+        }
+        if collection_id is not None:
+            item["collection"] = collection_id
+        item["gsd"] = self.gsd
+        return item
+
+    def to_item(self):
+
+        """
+            Returns the item as pystac.Item, for the catalog that is saved as a whole with normalize_and_save
+        """
+
+        return pystac.Item.from_dict(self.to_dict(), migrate=False, preserve_dict=False)
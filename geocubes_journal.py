@@ -0,0 +1,102 @@
+import os
+import json
+import threading
+
+class Journal:
+
+    """
+        Append-only journal of the finished units of a run, one JSON record per line. A record is written as soon as its unit is finished,
+        so a run that stops can be resumed from the journal and only the unfinished work is done again.
+        A run that was killed while writing may leave a partial last line, it is dropped when the journal is opened.
+        The journal can be shared between the threads of a run.
+
+        path - Path of the journal file
+        resume - Keep the records of the earlier run, otherwise the journal is started empty
+        records - Records already loaded by another process, e.g. the parent of a worker process. The file is then only appended to,
+                  it is not read or truncated while the other processes may be writing to it.
+    """
+
+    def __init__(self, path, resume=False, records=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        self.units = {}
+        if records is not None:
+            for record in records:
+                self._add(record)
+        elif resume and os.path.exists(path):
+            self._load()
+        else:
+            open(path, "wb").close()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self._add(record)
+        if complete < len(data):
+            # The last record was not written completely
+            with open(self.path, "r+b") as f:
+                f.truncate(complete)
+
+    def _add(self, record):
+        self.index[(record["unit"], tuple(record["key"]))] = record
+        self.units.setdefault(record["unit"], []).append(record)
+
+    def done(self, unit, *key):
+
+        """
+            Returns True if the unit with the given key is recorded as finished
+        """
+
+        return (unit, tuple(key)) in self.index
+
+    def get(self, unit, *key):
+
+        """
+            Returns the record of the unit with the given key, or None if it is not finished
+        """
+
+        return self.index.get((unit, tuple(key)))
+
+    def records(self, unit):
+
+        """
+            Returns the records of the given unit type in the order they were written
+        """
+
+        return self.units.get(unit, [])
+
+    def records_with(self, first):
+
+        """
+            Returns the records of all unit types whose key starts with the given value, e.g. all the records of a collection
+        """
+
+        return [record for records in self.units.values() for record in records if record["key"][0] == first]
+
+    def record(self, unit, *key, **fields):
+
+        """
+            Records a finished unit. The line is flushed at once, so it is kept even if the run stops right after.
+
+            unit - Type of the unit, e.g. "collection", "item" or "upload"
+            key - Values identifying the unit, e.g. the collection and item IDs
+            fields - Additional values stored with the record
+        """
+
+        record = {"unit": unit, "key": list(key), **fields}
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self._add(record)
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
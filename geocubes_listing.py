@@ -0,0 +1,86 @@
+import re
+import html
+import requests
+from geocubes_metrics import metrics
+from geocubes_throttle import governor
+
+# Quoted href of an <a> tag ending with "tif". Only the tag and attribute names are case insensitive.
+TIF_HREF = re.compile(r"""(?i:<a\s[^>]*?href)\s*=\s*(["'])([^"']*tif)\1""")
+# The same link with the rest of its line up to the next link, which has the date and size of the file in an Apache listing
+TIF_ROW = re.compile(r"""(?i:<a\s[^>]*?href)\s*=\s*(["'])([^"']*tif)\1[^\n]*?(?i:</a>)((?:(?!(?i:<a\s))[^\n])*)""")
+TAG = re.compile(r"<[^>]*>")
+
+def parse_tif_hrefs(text):
+
+    """
+        Extracts the .tif links of an HTML folder listing in a single pass, without parsing the whole document.
+        Returns the hrefs in the order of the listing
+    """
+
+    return [html.unescape(match.group(2)) for match in TIF_HREF.finditer(text)]
+
+def parse_tif_details(text):
+
+    """
+        Extracts the text following each .tif link on its line of an HTML folder listing, e.g. "2024-01-01 00:00 12K", without the tags and extra whitespace.
+        Returns a dictionary from href to the details, which are empty if the listing shows none
+    """
+
+    return {
+        html.unescape(match.group(2)): " ".join(html.unescape(TAG.sub(" ", match.group(3))).split())
+        for match in TIF_ROW.finditer(text)
+    }
+
+def fetch_listing(url, cache=None, session=None, details=False):
+
+    """
+        Fetches the .tif links of a GeoCubes year folder without storing them. With a cache, the listing is fetched with a conditional GET
+        and a 304 response returns the cached links.
+        Returns a tuple of the hrefs, the details of the files from parse_tif_details (None if not asked for or the listing was not downloaded),
+        the validators of the listing (ETag, Last-Modified) and whether the listing was downloaded
+
+        url - URL of the year folder
+        cache - Optional RasterCache where the listings are kept
+        session - Optional requests.Session
+        details - Parse the details of the files as well
+    """
+
+    session = session or requests
+    cached, validators = (None, None) if cache is None else cache.listing(url)
+
+    request_headers = {}
+    if cached is not None:
+        if validators[0]:
+            request_headers["If-None-Match"] = validators[0]
+        if validators[1]:
+            request_headers["If-Modified-Since"] = validators[1]
+
+    with metrics.timer("listing_fetch"):
+        r = governor.request(session, "GET", url, headers=request_headers)
+    if r.status_code == 304 and cached is not None:
+        metrics.count("listing_not_modified")
+        return cached, None, validators, False
+    r.raise_for_status()
+    metrics.add_bytes("listing", len(r.content))
+
+    with metrics.timer("listing_parse"):
+        hrefs = parse_tif_hrefs(r.text)
+        files = parse_tif_details(r.text) if details else None
+    return hrefs, files, (r.headers.get("ETag"), r.headers.get("Last-Modified")), True
+
+def list_tifs(url, cache=None, session=None):
+
+    """
+        Lists the .tif links of a GeoCubes year folder. With a cache, the listing is fetched with a conditional GET and a 304 response
+        means that the folder has not changed since the last run, so the cached links are used without downloading or parsing the page.
+        Returns a tuple of the hrefs and whether the folder changed (True if it was not cached)
+
+        url - URL of the year folder
+        cache - Optional RasterCache where the listings are kept
+        session - Optional requests.Session
+    """
+
+    hrefs, _, validators, downloaded = fetch_listing(url, cache, session)
+    if downloaded and cache is not None:
+        cache.store_listing(url, hrefs, validators)
+    return hrefs, downloaded
@@ -0,0 +1,326 @@
+import re
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+import contextlib
+from pathlib import Path
+from collections import Counter
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket is unbounded
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metrics:
+
+    """
+        Counters, byte counts, gauges and latency histograms of the phases of a run, e.g. the listing fetch, the raster open and the upload.
+        The phases are timed with timer(), the same phase can be timed from several threads at once.
+        The module has one shared instance, `metrics`, that the harvest and upload code record into.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        """
+            Removes the recorded values and restarts the run time, e.g. in a forked worker process that inherited the values of its parent
+        """
+
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counters = Counter()
+        self.bytes = Counter()
+        self.gauges = {}
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+
+        """
+            Times the block as one observation of the phase, also when it raises
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def timed(self, phase):
+
+        """
+            Returns a decorator that times every call of the function as one observation of the phase
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, phase, seconds):
+
+        """
+            Records one duration of the phase in seconds
+        """
+
+        bucket = next((n for n, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = {"count": 0, "seconds": 0.0, "max": 0.0, "buckets": [0] * (len(BUCKETS) + 1)}
+            observed = self.phases[phase]
+            observed["count"] += 1
+            observed["seconds"] += seconds
+            observed["max"] = max(observed["max"], seconds)
+            observed["buckets"][bucket] += 1
+
+    def count(self, name, n=1):
+
+        """
+            Adds n to the counter of an event, e.g. a cache hit
+        """
+
+        with self.lock:
+            self.counters[name] += n
+
+    def add_bytes(self, name, n):
+
+        """
+            Adds n to the number of bytes transferred, name tells what was transferred, e.g. "listing" or "upload"
+        """
+
+        with self.lock:
+            self.bytes[name] += n
+
+    def gauge(self, name, value, combine=None):
+
+        """
+            Sets the current value of a gauge, e.g. the limit of the requests in flight.
+            With combine the value is combined with the previous one, e.g. max keeps the highest value of the run.
+        """
+
+        with self.lock:
+            if combine is not None and name in self.gauges:
+                value = combine(self.gauges[name], value)
+            self.gauges[name] = value
+
+    def snapshot(self):
+
+        """
+            Returns the recorded values as a dictionary that can be sent between processes and added to another instance with merge()
+        """
+
+        with self.lock:
+            return {
+                "phases": {phase: dict(observed, buckets=list(observed["buckets"])) for phase, observed in self.phases.items()},
+                "counters": dict(self.counters),
+                "bytes": dict(self.bytes),
+                "gauges": dict(self.gauges)
+            }
+
+    def merge(self, snapshot):
+
+        """
+            Adds the values of a snapshot, e.g. from a worker process
+        """
+
+        with self.lock:
+            for phase, other in snapshot["phases"].items():
+                if phase not in self.phases:
+                    self.phases[phase] = {"count": 0, "seconds": 0.0, "max": 0.0, "buckets": [0] * (len(BUCKETS) + 1)}
+                observed = self.phases[phase]
+                observed["count"] += other["count"]
+                observed["seconds"] += other["seconds"]
+                observed["max"] = max(observed["max"], other["max"])
+                observed["buckets"] = [a + b for a, b in zip(observed["buckets"], other["buckets"])]
+            self.counters.update(snapshot["counters"])
+            self.bytes.update(snapshot["bytes"])
+            # Each worker process has its own gauges, the lowest value is kept of the gauges named *_min and the highest of the rest
+            for name, value in snapshot.get("gauges", {}).items():
+                combine = min if name.endswith("_min") else max
+                self.gauges[name] = combine(self.gauges.get(name, value), value)
+
+    def report(self):
+
+        """
+            Returns the JSON report: the run time, and for each phase the number of observations, the total, mean and maximum seconds,
+            the estimated median and 95th percentile and the histogram, followed by the counters, byte counts and gauges
+        """
+
+        snapshot = self.snapshot()
+        phases = {}
+        for phase, observed in sorted(snapshot["phases"].items()):
+            phases[phase] = {
+                "count": observed["count"],
+                "seconds": round(observed["seconds"], 6),
+                "mean": round(observed["seconds"] / observed["count"], 6),
+                "max": round(observed["max"], 6),
+                "p50": _quantile(observed, 0.5),
+                "p95": _quantile(observed, 0.95),
+                "histogram": {str(bound): n for bound, n in zip((*BUCKETS, "+Inf"), observed["buckets"])}
+            }
+        return {
+            "elapsed": round(time.perf_counter() - self.start, 3),
+            "phases": phases,
+            "counters": dict(sorted(snapshot["counters"].items())),
+            "bytes": dict(sorted(snapshot["bytes"].items())),
+            "gauges": dict(sorted(snapshot["gauges"].items()))
+        }
+
+    def prometheus(self, prefix="geocubes"):
+
+        """
+            Returns the metrics in the Prometheus text exposition format, e.g. for the node exporter textfile collector
+        """
+
+        snapshot = self.snapshot()
+        lines = [f"# HELP {prefix}_phase_seconds Duration of the phases of the run", f"# TYPE {prefix}_phase_seconds histogram"]
+        for phase, observed in sorted(snapshot["phases"].items()):
+            cumulative = 0
+            for bound, n in zip((*BUCKETS, "+Inf"), observed["buckets"]):
+                cumulative += n
+                lines.append(f'{prefix}_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_phase_seconds_sum{{phase="{phase}"}} {observed["seconds"]}')
+            lines.append(f'{prefix}_phase_seconds_count{{phase="{phase}"}} {observed["count"]}')
+        lines += [f"# HELP {prefix}_events_total Number of events of the run", f"# TYPE {prefix}_events_total counter"]
+        lines += [f'{prefix}_events_total{{event="{name}"}} {n}' for name, n in sorted(snapshot["counters"].items())]
+        lines += [f"# HELP {prefix}_bytes_total Bytes transferred in the run", f"# TYPE {prefix}_bytes_total counter"]
+        lines += [f'{prefix}_bytes_total{{transfer="{name}"}} {n}' for name, n in sorted(snapshot["bytes"].items())]
+        lines += [f"# HELP {prefix}_gauge Values of the gauges at the end of the run", f"# TYPE {prefix}_gauge gauge"]
+        lines += [f'{prefix}_gauge{{name="{name}"}} {value}' for name, value in sorted(snapshot["gauges"].items())]
+        lines += [f"# HELP {prefix}_elapsed_seconds Run time", f"# TYPE {prefix}_elapsed_seconds gauge"]
+        lines.append(f"{prefix}_elapsed_seconds {time.perf_counter() - self.start}")
+        return "\n".join(lines) + "\n"
+
+def _quantile(observed, q):
+
+    """
+        Estimates a quantile from the histogram buckets by linear interpolation within the bucket, capped by the maximum
+    """
+
+    target = q * observed["count"]
+    cumulative = 0
+    lower = 0.0
+    for bound, n in zip((*BUCKETS, observed["max"]), observed["buckets"]):
+        if n and cumulative + n >= target:
+            upper = min(bound, observed["max"])
+            return round(lower + (upper - lower) * (target - cumulative) / n, 6)
+        cumulative += n
+        lower = bound
+    return round(observed["max"], 6)
+
+metrics = Metrics()
+
+class Profiler:
+
+    """
+        Sampling profiler of all the threads of the process. The stacks are sampled at a fixed interval from a background thread,
+        so the thread pools of the harvest and the upload are profiled as well. The samples are written as collapsed stacks,
+        one "thread;outer;...;inner count" line per stack, which flamegraph.pl and speedscope can show.
+
+        interval - Seconds between the samples
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            # The threads of a pool are counted together, e.g. ThreadPoolExecutor-0_3 as ThreadPoolExecutor-0
+            names = {thread.ident: re.sub(r"_\d+$", "", thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join([names.get(ident, "thread"), *reversed(stack)])] += 1
+            self.samples += 1
+
+    def write(self, path):
+
+        """
+            Writes the collapsed stacks into a file
+        """
+
+        with open(path, "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
+
+    def top(self, n=15):
+
+        """
+            Returns the functions with the most samples at the top of the stack, as tuples of the function and the share of the samples.
+            Threads waiting for the network or a lock are counted too, so the list shows where the time goes rather than the CPU use.
+        """
+
+        functions = Counter()
+        for stack, count in self.stacks.items():
+            functions[stack.rsplit(";", 1)[-1]] += count
+        total = sum(functions.values())
+        return [(function, count / total) for function, count in functions.most_common(n)]
+
+def add_metrics_arguments(parser):
+
+    """
+        Adds the metrics and profiling options to the argument parser of a script
+    """
+
+    parser.add_argument("--metrics", type=str, help="Write the per-phase timings, counters and byte counts of the run as JSON to this file")
+    parser.add_argument("--prometheus", type=str, help="Write the metrics in the Prometheus text format to this file")
+    parser.add_argument("--profile", type=str, help="Sample the stacks of all threads during the run and write them as collapsed stacks to this file")
+
+def start_metrics(args):
+
+    """
+        Starts the profiler if --profile was given. The report files selected by add_metrics_arguments are written when the script exits,
+        also when it stops early with sys.exit or an error.
+    """
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        profiler.start()
+    if args.metrics or args.prometheus or profiler is not None:
+        atexit.register(write_metrics, args, profiler)
+
+def write_metrics(args, profiler=None):
+
+    """
+        Writes the JSON report, the Prometheus text and the profile selected by the options.
+        The messages go to stderr, so they do not mix with output written to stdout, e.g. update_geocubes.py --plan -
+    """
+
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            json.dump(metrics.report(), f, indent=2)
+        print(f"Metrics written to {args.metrics}", file=sys.stderr)
+    if args.prometheus:
+        with open(args.prometheus, "w") as f:
+            f.write(metrics.prometheus())
+        print(f"Prometheus metrics written to {args.prometheus}", file=sys.stderr)
+    if profiler is not None:
+        profiler.stop()
+        profiler.write(args.profile)
+        print(f"Profile of {profiler.samples} samples written to {args.profile}, the most sampled functions:", file=sys.stderr)
+        for function, share in profiler.top():
+            print(f" {share:6.1%} {function}", file=sys.stderr)
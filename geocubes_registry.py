@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import argparse
+import requests
+from dataclasses import dataclass
+from geocubes_metrics import metrics
+from geocubes_throttle import governor
+
+DEFAULT_BASE_URL = "https://vm0160.kaj.pouta.csc.fi"
+DEFAULT_REGISTRY = "geocubes_datasets.json"
+DEFAULT_TTL = 24 * 60 * 60 # Seconds, an older registry file is fetched again
+FIELDS = ["name", "layername", "years", "folder", "file_prefix", "max_resolution", "bit_depth", "producer", "metadata_URL"]
+
+@dataclass(slots=True, frozen=True)
+class Dataset:
+
+    """
+        One GeoCubes dataset from the getDatasets API, with the URLs of its year folders
+    """
+
+    name: str
+    layername: str
+    years: tuple
+    folder: str
+    file_prefix: str
+    max_resolution: str
+    bit_depth: str
+    producer: str
+    metadata_URL: str
+    paths: tuple
+
+class DatasetRegistry:
+
+    """
+        The GeoCubes datasets indexed by dataset name and by layer name. Iterating and indexing the registry work like a dictionary keyed by dataset name.
+    """
+
+    def __init__(self, datasets, base_url=DEFAULT_BASE_URL, fetched_at=None):
+        self.base_url = base_url
+        self.fetched_at = fetched_at
+        self.by_name = {dataset.name: dataset for dataset in datasets}
+        self.by_layername = {dataset.layername: dataset for dataset in datasets}
+
+    @classmethod
+    def parse(cls, text, base_url=DEFAULT_BASE_URL, fetched_at=None):
+
+        """
+            Parses the response of the getDatasets API, records separated by semicolons and fields by commas.
+            Returns the registry
+        """
+
+        datasets = []
+        for raw in text.split(";"):
+            split = raw.split(",")
+            if len(split) < len(FIELDS):
+                continue
+            fields = dict(zip(FIELDS, split))
+            fields["years"] = tuple(fields["years"].split("."))
+            fields["paths"] = tuple(f"{base_url}{fields['folder']}{year}/" for year in fields["years"])
+            datasets.append(Dataset(**fields))
+        return cls(datasets, base_url, fetched_at)
+
+    def layer(self, layername):
+        return self.by_layername[layername]
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        return iter(self.by_name)
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def keys(self):
+        return self.by_name.keys()
+
+    def values(self):
+        return self.by_name.values()
+
+    def items(self):
+        return self.by_name.items()
+
+def fetch_registry_text(base_url=DEFAULT_BASE_URL):
+
+    """
+        Returns the raw response of the getDatasets API
+    """
+
+    with metrics.timer("dataset_fetch"):
+        r = governor.request(requests, "GET", f"{base_url}/geocubes/info/getDatasets")
+    r.raise_for_status()
+    metrics.add_bytes("dataset_list", len(r.content))
+    return r.text
+
+def save_registry(path, text, base_url=DEFAULT_BASE_URL):
+
+    """
+        Writes the raw getDatasets response with the base URL and the fetch time, the file can be used as an offline snapshot
+    """
+
+    with open(path, "w") as f:
+        json.dump({"base_url": base_url, "fetched_at": time.time(), "text": text}, f)
+
+def get_datasets(base_url=DEFAULT_BASE_URL, path=DEFAULT_REGISTRY, ttl=DEFAULT_TTL, offline=False):
+
+    """
+        Datasets can be obtained from an API endpoint. The response is kept in a registry file, and the API is called again
+        only when the file is older than ttl or was fetched from another base URL. If the API cannot be reached, an older file is used.
+        Returns the datasets as DatasetRegistry
+
+        base_url - Address of the GeoCubes server
+        path - Registry file, None to always call the API
+        ttl - Maximum age of the registry file in seconds
+        offline - Only read the registry file (e.g. a saved snapshot), whatever its age
+    """
+
+    saved = None
+    if path and os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+
+    if offline:
+        if saved is None:
+            raise FileNotFoundError(f"No dataset registry file {path} for the offline mode")
+        return DatasetRegistry.parse(saved["text"], saved["base_url"], saved["fetched_at"])
+
+    if saved is not None and saved["base_url"] == base_url and time.time() - saved["fetched_at"] < ttl:
+        return DatasetRegistry.parse(saved["text"], base_url, saved["fetched_at"])
+
+    try:
+        text = fetch_registry_text(base_url)
+    except requests.RequestException as e:
+        if saved is None or saved["base_url"] != base_url:
+            raise
+        print(f"Could not fetch the GeoCubes datasets ({e}), using the registry file from {time.strftime('%Y-%m-%d %H:%M', time.localtime(saved['fetched_at']))}")
+        return DatasetRegistry.parse(saved["text"], base_url, saved["fetched_at"])
+
+    if path:
+        save_registry(path, text, base_url)
+    return DatasetRegistry.parse(text, base_url, time.time())
+
+def add_registry_arguments(parser):
+
+    """
+        Adds the dataset registry options to the argument parser of a script
+    """
+
+    parser.add_argument("--geocubes-url", type=str, default=DEFAULT_BASE_URL, help=f"Address of the GeoCubes server (default {DEFAULT_BASE_URL})")
+    parser.add_argument("--datasets", type=str, default=DEFAULT_REGISTRY, help=f"File where the GeoCubes dataset list is kept between runs (default {DEFAULT_REGISTRY})")
+    parser.add_argument("--datasets-ttl", type=float, default=DEFAULT_TTL / 3600, help="Hours before the dataset list is fetched again (default 24, 0 always fetches)")
+    parser.add_argument("--offline", action="store_true", help="Read the dataset list only from the --datasets file, e.g. a snapshot saved with geocubes_registry.py")
+
+def datasets_from_args(args):
+
+    """
+        Returns the DatasetRegistry selected by the options of add_registry_arguments
+    """
+
+    return get_datasets(args.geocubes_url, args.datasets, args.datasets_ttl * 3600, args.offline)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Show the GeoCubes datasets or save them as a snapshot for the offline mode")
+    parser.add_argument("command", choices=["show", "save"], help="show lists the datasets, save fetches them from the API into the --datasets file")
+    add_registry_arguments(parser)
+    args = parser.parse_args()
+
+    if args.command == "save":
+        save_registry(args.datasets, fetch_registry_text(args.geocubes_url), args.geocubes_url)
+        print(f"Saved the dataset list to {args.datasets}")
+    registry = datasets_from_args(args)
+    for name, dataset in registry.items():
+        print(f"{name} ({dataset.layername}): {', '.join(dataset.years)}")
@@ -1,12 +1,25 @@
 import pystac
-import rasterio
-import requests
 import datetime
 import pandas
+import os
 import re
-from bs4 import BeautifulSoup
-from rio_stac.stac import create_stac_item
-from shapely.geometry import GeometryCollection, shape
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from geocubes_harvest import harvest_headers, create_record
+from geocubes_cache import RasterCache, DEFAULT_CACHE
+from geocubes_listing import list_tifs
+from geocubes_filenames import index_listing, group_items, collection_id
+from geocubes_extent import ExtentAccumulator
+from geocubes_writer import StreamingCatalogWriter
+from geocubes_journal import Journal
+from geocubes_registry import add_registry_arguments, datasets_from_args
+from geocubes_metrics import metrics, add_metrics_arguments, start_metrics
+from geocubes_throttle import add_throttle_arguments, configure_throttle
+from geocubes_export import export_collection, add_export_arguments, export_formats
+from geocubes_index import ItemIndex, item_row, DEFAULT_INDEX
+
+DEFAULT_JOURNAL = "geocubes_stac.journal"
 
 def create_collection(collection_info, dataset_info):
 
@@ -15,17 +28,7 @@ def create_collection(collection_info, dataset_info):
         Returns the collection as pystac.Collection
     """
 
-    # The regural expression sub is changing the spaces into underscores
-    # For sentinel and NDVI collections, the name is specified a bit different as the names contain the years/months of the data
-    col_name = re.sub(r'\W+','_', collection_info['Name'].lower())
-    if "sentinel" in col_name:
-        split = col_name.split("_")[:-2]
-        col_name = "_".join(split)
-    elif "ndvi" in col_name:
-        split = col_name.split("_")[:-1]
-        col_name = "_".join(split)
-
-    col_id = f"{col_name}_at_geocubes"
+    col_id = collection_id(collection_info['Name'])
 
     collection = pystac.Collection(
         id = col_id,
@@ -49,7 +52,7 @@ def create_collection(collection_info, dataset_info):
         ],
         assets = {
             "meta": pystac.Asset(
-                dataset_info["metadata_URL"],
+                dataset_info.metadata_URL,
                 title = "Metadata",
                 roles = ["metadata"]
             )
@@ -61,7 +64,7 @@ def create_collection(collection_info, dataset_info):
         )
     )
 
-    if "sentinel" in col_name:
+    if "sentinel" in col_id:
         collection.providers.append(
             pystac.Provider(
                 name = "ESA",
@@ -69,7 +72,7 @@ def create_collection(collection_info, dataset_info):
             )
         )
 
-    if dataset_info["producer"] == "MML":
+    if dataset_info.producer == "MML":
         collection.description = re.sub("YYYY", "NLS", collection.description)
         collection.providers.append(
             pystac.Provider(
@@ -77,7 +80,7 @@ def create_collection(collection_info, dataset_info):
                 roles = ["producer", "processor"]
             )
         )
-    elif dataset_info["producer"] == "IL":
+    elif dataset_info.producer == "IL":
         collection.description = re.sub("YYYY", "FMI", collection.description)
         collection.providers.append(
             pystac.Provider(
@@ -92,10 +95,10 @@ def create_collection(collection_info, dataset_info):
             )
         )
     else:
-        collection.description = re.sub("YYYY", dataset_info["producer"], collection.description)
+        collection.description = re.sub("YYYY", dataset_info.producer, collection.description)
         collection.providers.append(
             pystac.Provider(
-                name = dataset_info["producer"],
+                name = dataset_info.producer,
                 roles = ["producer"]
             )
         )
@@ -110,173 +113,246 @@ def create_collection(collection_info, dataset_info):
     
     return collection
 
-def get_datasets():
+def build_collection(collection_info, dataset_info, catalog, writer=None, workers=1, cache=None, range_reader=True, journal=None, index=None):
 
     """
-        Datasets can be obtained from an API endpoint.
-        Returns a dictionary containing the GeoCubes datasets and their relevant information.
+        Makes the collection and its items from the year folders of the dataset and adds it to the catalog.
+        Returns the collection as pystac.Collection
+
+        collection_info - Collection information and translations from the CSV
+        dataset_info - Dataset information from the GeoCubes API
+        catalog - The root pystac.Catalog
+        writer - Optional StreamingCatalogWriter, the items and the collection are written as they are finished
+        workers - Number of raster headers fetched concurrently
+        cache - Optional RasterCache for the raster headers
+        range_reader - Parse the raster headers from range requests instead of opening them with GDAL
+        journal - Optional Journal used with the writer. The written items and year folders are recorded into it,
+                  and the items it already has are read from their written files instead of being made again.
+        index - Optional ItemIndex, the items are indexed after each year folder and the items no longer in GeoCubes are removed from it at the end
     """
 
-    data = requests.get("https://vm0160.kaj.pouta.csc.fi/geocubes/info/getDatasets")
-    const_url = "https://vm0160.kaj.pouta.csc.fi"
-    raw_datasets = data.text.split(";")
-    split_datasets = [x.split(",") for x in raw_datasets]
-
-    dataset_dict = {}
-    for split in split_datasets:
-        dataset_dict[split[0]] = dict(zip(["name", "layername", "years", "folder", "file_prefix", "max_resolution", "bit_depth", "producer", "metadata_URL"], split))
-
-    for d in dataset_dict:
-        year_split = dataset_dict[d]['years'].split(".")
-        dataset_dict[d]['paths'] = []
-        if len(year_split) == 1:
-            dataset_dict[d]['paths'].append(f"{const_url}{dataset_dict[d]['folder']}{year_split[0]}/")
-        else:
-            for year in year_split:
-                dataset_dict[d]['paths'].append(f"{const_url}{dataset_dict[d]['folder']}{year}/")
-    
-    return dataset_dict
+    collection = create_collection(collection_info, dataset_info)
+    if writer is not None:
+        writer.add_collection(collection)
+    else:
+        catalog.add_child(collection)
+    extent = ExtentAccumulator()
+    indexed_ids = []
 
-if __name__ == "__main__":
+    # The items of the collection in the journal grouped by year folder, in the order they were written
+    journal_items = {}
+    if journal is not None:
+        for record in journal.records("item"):
+            if record["key"][0] == collection.id:
+                journal_items.setdefault(record["year_path"], []).append(record)
+
+    for year_path in dataset_info.paths:
+        index_rows = []
+
+        if journal is not None and journal.done("year", collection.id, year_path):
+            # The whole year folder was written before, its items are taken from the journal in the original order
+            for record in journal_items.get(year_path, []):
+                item = resume_item(collection, record["path"], writer, extent)
+                index_rows.append(item_row(collection.id, item))
+            if index is not None:
+                index.add_items(index_rows)
+                indexed_ids += [row[1] for row in index_rows]
+            continue
+
+        # The .tif links of the folder, a cached listing is revalidated with a conditional GET
+        item_links, _ = list_tifs(year_path, cache)
+        # The files grouped into items with their item IDs, in listing order
+        grouped_items = group_items(index_listing(item_links, year_path, collection_info["Name"]))
+
+        # The items already written in an earlier run are not harvested again
+        resumed = {}
+        if journal is not None:
+            resumed = {key: journal.get("item", collection.id, item_id) for key, (item_id, files) in grouped_items.items() if journal.done("item", collection.id, item_id)}
+
+        # Fetch the raster headers of the whole year folder at once, the items are assembled below in listing order
+        # The item source is usually the first file of its group, so its header is read only once
+        hrefs = [year_path+item+".tif" for key, (item_id, files) in grouped_items.items() if key not in resumed for item in [key]+files]
+        headers = harvest_headers(hrefs, workers, cache, range_reader)
 
-    datasets = get_datasets()
+        for key, (item_id, files) in grouped_items.items():
+
+            if key in resumed:
+                item = resume_item(collection, resumed[key]["path"], writer, extent)
+                index_rows.append(item_row(collection.id, item))
+                continue
+
+            item = create_record(item_id, year_path, key, files, headers)
+            for asset in item.assets[1:]:
+                # Add the GSD into the Collection Summaries if not in it
+                extent.add_gsd(asset.gsd)
+            extent.add_item(item)
+            if writer is not None:
+                path = writer.write_item(collection, item)
+                if journal is not None:
+                    journal.record("item", collection.id, item_id, year_path=year_path, path=path)
+            else:
+                # normalize_and_save writes the whole catalog of pystac objects at the end
+                collection.add_item(item.to_item())
+            index_rows.append(item_row(collection.id, item))
+            metrics.count("items_made")
+            print(f"* Item made: {item.id}")
+
+        if index is not None:
+            index.add_items(index_rows)
+            indexed_ids += [row[1] for row in index_rows]
+        if journal is not None:
+            journal.record("year", collection.id, year_path)
+
+    # Updating the Spatial and Temporal Extents and the sorted GSD Summaries from the data
+    extent.apply(collection)
+
+    # Add the lowest and highest GSD to the description
+    sorted_gsd = collection.summaries.lists["gsd"]
+    collection.description = re.sub('XXXX', f"{sorted_gsd[0]}m-{sorted_gsd[-1]}m", collection.description)
+
+    if writer is not None:
+        writer.finish_collection(collection)
+    if index is not None:
+        index.retain(collection.id, indexed_ids)
+
+    return collection
+
+def resume_item(collection, path, writer, extent):
+
+    """
+        Adds an item written in an earlier run to the collection and the extents, the raster headers are not read again.
+        The written file already has the links of the collection, so only its link is added to the collection.
+        Returns the item as a STAC dictionary
+    """
+
+    with open(path) as f:
+        item = json.load(f)
+    for asset_id, asset in item["assets"].items():
+        if asset_id != "COG":
+            extent.add_gsd(asset["gsd"])
+    extent.add_bbox(item["bbox"])
+    extent.add_interval(pystac.utils.str_to_datetime(item["properties"]["start_datetime"]), pystac.utils.str_to_datetime(item["properties"]["end_datetime"]))
+    writer.add_item_link(collection, path)
+    metrics.count("items_resumed")
+    print(f"* Item resumed: {item['id']}")
+    return item
+
+def create_catalog():
+
+    """
+        Returns the root catalog
+    """
 
     try: # Takes the awailable catalog if it exists
         catalog = pystac.Catalog("GeoCubes", "Testing catalog", catalog_type=pystac.CatalogType.RELATIVE_PUBLISHED)
     except:
         catalog = pystac.Catalog.from_file("Geocubes/catalog.json")
+    return catalog
+
+def build_collection_process(collection_info, dataset_info, options, records):
+
+    """
+        Builds one collection in a worker process. The collection subtree is written to GeoCubes with its own copy of the root catalog,
+        the catalog.json is left to the parent process.
+        Returns the path of the written collection.json and the metrics of the collection
+
+        collection_info - Collection information and translations from the CSV
+        dataset_info - Dataset information from the GeoCubes API
+        options - Dictionary of the parsed command line arguments
+        records - Journal records of the collection, loaded by the parent process
+    """
+
+    metrics.reset()
+    # The GeoCubes request limits are shared between the worker processes
+    configure_throttle(argparse.Namespace(**options), options["jobs"])
+    cache = None if options["no_cache"] else RasterCache(options["cache"])
+    index = None if options["no_index"] else ItemIndex(options["index"])
+    # The parent process has already started or loaded the journal, the workers only append to it
+    journal = Journal(options["journal"], records=records)
+    writer = StreamingCatalogWriter(create_catalog(), "GeoCubes", write_catalog=False)
+    collection = build_collection(collection_info, dataset_info, writer.catalog, writer, options["workers"], cache, not options["gdal_headers"], journal, index)
+    journal.close()
+    if cache is not None:
+        cache.close()
+    if index is not None:
+        index.close()
+
+    return collection.get_self_href(), metrics.snapshot()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="Number of raster headers fetched concurrently (default 1, serial)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of collections built in parallel worker processes, implies --stream (default 1)")
+    parser.add_argument("--cache", type=str, default=DEFAULT_CACHE, help=f"Cache of the raster headers and folder listings, revalidated against the server on every run (default {DEFAULT_CACHE})")
+    parser.add_argument("--no-cache", action="store_true", help="Read every raster header with GDAL without the cache")
+    parser.add_argument("--index", type=str, default=DEFAULT_INDEX, help=f"Spatial and temporal index of the harvested items, see geocubes_index.py (default {DEFAULT_INDEX})")
+    parser.add_argument("--no-index", action="store_true", help="Do not update the item index")
+    parser.add_argument("--gdal-headers", action="store_true", help="Open the rasters with GDAL instead of parsing the header from a single range request")
+    parser.add_argument("--stream", action="store_true", help="Write each item as soon as it is made and each collection when it is finished, instead of saving the whole catalog at the end")
+    parser.add_argument("--journal", type=str, default=DEFAULT_JOURNAL, help=f"Journal of the written items and collections, kept in the streaming mode (default {DEFAULT_JOURNAL})")
+    parser.add_argument("--resume", action="store_true", help="Continue a stopped run from the journal, the written items and collections are not made again. Implies --stream")
+    parser.add_argument("--export", type=str, help="Also write the items of each collection into a single NDJSON and stac-geoparquet file in this folder")
+    add_export_arguments(parser)
+    add_registry_arguments(parser)
+    add_throttle_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    start_metrics(args)
+    configure_throttle(args)
+    formats = export_formats(args, parser) if args.export else None
+
+    datasets = datasets_from_args(args)
+    catalog = create_catalog()
 
     # Information and translations of the GeoCubes
     collection_csv = pandas.read_csv('karttatasot.csv', index_col='Nimi').to_dict('index')
 
-    for col in collection_csv:
-
-        collection_info = collection_csv[col]
-        dataset_info = datasets[col]
+    # The journal is kept only in the streaming mode, as otherwise nothing is written before the end
+    journal = Journal(args.journal, resume=args.resume) if args.stream or args.jobs > 1 or args.resume else None
 
-        collection = create_collection(collection_info, dataset_info)
-        catalog.add_child(collection)
-        
-        for year_path in dataset_info['paths']:
-
-            #TIFs through BeautifulSoup
-            page = requests.get(year_path)
-            data = page.text
-            soup = BeautifulSoup(data, features="html.parser")
-
-            links = [link for link in soup.find_all("a")]
-
-            assets = {}
-            item_links = [link.get("href") for link in links if link.get("href").endswith("tif")]
-            item_sets = [item.split(".")[0] for item in item_links]
-            
-            grouped_dict = {}
-            for item in item_sets:
-                prefix = "_".join(item.split("_")[:4])
-                if prefix not in grouped_dict:
-                    grouped_dict[prefix] = []
-                grouped_dict[prefix].append(item)
-
-            for key in grouped_dict.keys():
-                
-                # Takes the year from the path
-                item_starttime = datetime.datetime.strptime(f"{year_path.split('/')[-2]}-01-01", "%Y-%m-%d")
-                item_endtime = datetime.datetime.strptime(f"{year_path.split('/')[-2]}-12-31", "%Y-%m-%d")
-
-                with rasterio.open(year_path+grouped_dict[key][0]+".tif") as src:
-                    assets = {
-                        "COG": pystac.Asset(
-                            href=year_path+grouped_dict[key][0]+".tif", 
-                            media_type="image/tiff; application=geotiff; profile=cloud-optimized", 
-                            title="COG",
-                            roles=["data"],
-                            extra_fields={
-                                "gsd": int(src.res[0]),
-                                "proj:shape": src.shape,
-                                "proj:transform": [
-                                    src.transform.a,
-                                    src.transform.b,
-                                    src.transform.c,
-                                    src.transform.d,
-                                    src.transform.e,
-                                    src.transform.f,
-                                    src.transform.g,
-                                    src.transform.h,
-                                    src.transform.i
-                                ]
-                            }
-                        )
-                    }
-                min_gsd = assets["COG"].extra_fields["gsd"]
-                for asset in grouped_dict[key][1:]:
-                    with rasterio.open(year_path+asset+".tif") as src:
-                        asset_id = asset.split("_")[-1]
-                        assets[asset_id] = pystac.Asset(
-                            href=year_path+asset+".tif",
-                            media_type="image/tiff; application=geotiff", 
-                            title=asset.split('_')[-1],
-                            roles=["data"],
-                            extra_fields={
-                                "gsd": int(src.res[0]),
-                                "proj:shape": src.shape,
-                                "proj:transform": [
-                                    src.transform.a,
-                                    src.transform.b,
-                                    src.transform.c,
-                                    src.transform.d,
-                                    src.transform.e,
-                                    src.transform.f,
-                                    src.transform.g,
-                                    src.transform.h,
-                                    src.transform.i
-                                ]
-                            }
-                        )
-                    
-                    # Add the GSD into the Collection Summaries if not in it
-                    if assets[asset_id].extra_fields["gsd"] not in collection.summaries.lists["gsd"]:
-                        collection.summaries.lists["gsd"].append(assets[asset_id].extra_fields["gsd"])
-                    min_gsd = min(min_gsd, assets[asset_id].extra_fields["gsd"])
-
-                # The sentinel and NDVI items are named a bit differently from the rest
-                item_year = year_path.split("/")[-1]
-                if "sentinel" in key:
-                    name = key.split("_")[0].replace('-', '_')
-                    item_info = "_".join(key.split(".")[0].split("_")[1:])
-                    item_id = f"{name.lower().replace(' ', '_').replace(',', '')}_{item_info}"
-                elif "ndvi" in key:
-                    name = key.split("_")[0]
-                    item_info = "_".join(key.split(".")[0].split("_")[1:])
-                    item_id = f"{name.lower()}_{item_info}"
+    if args.jobs > 1:
+        # The collections are independent, each worker writes its own collection subtree and the results are attached in CSV order
+        writer = StreamingCatalogWriter(catalog, "GeoCubes")
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {col: executor.submit(build_collection_process, collection_csv[col], datasets[col], vars(args), journal.records_with(collection_id(collection_csv[col]["Name"]))) for col in collection_csv if not journal.done("collection", col)}
+            for col in collection_csv:
+                if col in futures:
+                    path, snapshot = futures[col].result()
+                    metrics.merge(snapshot)
+                    journal.record("collection", col, path=path)
                 else:
-                    item_info = "_".join(key.split(".")[0].split("_")[1:])
-                    item_id = f"{collection_info['Name'].lower().replace(' ', '_').replace(',', '')}_{item_info}"
-
-                item = create_stac_item(
-                    source=year_path+key+".tif",
-                    id=item_id,
-                    assets=assets, 
-                    asset_media_type=pystac.MediaType.TIFF, 
-                    with_proj=True,
-                )
-                item.common_metadata.start_datetime = item_starttime
-                item.common_metadata.end_datetime = item_endtime
-                item.extra_fields["gsd"] = min_gsd
-                item.properties["proj:epsg"] = 3067
-                collection.add_item(item)
-                print(f"* Item made: {item.id}")
-
-        # Updating the Spatial and Temporal Extents from the data
-        bounds = [GeometryCollection([shape(s.geometry) for s in collection.get_all_items()]).bounds]
-        start_times = [st.common_metadata.start_datetime for st in collection.get_all_items()]
-        end_times = [et.common_metadata.end_datetime for et in collection.get_all_items()]
-        temporal = [[min(start_times), max(end_times)]]
-        collection.extent.spatial = pystac.SpatialExtent(bounds)
-        collection.extent.temporal = pystac.TemporalExtent(temporal)
-
-        # Sort the GSD Summaries and add the lowest and highest to the description
-        sorted_gsd = sorted(collection.summaries.lists["gsd"])
-        collection.summaries.lists["gsd"] = sorted_gsd
-        collection.description = re.sub('XXXX', f"{sorted_gsd[0]}m-{sorted_gsd[-1]}m", collection.description)
-
-    catalog.normalize_and_save("GeoCubes")
\ No newline at end of file
+                    path = journal.get("collection", col)["path"]
+                writer.attach_collection(path)
+    else:
+        cache = None if args.no_cache else RasterCache(args.cache)
+        index = None if args.no_index else ItemIndex(args.index)
+        writer = StreamingCatalogWriter(catalog, "GeoCubes") if journal is not None else None
+
+        for col in collection_csv:
+            if journal is not None and journal.done("collection", col):
+                writer.attach_collection(journal.get("collection", col)["path"])
+                continue
+            collection = build_collection(collection_csv[col], datasets[col], catalog, writer, args.workers, cache, not args.gdal_headers, journal, index)
+            if journal is not None:
+                journal.record("collection", col, path=collection.get_self_href())
+
+        if writer is None:
+            with metrics.timer("save"):
+                catalog.normalize_and_save("GeoCubes")
+
+        if cache is not None:
+            cache.close()
+        if index is not None:
+            index.close()
+
+    if journal is not None:
+        journal.close()
+
+    if args.export:
+        os.makedirs(args.export, exist_ok=True)
+        # The collections are read from their written files, the catalog keeps only their links
+        for link in catalog.get_child_links():
+            collection_folder = os.path.dirname(link.get_absolute_href())
+            count = export_collection(collection_folder, args.export, formats)
+            print(f"Exported {count} items of {os.path.basename(collection_folder)} to {args.export}")
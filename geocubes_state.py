@@ -0,0 +1,272 @@
+import time
+import sqlite3
+import argparse
+import requests
+import threading
+from urllib.parse import urljoin
+from geoserver_catalog import fetch_item_ids, count_items
+
+DEFAULT_STATE = "geocubes_state.sqlite"
+DEFAULT_MAX_AGE = 24 * 60 * 60 # Seconds, the item IDs of a collection listed earlier than this are listed again
+
+class CatalogState:
+
+    """
+        Local snapshot of the collections and item IDs in the remote STAC API. Each collection is refreshed incrementally:
+        the item count of the API is compared to the snapshot and the item IDs are listed again only if the counts differ.
+        A removed item and an added one keep the count the same, so the item IDs are also listed again once the listing is older than max_age.
+        The items sent by the update scripts are recorded, so the snapshot stays current without a new crawl.
+        The fingerprints (size, Last-Modified and ETag) and the listing details of the files of each item are kept as well, to find the items whose files have changed,
+        with the validators of the folder listings whose items have all been sent.
+
+        path - Path of the SQLite database
+        max_age - Seconds after which the item IDs of a collection are listed again even if the counts agree
+    """
+
+    def __init__(self, path=DEFAULT_STATE, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS collections (
+                id TEXT PRIMARY KEY,
+                synced_at REAL NOT NULL,
+                listed_at REAL
+            )
+        """)
+        # A snapshot made before the listing time was kept is listed again on its next refresh
+        if "listed_at" not in [row[1] for row in self.connection.execute("PRAGMA table_info(collections)")]:
+            self.connection.execute("ALTER TABLE collections ADD COLUMN listed_at REAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                collection TEXT NOT NULL,
+                id TEXT NOT NULL,
+                synced_at REAL NOT NULL,
+                PRIMARY KEY (collection, id)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS assets (
+                collection TEXT NOT NULL,
+                item TEXT NOT NULL,
+                href TEXT NOT NULL,
+                size INTEGER,
+                last_modified TEXT,
+                etag TEXT,
+                listed TEXT,
+                PRIMARY KEY (collection, item, href)
+            )
+        """)
+        if "listed" not in [row[1] for row in self.connection.execute("PRAGMA table_info(assets)")]:
+            self.connection.execute("ALTER TABLE assets ADD COLUMN listed TEXT")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS folders (
+                collection TEXT NOT NULL,
+                url TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                PRIMARY KEY (collection, url)
+            )
+        """)
+        self.connection.commit()
+
+    def refresh(self, stac_url, collection_id, session=None):
+
+        """
+            Brings the snapshot of the collection up to date with the STAC API. If the API reports the same number of items as the snapshot
+            and the item IDs were listed less than max_age ago, only one request is made. Otherwise the item IDs are listed and the snapshot is replaced.
+            Returns True if the item IDs were listed again
+
+            stac_url - Root of the STAC API, e.g. <host>/geoserver/ogc/stac/v1/
+        """
+
+        remote_count = count_items(stac_url, collection_id, session)
+        with self.lock:
+            synced = self.connection.execute("SELECT listed_at FROM collections WHERE id = ?", (collection_id,)).fetchone()
+            local_count = self.connection.execute("SELECT COUNT(*) FROM items WHERE collection = ?", (collection_id,)).fetchone()[0]
+
+        now = time.time()
+        fresh = synced is not None and synced[0] is not None and now - synced[0] < self.max_age
+        if fresh and remote_count is not None and remote_count == local_count:
+            with self.lock:
+                self.connection.execute("UPDATE collections SET synced_at = ? WHERE id = ?", (now, collection_id))
+                self.connection.commit()
+            return False
+
+        remote_ids = fetch_item_ids(stac_url, collection_id, session)
+        with self.lock:
+            local_ids = {row[0] for row in self.connection.execute("SELECT id FROM items WHERE collection = ?", (collection_id,))}
+            self.connection.executemany(
+                "DELETE FROM items WHERE collection = ? AND id = ?",
+                ((collection_id, item_id) for item_id in local_ids - remote_ids)
+            )
+            self.connection.executemany(
+                "DELETE FROM assets WHERE collection = ? AND item = ?",
+                ((collection_id, item_id) for item_id in local_ids - remote_ids)
+            )
+            self.connection.executemany(
+                "INSERT INTO items (collection, id, synced_at) VALUES (?, ?, ?)",
+                ((collection_id, item_id, now) for item_id in remote_ids - local_ids)
+            )
+            self.connection.execute("INSERT OR REPLACE INTO collections (id, synced_at, listed_at) VALUES (?, ?, ?)", (collection_id, now, now))
+            self.connection.commit()
+        return True
+
+    def item_ids(self, collection_id):
+
+        """
+            Returns the item IDs of the collection in the snapshot as a set
+        """
+
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT id FROM items WHERE collection = ?", (collection_id,))}
+
+    def record_item(self, collection_id, item_id):
+
+        """
+            Records an item that was sent to the API
+        """
+
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO items (collection, id, synced_at) VALUES (?, ?, ?)", (collection_id, item_id, time.time()))
+            self.connection.commit()
+
+    def item_fingerprints(self, collection_id):
+
+        """
+            Returns a dictionary from item ID to the fingerprints of its files, {href: (size, last_modified, etag)}
+        """
+
+        fingerprints = {}
+        with self.lock:
+            rows = self.connection.execute("SELECT item, href, size, last_modified, etag FROM assets WHERE collection = ?", (collection_id,)).fetchall()
+        for item_id, href, size, last_modified, etag in rows:
+            fingerprints.setdefault(item_id, {})[href] = (size, last_modified, etag)
+        return fingerprints
+
+    def item_listings(self, collection_id):
+
+        """
+            Returns a dictionary from item ID to the folder listing details of its files when they were last recorded, {href: details}
+        """
+
+        listings = {}
+        with self.lock:
+            rows = self.connection.execute("SELECT item, href, listed FROM assets WHERE collection = ?", (collection_id,)).fetchall()
+        for item_id, href, listed in rows:
+            listings.setdefault(item_id, {})[href] = listed
+        return listings
+
+    def record_fingerprints(self, collection_id, item_id, fingerprints, listed=None):
+
+        """
+            Replaces the file fingerprints of an item
+
+            fingerprints - Dictionary from href to (size, last_modified, etag)
+            listed - Optional dictionary from href to the details of the file in the folder listing, e.g. its date and size
+        """
+
+        listed = listed or {}
+        with self.lock:
+            self.connection.execute("DELETE FROM assets WHERE collection = ? AND item = ?", (collection_id, item_id))
+            self.connection.executemany(
+                "INSERT INTO assets (collection, item, href, size, last_modified, etag, listed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((collection_id, item_id, href, *fingerprint, listed.get(href)) for href, fingerprint in fingerprints.items())
+            )
+            self.connection.commit()
+
+    def folder_validators(self, collection_id, url):
+
+        """
+            Returns the ETag and Last-Modified of the folder listing whose items were last all sent, or None if the folder has not been recorded
+        """
+
+        with self.lock:
+            row = self.connection.execute("SELECT etag, last_modified FROM folders WHERE collection = ? AND url = ?", (collection_id, url)).fetchone()
+        return None if row is None else tuple(row)
+
+    def record_folder(self, collection_id, url, validators):
+
+        """
+            Records the validators of a folder listing once the items of the listing have been sent
+        """
+
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)", (collection_id, url, *validators))
+            self.connection.commit()
+
+    def purge(self):
+
+        """
+            Removes the whole snapshot, the next refresh lists every collection again. Returns the number of removed items
+        """
+
+        with self.lock:
+            removed = self.connection.execute("DELETE FROM items").rowcount
+            self.connection.execute("DELETE FROM collections")
+            self.connection.execute("DELETE FROM assets")
+            self.connection.execute("DELETE FROM folders")
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+        return removed
+
+    def info(self):
+
+        """
+            Returns a dictionary of the collections in the snapshot with their item counts and last sync times
+        """
+
+        with self.lock:
+            rows = self.connection.execute("""
+                SELECT c.id, c.synced_at, COUNT(i.id) FROM collections c
+                LEFT JOIN items i ON i.collection = c.id
+                GROUP BY c.id ORDER BY c.id
+            """).fetchall()
+        return {
+            collection_id: {"items": count, "synced_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(synced_at))}
+            for collection_id, synced_at, count in rows
+        }
+
+    def close(self):
+        self.connection.close()
+
+def add_state_arguments(parser):
+
+    """
+        Adds the option of how often the snapshot lists the item IDs again to the argument parser of a script
+    """
+
+    parser.add_argument("--state-max-age", type=float, default=DEFAULT_MAX_AGE / 3600,
+                        help=f"Hours after which the item IDs of a collection are listed again even if its item count has not changed (default {DEFAULT_MAX_AGE // 3600})")
+
+def state_max_age(args):
+    return args.state_max_age * 3600
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Inspect, refresh or purge the local snapshot of the remote catalog")
+    parser.add_argument("command", choices=["info", "refresh", "purge"], help="info shows the snapshot, refresh syncs it with the STAC API, purge empties it")
+    parser.add_argument("--state", type=str, default=DEFAULT_STATE, help=f"Path of the snapshot database (default {DEFAULT_STATE})")
+    parser.add_argument("--host", type=str, help="Hostname of the STAC API, required by refresh")
+    add_state_arguments(parser)
+    args = parser.parse_args()
+
+    state = CatalogState(args.state, state_max_age(args))
+    if args.command == "refresh":
+        if not args.host:
+            parser.error("refresh requires --host")
+        stac_url = f"{args.host}/geoserver/ogc/stac/v1/"
+        session = requests.Session()
+        session.headers.update({"User-Agent": "update-script"})
+        r = session.get(urljoin(stac_url, "collections"))
+        r.raise_for_status()
+        for collection in r.json()["collections"]:
+            if collection["id"].endswith("at_geocubes"):
+                listed = state.refresh(stac_url, collection["id"], session)
+                print(f"{collection['id']}: {'listed' if listed else 'unchanged'}")
+    elif args.command == "purge":
+        print(f"Removed {state.purge()} items")
+    for collection_id, info in state.info().items():
+        print(f"{collection_id}: {info['items']} items, synced {info['synced_at']}")
+    state.close()
@@ -0,0 +1,248 @@
+import time
+import threading
+import requests
+import email.utils
+from geocubes_metrics import metrics
+
+DEFAULT_MAX_CONCURRENCY = 32
+# Statuses that mean the server is overloaded, the request is retried after a pause
+THROTTLED = (429, 503)
+# The errors raised without a response that tell the server is overloaded or unreachable
+CONNECTION_ERRORS = (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)
+
+class Governor:
+
+    """
+        Shared limit of the requests in flight to the GeoCubes server. The limit adapts to the server with additive increase and
+        multiplicative decrease: each successful request raises it by 1 / limit, so about one more request per round trip,
+        or by 1 until the first decrease, so that the limit doubles each round trip at the start of the run, and it is halved when the server answers 429, 503 or another 5xx or the connection fails.
+        The limit where the server pushed back is remembered, and the limit stays below it for a while before it is probed again.
+        A smaller decrease is made when the smoothed latency grows well above the lowest latency seen, which means that the requests queue at the server.
+        A Retry-After of a response pauses all the new requests until it has passed.
+        The module has one shared instance, `governor`, that every request to GeoCubes goes through,
+        so the thread pools of the harvest can be larger than what the server takes.
+
+        limit - Initial number of requests in flight
+        min_limit - Lowest number of requests in flight
+        max_limit - Highest number of requests in flight
+        max_rate - Optional highest number of requests started per second
+        retries - Number of retries of a throttled request
+        backoff - Seconds paused after a throttled response without a Retry-After, doubled for each retry
+        tolerance - How many times the lowest latency the smoothed latency may grow before the limit is decreased
+        probe - Seconds the limit stays below the limit where the server last pushed back
+    """
+
+    def __init__(self, limit=4, min_limit=1, max_limit=DEFAULT_MAX_CONCURRENCY, max_rate=None, retries=3, backoff=1.0, tolerance=3.0, probe=30.0):
+        self.condition = threading.Condition()
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(limit, min_limit), max_limit))
+        self.max_rate = max_rate
+        self.retries = retries
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.probe = probe
+        self.ceiling = None
+        self.last_pushback = 0.0
+        self.slow_start = True
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.next_start = 0.0
+        self.last_decrease = 0.0
+        self.smoothed = None
+        self.baseline = None
+
+    def configure(self, max_limit=None, max_rate=None):
+
+        """
+            Changes the highest number of requests in flight and the highest request rate, e.g. from the command line options
+        """
+
+        with self.condition:
+            if max_limit is not None:
+                self.max_limit = max(max_limit, self.min_limit)
+                self.limit = min(self.limit, self.max_limit)
+            self.max_rate = max_rate
+            self._record()
+            self.condition.notify_all()
+
+    def acquire(self):
+
+        """
+            Waits until a request may be started and reserves its place
+        """
+
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                elif self.max_rate and now < self.next_start:
+                    self.condition.wait(self.next_start - now)
+                else:
+                    break
+            if self.max_rate:
+                self.next_start = max(self.next_start, now) + 1 / self.max_rate
+            self.in_flight += 1
+            metrics.gauge("geocubes_in_flight_max", self.in_flight, max)
+
+    def release(self, latency, status=None, error=False, retry_after=None):
+
+        """
+            Frees the place of a finished request and adapts the limit to how the request went
+
+            latency - Seconds from the start of the request to its response
+            status - HTTP status of the response, None if there was no response
+            error - True if the request failed without a response, e.g. a connection error
+            retry_after - Seconds the server asked to wait before the next request
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+                metrics.count("geocubes_retry_after")
+
+            if error or (status is not None and status >= 500) or status == 429:
+                if self._decrease(now, 0.5):
+                    self.ceiling = self.limit * 2
+                    self.last_pushback = now
+            else:
+                self.smoothed = latency if self.smoothed is None else 0.8 * self.smoothed + 0.2 * latency
+                # The lowest latency rises slowly, so that a lasting change in the network is taken as the new normal
+                self.baseline = self.smoothed if self.baseline is None else min(self.baseline * 1.001, self.smoothed)
+                if self.smoothed > self.tolerance * self.baseline:
+                    self._decrease(now, 0.9)
+                else:
+                    highest = self.max_limit
+                    if self.ceiling is not None and now - self.last_pushback < self.probe:
+                        highest = min(max(self.ceiling - 1, self.min_limit), highest)
+                    if self.limit < highest:
+                        self.limit = min(self.limit + (1 if self.slow_start else 1 / self.limit), highest)
+            self._record()
+            self.condition.notify_all()
+
+    def _decrease(self, now, factor):
+        # The requests that were in flight together fail together, so the limit is decreased at most once per round trip
+        if now - self.last_decrease < (self.smoothed or 0.0):
+            return False
+        self.last_decrease = now
+        self.slow_start = False
+        self.limit = max(self.limit * factor, self.min_limit)
+        metrics.count("geocubes_limit_decrease")
+        return True
+
+    def _record(self):
+        metrics.gauge("geocubes_limit", round(self.limit, 2))
+        metrics.gauge("geocubes_limit_max", round(self.limit, 2), max)
+        metrics.gauge("geocubes_limit_min", round(self.limit, 2), min)
+
+    def slot(self):
+
+        """
+            Returns a context manager that holds a place for the requests of the block, e.g. a GDAL open of a raster.
+            A connection error or a timeout raised in the block counts as a failed request, other errors can be classified with failure.
+        """
+
+        return _Slot(self)
+
+    def request(self, session, method, url, **kwargs):
+
+        """
+            Sends a request when the limit allows it. A throttled response is retried after its Retry-After, or after the backoff if it has none,
+            and the last response is returned if the retries run out. The caller checks the status as with session.request.
+            Returns the response
+
+            session - requests.Session or the requests module
+        """
+
+        for attempt in range(self.retries + 1):
+            with self.slot() as slot:
+                r = session.request(method, url, **kwargs)
+                slot.response(r)
+            if r.status_code not in THROTTLED or attempt == self.retries:
+                return r
+            r.close()
+            metrics.count("geocubes_retry")
+            if slot.retry_after is None:
+                with self.condition:
+                    self.paused_until = max(self.paused_until, time.monotonic() + self.backoff * 2 ** attempt)
+
+class _Slot:
+
+    def __init__(self, governor):
+        self.governor = governor
+        self.status = None
+        self.retry_after = None
+        self.error = None
+
+    def __enter__(self):
+        self.governor.acquire()
+        self.start = time.monotonic()
+        return self
+
+    def response(self, r):
+        self.status = r.status_code
+        if r.status_code in THROTTLED:
+            self.retry_after = parse_retry_after(r.headers.get("Retry-After"))
+
+    def failure(self, status=None, error=False):
+
+        """
+            Classifies an error raised in the block: the HTTP status if the server answered, or error for a failed connection or a timeout.
+            A failure with neither, e.g. a file that is not a valid raster, does not decrease the limit.
+        """
+
+        self.status = status
+        self.error = error
+
+    def __exit__(self, exc_type, exc, tb):
+        error = self.error
+        if error is None:
+            error = exc_type is not None and self.status is None and issubclass(exc_type, CONNECTION_ERRORS)
+        self.governor.release(time.monotonic() - self.start, self.status, error, self.retry_after)
+        return False
+
+def parse_retry_after(value):
+
+    """
+        Returns the seconds of a Retry-After header, given either as seconds or as an HTTP date, None if the header is missing or invalid
+    """
+
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+governor = Governor()
+
+def add_throttle_arguments(parser):
+
+    """
+        Adds the GeoCubes request limit options to the argument parser of a script
+    """
+
+    parser.add_argument("--geocubes-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY,
+                        help=f"Highest number of requests in flight to the GeoCubes server, the limit adapts to the server below it (default {DEFAULT_MAX_CONCURRENCY})")
+    parser.add_argument("--geocubes-rate", type=float, help="Highest number of requests started per second to the GeoCubes server (default no limit)")
+
+def configure_throttle(args, processes=1):
+
+    """
+        Sets the limits of the shared governor from the options of add_throttle_arguments.
+        The limits are divided between the worker processes, each of them has its own governor.
+    """
+
+    governor.configure(
+        max(args.geocubes_concurrency // processes, 1),
+        args.geocubes_rate / processes if args.geocubes_rate else None
+    )
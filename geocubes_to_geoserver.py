@@ -1,123 +1,36 @@
-import json
+import sys
 import getpass
 import argparse
 import requests
 import pystac_client
 from pathlib import Path
-from requests.auth import HTTPBasicAuth
 from urllib.parse import urljoin
+from geoserver_upload import Uploader
+from geoserver_catalog import fetch_item_ids
+from geoserver_convert import convert_collection, read_ndjson, payload_id, json_convert
+from geocubes_export import read_export
+from geocubes_journal import Journal
+from geocubes_metrics import add_metrics_arguments, start_metrics
 
-def json_convert(jsonfile):
-
-    """
-        jsonfile: json file in dict format
-        
-        A function to map the Sentinel-2 STAC jsonfiles into the GeoServer database layout.
-        There are different json layouts for Collections and Items. The function checks if the jsonfile is of type "Collection",
-        or of type "Feature" (=Item). A number of properties are hardcoded into Sentinel-2 metadata as these are not collected in the STAC jsonfiles.
-    """
-
-    with open(jsonfile) as f:
-        content = json.load(f)
-    
-    if content["type"] == "Collection":
-
-        new_json = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": [
-                    [
-                        [
-                            content["extent"]["spatial"]["bbox"][0][2],
-                            content["extent"]["spatial"]["bbox"][0][1]
-                        ],
-                        [
-                            content["extent"]["spatial"]["bbox"][0][2],
-                            content["extent"]["spatial"]["bbox"][0][3]
-                        ],
-                        [
-                            content["extent"]["spatial"]["bbox"][0][0],
-                            content["extent"]["spatial"]["bbox"][0][3]
-                        ],
-                        [
-                            content["extent"]["spatial"]["bbox"][0][0],
-                            content["extent"]["spatial"]["bbox"][0][1]
-                        ],
-                        [
-                            content["extent"]["spatial"]["bbox"][0][2],
-                            content["extent"]["spatial"]["bbox"][0][1]
-                        ]
-
-                    ]
-                ]
-            },
-            "properties": {
-                "name": content["id"],
-                "title": content["title"],
-                "eo:identifier": content["id"],
-                "description": content["description"],
-                "timeStart": content["extent"]["temporal"]["interval"][0][0],
-                "timeEnd": content["extent"]["temporal"]["interval"][0][1],
-                "primary": True,
-                "license": content["license"],
-                "providers": content["providers"], # Providers added
-                "derivedFrom": None,
-                "licenseLink": None,
-                "summaries": content["summaries"],
-                "queryables": [
-                    "eo:identifier"
-                ]
-            }
-        }
-
-        if "derived_from" in content:
-            new_json["properties"]["derivedFrom"] = {
-                    "href": content["derived_from"],
-                    "rel": "derived_from",
-                    "type": "application/json"
-            }
-
-        if "assets" in content:
-            new_json["properties"]["assets"] = content["assets"]
-
-        for link in content["links"]:
-            if link["rel"] == "license":
-                new_json["properties"]["licenseLink"] = {
-                    "href": link["href"],
-                    "rel": "license",
-                    "type": "application/json"
-                } # New License URL link
-
-    if content["type"] == "Feature":
-
-        new_json = {
-            "type": "Feature",
-            "geometry": content["geometry"],
-            "properties": {
-                "eop:identifier": content["id"],
-                "eop:parentIdentifier": content["collection"],
-                "timeStart": content["properties"]["start_datetime"],
-                "timeEnd": content["properties"]["end_datetime"],
-                "eop:resolution": content["gsd"],
-                # "opt:cloudCover": int(content["properties"]["eo:cloud_cover"]),
-                "crs": content["properties"]["proj:epsg"],
-                "projTransform": content["properties"]["proj:transform"],
-                # "thumbnailURL": content["links"]["thumbnail"]["href"],
-                "assets": content["assets"]
-            }
-        }
-
-    return json.loads(json.dumps(new_json))
+DEFAULT_JOURNAL = "geocubes_to_geoserver.journal"
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, help="Hostname of the selected STAC API", required=True)
+    parser.add_argument("--workers", type=int, default=8, help="Number of concurrent upload requests (default 8)")
+    parser.add_argument("--retries", type=int, default=5, help="Number of retries for connection errors and 5xx responses (default 5)")
+    parser.add_argument("--existence", choices=["index", "probe"], default="index",
+                        help="index fetches the IDs of the uploaded items page by page before the upload, probe checks each item from the REST API before sending it (for very large collections)")
+    parser.add_argument("--ndjson", type=str, help="Upload the payloads of an NDJSON file made with geoserver_convert.py instead of converting the collection folder")
+    parser.add_argument("--export", type=str, help="Upload the collection exported with geocubes_export.py, given as its .items.ndjson or .items.parquet file")
+    parser.add_argument("--dry-run", action="store_true", help="Only print which items would be added and which updated, nothing is sent")
+    parser.add_argument("--journal", type=str, default=DEFAULT_JOURNAL, help=f"Journal of the finished uploads (default {DEFAULT_JOURNAL})")
+    parser.add_argument("--resume", action="store_true", help="Continue a stopped upload from the journal, the uploads it has are not sent again")
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
-
-    pwd = getpass.getpass()
+    start_metrics(args)
 
     # The uploaded collection is specific below, this could be done with an argument in the future
     collection_name = "sentinel_1_global_backscatter_at_geocubes"
@@ -125,55 +38,76 @@ if __name__ == "__main__":
     workingdir = Path(__file__).parent
     collection_folder = workingdir / "GeoCubes" / collection_name
 
+    # Converted OSEO payloads, the collection comes first and the items after it
+    if args.ndjson:
+        payloads = read_ndjson(args.ndjson)
+    elif args.export:
+        payloads = map(json_convert, read_export(args.export))
+    else:
+        payloads = convert_collection(collection_folder)
+    converted = next(payloads)
+    collection_name = payload_id(converted)
+
     app_host = f"{args.host}/geoserver/rest/oseo/"
-    catalog = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/", headers={"User-Agent":"update-script"})
+    stac_url = f"{args.host}/geoserver/ogc/stac/v1/"
+    catalog = pystac_client.Client.open(stac_url, headers={"User-Agent":"update-script"})
+    col_ids = [col.id for col in catalog.get_collections()]
+
+    # Get the IDs of the already uploaded items from the specific collection
+    # The dry run always uses the ID index, as the REST API needs the password
+    if args.existence == "index" or args.dry_run:
+        session = requests.Session()
+        session.headers.update({"User-Agent":"update-script"})
+        posted_ids = fetch_item_ids(stac_url, collection_name, session) if collection_name in col_ids else set()
+        print(f"Number of uploaded items: {len(posted_ids)}")
+
+    if args.dry_run:
+        print(f"{'Update' if collection_name in col_ids else 'Add'} collection: {collection_name}")
+        added = updated = 0
+        for payload in payloads:
+            product_id = payload_id(payload)
+            if product_id in posted_ids:
+                updated += 1
+                print(f" * Update: {product_id}")
+            else:
+                added += 1
+                print(f" + Add: {product_id}")
+        print(f"Dry run: {added} items would be added and {updated} updated.")
+        sys.exit(0)
 
-    # Convert the STAC collection json into json that GeoServer can handle
-    converted = json_convert(collection_folder / "collection.json")
+    pwd = getpass.getpass()
+    uploader = Uploader(("admin", pwd), workers=args.workers, retries=args.retries)
+    journal = Journal(args.journal, resume=args.resume)
 
     #Additional code for changing collection data if the collection already exists
-    collections = catalog.get_collections()
-    col_ids = [col.id for col in collections]
-    if collection_name in col_ids:
-        r = requests.put(urljoin(app_host + "collections/", collection_name), json=converted, auth=HTTPBasicAuth("admin", pwd))
-        r.raise_for_status()
+    if journal.done("collection", collection_name):
+        print(f"Collection already uploaded: {collection_name}")
+    elif collection_name in col_ids:
+        uploader.request("PUT", urljoin(app_host + "collections/", collection_name), converted)
+        journal.record("collection", collection_name)
         print(f"Updated {collection_name}")
     else:
-        r = requests.post(urljoin(app_host, "collections/"), json=converted, auth=HTTPBasicAuth("admin", pwd))
-        r.raise_for_status()
+        uploader.request("POST", urljoin(app_host, "collections/"), converted)
+        journal.record("collection", collection_name)
         print(f"Added new collection: {collection_name}")
 
-    # Get the items from the specific collection
-    posted = catalog.search(collections=[collection_name]).item_collection()
-    posted_ids = [x.id for x in posted]
-    print(f"Number of uploaded items: {len(posted_ids)}")
-
-    with open(collection_folder / "collection.json") as f:
-        rootcollection = json.load(f)
-
-    items = [x['href'] for x in rootcollection["links"] if x["rel"] == "item"]
-
     print("Uploading items:")
-    for i, item in enumerate(items):
-        with open(collection_folder / item) as f:
-            payload = json.load(f)
-        # Convert the STAC item json into json that GeoServer can handle
-        converted = json_convert(collection_folder / item)
-        request_point = f"collections/{rootcollection['id']}/products"
-        if payload["id"] in posted_ids:
-            request_point = f"collections/{rootcollection['id']}/products/{payload['id']}"
-            r = requests.put(urljoin(app_host, request_point), json=converted, auth=HTTPBasicAuth("admin", pwd))
-            r.raise_for_status()
-        else:
-            r = requests.post(urljoin(app_host, request_point), json=converted, auth=HTTPBasicAuth("admin", pwd))
-            r.raise_for_status()
-        if len(items) >= 5: # Just to keep track that the script is still running
-            if i == int(len(items) / 5):
-                print("~20% of items added.")
-            elif i == int(len(items) / 5) * 2:
-                print("~40% of items added.")
-            elif i == int(len(items) / 5) * 3:
-                print("~60% of items added.")
-            elif i == int(len(items) / 5) * 4:
-                print("~80% of items added.")
-    print("All items added.")
\ No newline at end of file
+    resumed = 0
+    for payload in payloads:
+        product_id = payload_id(payload)
+        if journal.done("upload", collection_name, product_id):
+            resumed += 1
+            continue
+        exists = product_id in posted_ids if args.existence == "index" else None
+        future = uploader.submit_product(app_host, collection_name, product_id, payload, exists)
+        # The upload is recorded from the worker thread once it has succeeded
+        future.add_done_callback(lambda f, product_id=product_id: f.result() and journal.record("upload", collection_name, product_id))
+
+    uploader.close()
+    journal.close()
+    if resumed:
+        print(f"Skipped {resumed} items uploaded before.")
+    print(uploader.summary())
+    if uploader.failures:
+        sys.exit(1)
+    print("All items added.")
@@ -0,0 +1,110 @@
+import os
+import json
+import pystac
+from geocubes_metrics import metrics
+
+class StreamingCatalogWriter:
+
+    """
+        Writes the catalog tree one object at a time, in the same layout that catalog.normalize_and_save makes.
+        Each item is written from its record to its final path as soon as it is made and only its link is kept in the collection,
+        so the memory use is bounded by the item links of one collection instead of the whole catalog.
+        The catalog.json is rewritten after each finished collection, so the tree on disk is valid even if the run stops.
+
+        catalog - The root pystac.Catalog
+        root_dir - Folder of the catalog.json
+        write_catalog - Write the catalog.json after each collection, disabled in worker processes that only write their own collection
+    """
+
+    def __init__(self, catalog, root_dir="GeoCubes", write_catalog=True):
+        self.catalog = catalog
+        self.root_dir = os.path.abspath(root_dir)
+        self.write_catalog = write_catalog
+        self.catalog.set_self_href(os.path.join(self.root_dir, "catalog.json"))
+        self.stac_io = pystac.StacIO.default()
+
+    def add_collection(self, collection):
+
+        """
+            Adds the collection to the catalog and sets its href, before any of its items are written
+        """
+
+        self.catalog.add_child(collection)
+
+    def write_item(self, collection, item):
+
+        """
+            Writes an item record to its final path and adds its link to the collection, only the link is kept in memory.
+            Returns the path of the written item
+
+            collection - The pystac.Collection of the item, with its href set by add_collection
+            item - ItemRecord of the item
+        """
+
+        # The path is the same the best practices layout gives
+        path = os.path.join(os.path.dirname(collection.get_self_href()), item.id, f"{item.id}.json")
+        # Same links as normalize_and_save writes: root, collection and parent
+        links = [
+            self._link(pystac.RelType.ROOT, self.catalog, path),
+            self._link(pystac.RelType.COLLECTION, collection, path),
+            self._link(pystac.RelType.PARENT, collection, path)
+        ]
+        with metrics.timer("save"):
+            self.stac_io.save_json(path, item.to_dict(collection.id, links))
+        self.add_item_link(collection, path)
+        return path
+
+    def add_item_link(self, collection, path):
+
+        """
+            Adds the link of an already written item to the collection, e.g. an item resumed from an earlier run
+        """
+
+        collection.add_link(pystac.Link(pystac.RelType.ITEM, path, media_type=pystac.MediaType.GEOJSON))
+
+    def _link(self, rel, target, path):
+        # The link dictionary of pystac.Link.to_dict, with the href relative to the item
+        link = {"rel": rel, "href": os.path.relpath(target.get_self_href(), os.path.dirname(path)).replace(os.sep, "/"), "type": pystac.MediaType.JSON}
+        if target.title is not None:
+            link["title"] = target.title
+        return link
+
+    def finish_collection(self, collection):
+
+        """
+            Writes the collection.json of a finished collection and the updated catalog.json
+        """
+
+        # Same link order as normalize_and_save: root, items and parent
+        collection.set_parent(self.catalog)
+        with metrics.timer("save"):
+            collection.save_object(include_self_link=False)
+        # The item links are in the written file, so the finished collections do not add up in memory
+        collection.clear_links(pystac.RelType.ITEM)
+        if self.write_catalog:
+            self.save_catalog()
+
+    def attach_collection(self, path):
+
+        """
+            Adds a collection written by another process to the catalog as a child link and writes the updated catalog.json.
+            Only the title is read from the collection.json, the collection is not kept in memory.
+
+            path - Path of the written collection.json
+        """
+
+        with open(path) as f:
+            title = json.load(f).get("title")
+        self.catalog.add_link(pystac.Link(pystac.RelType.CHILD, path, media_type=pystac.MediaType.JSON, title=title))
+        self.save_catalog()
+
+    def save_catalog(self):
+
+        """
+            Writes the catalog.json
+        """
+
+        # Same link order as normalize_and_save: the self link is the last one
+        self.catalog.set_self_href(self.catalog.get_self_href())
+        with metrics.timer("save"):
+            self.catalog.save_object(include_self_link=True)
@@ -0,0 +1,59 @@
+import requests
+from urllib.parse import urljoin
+
+def fetch_item_ids(stac_url, collection_id, session=None, page_size=1000):
+
+    """
+        Streams the item IDs of a collection from the STAC API one page at a time. Only the id field is requested,
+        so the full items are not downloaded or parsed into pystac objects.
+        Returns the IDs as a set
+
+        stac_url - Root of the STAC API, e.g. <host>/geoserver/ogc/stac/v1/
+        collection_id - ID of the collection
+        session - Optional requests.Session
+        page_size - Number of items requested per page
+    """
+
+    session = session or requests.Session()
+    url = urljoin(stac_url, f"collections/{collection_id}/items")
+    params = {"limit": page_size, "fields": "id"}
+
+    ids = set()
+    while url:
+        r = session.get(url, params=params)
+        r.raise_for_status()
+        page = r.json()
+        ids.update(feature["id"] for feature in page["features"])
+        # The next link already holds the query parameters
+        url = next((link["href"] for link in page.get("links", []) if link["rel"] == "next" and link.get("method", "GET") == "GET"), None)
+        params = None
+
+    return ids
+
+def product_exists(app_host, collection_id, product_id, session):
+
+    """
+        Checks from the GeoServer REST API if the product is already in the collection, without listing the collection.
+        Returns True or False
+
+        app_host - The REST API path, e.g. <host>/geoserver/rest/oseo/
+        session - requests.Session with the REST API credentials
+    """
+
+    r = session.get(urljoin(app_host, f"collections/{collection_id}/products/{product_id}"))
+    if r.status_code == 404:
+        return False
+    r.raise_for_status()
+    return True
+
+def count_items(stac_url, collection_id, session=None):
+
+    """
+        Asks the number of items in a collection from the STAC API with a single one-item page.
+        Returns the numberMatched of the response, or None if the API does not report it
+    """
+
+    session = session or requests.Session()
+    r = session.get(urljoin(stac_url, f"collections/{collection_id}/items"), params={"limit": 1, "fields": "id"})
+    r.raise_for_status()
+    return r.json().get("numberMatched")
@@ -0,0 +1,210 @@
+import json
+import argparse
+from pathlib import Path
+from geocubes_metrics import metrics, add_metrics_arguments, start_metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data):
+
+    """
+        Parses JSON from a string or bytes, with orjson if it is installed
+    """
+
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(content):
+
+    """
+        Serializes a dictionary into one line of JSON, with orjson if it is installed.
+        Returns the line as bytes
+    """
+
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+@metrics.timed("conversion")
+def json_convert(content):
+
+    """
+        A function to map the STAC dictionaries into the GeoServer database layout.
+        There are different json layouts for Collections and Items. The function checks if the dictionary is of type "Collection",
+        or of type "Feature" (=Item).
+        Returns the OSEO payload as a dictionary
+
+        content - STAC dictionary from where the modified JSON will be made
+    """
+
+    if content["type"] == "Collection":
+
+        bbox = content["extent"]["spatial"]["bbox"][0]
+        new_json = {
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [
+                    [
+                        [bbox[2], bbox[1]],
+                        [bbox[2], bbox[3]],
+                        [bbox[0], bbox[3]],
+                        [bbox[0], bbox[1]],
+                        [bbox[2], bbox[1]]
+                    ]
+                ]
+            },
+            "properties": {
+                "name": content["id"],
+                "title": content["title"],
+                "eo:identifier": content["id"],
+                "description": content["description"],
+                "timeStart": content["extent"]["temporal"]["interval"][0][0],
+                "timeEnd": content["extent"]["temporal"]["interval"][0][1],
+                "primary": True,
+                "license": content["license"],
+                "providers": content["providers"], # Providers added
+                "derivedFrom": None,
+                "licenseLink": None,
+                "summaries": content["summaries"],
+                "queryables": [
+                    "eo:identifier"
+                ]
+            }
+        }
+
+        if "derived_from" in content:
+            new_json["properties"]["derivedFrom"] = {
+                "href": content["derived_from"],
+                "rel": "derived_from",
+                "type": "application/json"
+            }
+
+        if "assets" in content:
+            new_json["properties"]["assets"] = content["assets"]
+
+        for link in content["links"]:
+            if link["rel"] == "license":
+                new_json["properties"]["licenseLink"] = { #New License URL link
+                    "href": link["href"],
+                    "rel": "license",
+                    "type": "application/json"
+                }
+            elif link["rel"] == "derived_from":
+                new_json["properties"]["derivedFrom"] = {
+                    "href": link["href"],
+                    "rel": "derived_from",
+                    "type": "application/json"
+                }
+
+        # A collection without a source is sent without the field, like update_geocubes.py sent its collections
+        if new_json["properties"]["derivedFrom"] is None:
+            del new_json["properties"]["derivedFrom"]
+
+    if content["type"] == "Feature":
+
+        properties = content["properties"]
+        new_json = {
+            "type": "Feature",
+            "geometry": content["geometry"],
+            "properties": {
+                "eop:identifier": content["id"],
+                "eop:parentIdentifier": content["collection"],
+                "timeStart": properties.get("start_datetime"),
+                "timeEnd": properties.get("end_datetime"),
+                "eop:resolution": content["gsd"],
+                # "opt:cloudCover": int(content["properties"]["eo:cloud_cover"]),
+                "crs": properties["proj:epsg"],
+                "projTransform": properties["proj:transform"],
+                # "thumbnailURL": content["links"]["thumbnail"]["href"],
+                "assets": content["assets"]
+            }
+        }
+
+        if new_json["properties"]["timeStart"] is None and new_json["properties"]["timeEnd"] is None and properties.get("datetime") is not None:
+            new_json["properties"]["timeStart"] = properties["datetime"]
+            new_json["properties"]["timeEnd"] = properties["datetime"]
+
+    return new_json
+
+def payload_id(payload):
+
+    """
+        Returns the identifier of a converted collection or product payload
+    """
+
+    properties = payload["properties"]
+    return properties["eop:identifier"] if "eop:identifier" in properties else properties["eo:identifier"]
+
+def read_collection_folder(collection_folder):
+
+    """
+        Reads a collection written by geocubes_stac.py in one pass, each file is read and parsed only once.
+        Yields the STAC dictionary of the collection first and then those of its items in link order
+
+        collection_folder - Folder of the collection.json
+    """
+
+    collection_folder = Path(collection_folder)
+    with open(collection_folder / "collection.json", "rb") as f:
+        collection = loads(f.read())
+    yield collection
+
+    for link in collection["links"]:
+        if link["rel"] == "item":
+            with open(collection_folder / link["href"], "rb") as f:
+                yield loads(f.read())
+
+def convert_collection(collection_folder):
+
+    """
+        Converts a collection written by geocubes_stac.py as it is read with read_collection_folder.
+        Yields the OSEO payload of the collection first and then the payloads of its items in link order
+
+        collection_folder - Folder of the collection.json
+    """
+
+    return (json_convert(stac_object) for stac_object in read_collection_folder(collection_folder))
+
+def write_ndjson(payloads, path):
+
+    """
+        Writes the payloads into a newline delimited JSON file, one payload per line.
+        Returns the number of written payloads
+    """
+
+    count = 0
+    with open(path, "wb") as f:
+        for payload in payloads:
+            f.write(dumps(payload) + b"\n")
+            count += 1
+    return count
+
+def read_ndjson(path):
+
+    """
+        Yields the payloads of a newline delimited JSON file one at a time
+    """
+
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert collections of the STAC catalog into NDJSON files of GeoServer OSEO payloads. The first line of a file is the collection, the rest are its items.")
+    parser.add_argument("collections", nargs="+", help="Collection folders, e.g. GeoCubes/sentinel_1_global_backscatter_at_geocubes")
+    parser.add_argument("--output", type=str, default=".", help="Folder of the written <collection>.ndjson files (default current folder)")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    start_metrics(args)
+
+    for collection_folder in args.collections:
+        path = Path(args.output) / f"{Path(collection_folder).name}.ndjson"
+        count = write_ndjson(convert_collection(collection_folder), path)
+        print(f"{path}: 1 collection and {count - 1} items")
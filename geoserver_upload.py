@@ -0,0 +1,169 @@
+import time
+import requests
+import threading
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from geoserver_catalog import product_exists
+from geocubes_metrics import metrics
+
+class Uploader:
+
+    """
+        Sends JSON payloads to the GeoServer REST API. The requests share a pooled keep-alive session and
+        up to `workers` of them are in flight at the same time. Connection errors and the 5xx responses of the idempotent requests (PUT, GET)
+        are retried with exponential backoff. A POST is retried only if it could not connect, as GeoServer may have committed it before the error.
+        Failed requests are collected instead of stopping the upload, see summary().
+
+        auth - Tuple of username and password
+        workers - Number of concurrent requests
+        retries - Number of retries for a failed request
+        backoff - Backoff factor in seconds, the n:th retry waits backoff * 2^(n-1) seconds
+        headers - Optional headers sent with every request
+    """
+
+    def __init__(self, auth, workers=8, retries=5, backoff=0.5, headers=None):
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=[500, 502, 503, 504],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update(headers or {})
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Limits the queued payloads, so a large collection is not read into memory at once
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.lock = threading.Lock()
+        self.futures = set() # The unfinished requests, a finished one is dropped
+        self.sent = 0
+        self.bytes_sent = 0
+        self.failures = []
+        self.start = time.time()
+
+    def request(self, method, url, payload):
+
+        """
+            Sends one request and waits for it. Raises requests.HTTPError if it still fails after the retries.
+            Returns the response
+        """
+
+        with metrics.timer("upload"):
+            r = self.session.request(method, url, json=payload)
+        with self.lock:
+            self.sent += 1
+            self.bytes_sent += len(r.request.body or b"")
+        metrics.count(f"upload_{method.lower()}_{r.status_code}")
+        metrics.add_bytes("upload", len(r.request.body or b""))
+        r.raise_for_status()
+        return r
+
+    def submit(self, method, url, payload, label=None):
+
+        """
+            Queues a request to be sent concurrently. Blocks while the queue is full.
+            Returns the future of the request, its result is True if the request succeeded
+
+            label - Name of the payload used in the failure summary, e.g. the item ID
+        """
+
+        self.slots.acquire()
+        future = self.executor.submit(self._send, method, url, payload, label or url)
+        self._track(future)
+        return future
+
+    def submit_product(self, app_host, collection_id, product_id, payload, exists=None):
+
+        """
+            Queues the upload of a product. Products already in the collection are updated with PUT and new ones are added with POST.
+            Returns the future of the upload, its result is True if the upload succeeded
+
+            app_host - The REST API path, e.g. <host>/geoserver/rest/oseo/
+            exists - Whether the product is already in the collection. If None, it is checked from the REST API in the worker thread.
+        """
+
+        self.slots.acquire()
+        future = self.executor.submit(self._send_product, app_host, collection_id, product_id, payload, exists)
+        self._track(future)
+        return future
+
+    def _track(self, future):
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.slots.release()
+
+    def _send_product(self, app_host, collection_id, product_id, payload, exists):
+        try:
+            if exists is None:
+                exists = product_exists(app_host, collection_id, product_id, self.session)
+            if exists:
+                self.request("PUT", urljoin(app_host, f"collections/{collection_id}/products/{product_id}"), payload)
+                return True
+            try:
+                self.request("POST", urljoin(app_host, f"collections/{collection_id}/products"), payload)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                if isinstance(e, requests.HTTPError) and e.response.status_code < 500:
+                    raise
+                # The POST is not retried, as the product may have been committed before the error. It is updated if it is there and posted again if not.
+                if product_exists(app_host, collection_id, product_id, self.session):
+                    self.request("PUT", urljoin(app_host, f"collections/{collection_id}/products/{product_id}"), payload)
+                else:
+                    self.request("POST", urljoin(app_host, f"collections/{collection_id}/products"), payload)
+        except requests.RequestException as e:
+            with self.lock:
+                self.failures.append((product_id, str(e)))
+            return False
+        return True
+
+    def _send(self, method, url, payload, label):
+        try:
+            self.request(method, url, payload)
+        except requests.RequestException as e:
+            with self.lock:
+                self.failures.append((label, str(e)))
+            return False
+        return True
+
+    def wait(self):
+
+        """
+            Waits until all the queued requests are finished
+        """
+
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.result()
+
+    def summary(self):
+
+        """
+            Returns a summary of the sent requests, the throughput and the failures
+        """
+
+        elapsed = time.time() - self.start
+        lines = [
+            f"Sent {self.sent} requests ({self.bytes_sent / 1e6:.1f} MB) in {elapsed:.1f} seconds, "
+            f"{self.sent / elapsed if elapsed else 0:.1f} requests/s with {self.workers} workers.",
+            f"Failed: {len(self.failures)}"
+        ]
+        for label, error in self.failures:
+            lines.append(f" - {label}: {error}")
+        return "\n".join(lines)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+        self.session.close()
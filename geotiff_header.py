@@ -0,0 +1,177 @@
+import struct
+import xml.etree.ElementTree as ElementTree
+import requests
+import threading
+from rasterio.crs import CRS
+from geocubes_metrics import metrics
+from geocubes_throttle import governor
+
+HEADER_BYTES = 16384 # The first IFD and the GeoTIFF tags of a COG are at the start of the file
+
+# Field types: struct format and size of one value
+FIELD_TYPES = {
+    1: ("B", 1), 2: ("c", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 6: ("b", 1), 7: ("B", 1),
+    8: ("h", 2), 9: ("i", 4), 10: ("ii", 8), 11: ("f", 4), 12: ("d", 8), 16: ("Q", 8), 17: ("q", 8), 18: ("Q", 8)
+}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+DATE_TIME = 306
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+MODEL_TRANSFORMATION = 34264
+GEO_KEY_DIRECTORY = 34735
+GDAL_METADATA = 42112
+ASCII = 2
+
+# GeoKeys that do not change the CRS GDAL builds from the EPSG code
+MODEL_TYPE_KEY = 1024
+RASTER_TYPE_KEY = 1025
+GEOGRAPHIC_TYPE_KEY = 2048
+PROJECTED_CS_TYPE_KEY = 3072
+SUPPORTED_GEO_KEYS = {MODEL_TYPE_KEY, RASTER_TYPE_KEY, 1026, GEOGRAPHIC_TYPE_KEY, 2049, 2054, PROJECTED_CS_TYPE_KEY, 3073, 3076}
+
+_local = threading.local()
+
+class GeoTIFFHeaderError(Exception):
+
+    """
+        Raised when the header cannot be read from the fetched bytes, the caller should fall back to rasterio
+    """
+
+def _session():
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+def fetch_geotiff_header(url, size=HEADER_BYTES):
+
+    """
+        Fetches the first bytes of the file with a single range request and parses the header from them.
+        Returns a tuple of the header, in the same format as geocubes_harvest.read_header, and the ETag and Last-Modified of the file
+
+        url - URL of the GeoTIFF
+        size - Number of bytes requested from the start of the file
+    """
+
+    with governor.request(_session(), "GET", url, headers={"Range": f"bytes=0-{size - 1}"}, stream=True) as r:
+        r.raise_for_status()
+        data = r.raw.read(size, decode_content=True)
+        metrics.add_bytes("raster_header", len(data))
+        validators = (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+    return parse_geotiff_header(data), validators
+
+def parse_geotiff_header(data):
+
+    """
+        Parses the size, geotransform, CRS and date of the first image from the start of a TIFF or BigTIFF file.
+        The date is the one rio_stac gives the item: the ACQUISITIONDATETIME of the IMAGERY metadata, or the TIFF DateTime tag.
+        Only north-up rasters with an EPSG coded CRS are handled, for anything else GeoTIFFHeaderError is raised.
+        Returns the header in the same format as geocubes_harvest.read_header
+
+        data - Bytes from the start of the file
+    """
+
+    if data[:2] == b"II":
+        order = "<"
+    elif data[:2] == b"MM":
+        order = ">"
+    else:
+        raise GeoTIFFHeaderError("Not a TIFF file")
+
+    def unpack(fmt, offset):
+        size = struct.calcsize(order + fmt)
+        if offset + size > len(data):
+            raise GeoTIFFHeaderError("The header continues past the fetched range")
+        return struct.unpack_from(order + fmt, data, offset)
+
+    version = unpack("H", 2)[0]
+    if version == 42:
+        ifd_offset = unpack("I", 4)[0]
+        count_fmt, entry_fmt, entry_size, inline_size = "H", "HHII", 12, 4
+    elif version == 43:
+        ifd_offset = unpack("Q", 8)[0]
+        count_fmt, entry_fmt, entry_size, inline_size = "Q", "HHQQ", 20, 8
+    else:
+        raise GeoTIFFHeaderError("Not a TIFF file")
+
+    entry_count = unpack(count_fmt, ifd_offset)[0]
+    first_entry = ifd_offset + struct.calcsize(order + count_fmt)
+    tags = {}
+    for i in range(entry_count):
+        entry_offset = first_entry + i * entry_size
+        tag, field_type, count, value = unpack(entry_fmt, entry_offset)
+        if tag not in (IMAGE_WIDTH, IMAGE_LENGTH, DATE_TIME, MODEL_PIXEL_SCALE, MODEL_TIEPOINT, MODEL_TRANSFORMATION, GEO_KEY_DIRECTORY, GDAL_METADATA):
+            continue
+        if field_type not in FIELD_TYPES:
+            raise GeoTIFFHeaderError(f"Unknown field type {field_type} in tag {tag}")
+        fmt, type_size = FIELD_TYPES[field_type]
+        # Values that fit into the entry are stored in it, otherwise the entry holds the offset of the values
+        if count * type_size <= inline_size:
+            value_offset = entry_offset + entry_size - inline_size
+        else:
+            value_offset = value
+        if field_type == ASCII:
+            # A NUL terminated string, read as one value
+            tags[tag] = unpack(f"{count}s", value_offset)[0].split(b"\0")[0].decode("utf-8", "replace")
+        else:
+            tags[tag] = unpack(fmt * count, value_offset)
+
+    if IMAGE_WIDTH not in tags or IMAGE_LENGTH not in tags or GEO_KEY_DIRECTORY not in tags:
+        raise GeoTIFFHeaderError("Missing size or GeoTIFF tags")
+    width, height = tags[IMAGE_WIDTH][0], tags[IMAGE_LENGTH][0]
+
+    if MODEL_TRANSFORMATION in tags:
+        m = tags[MODEL_TRANSFORMATION]
+        transform = [m[0], m[1], m[3], m[4], m[5], m[7], 0.0, 0.0, 1.0]
+    elif MODEL_TIEPOINT in tags and MODEL_PIXEL_SCALE in tags and len(tags[MODEL_TIEPOINT]) == 6:
+        i, j, _, x, y, _ = tags[MODEL_TIEPOINT]
+        scale_x, scale_y = tags[MODEL_PIXEL_SCALE][:2]
+        transform = [scale_x, 0.0, x - i * scale_x, 0.0, -scale_y, y + j * scale_y, 0.0, 0.0, 1.0]
+    else:
+        raise GeoTIFFHeaderError("No geotransform, the raster may be georeferenced with GCPs")
+    if transform[1] != 0 or transform[3] != 0:
+        raise GeoTIFFHeaderError("Rotated geotransform")
+
+    geo_keys = tags[GEO_KEY_DIRECTORY]
+    keys = {}
+    for k in range(4, 4 + 4 * geo_keys[3], 4):
+        key_id, location, _, value = geo_keys[k:k + 4]
+        if key_id not in SUPPORTED_GEO_KEYS:
+            raise GeoTIFFHeaderError(f"GeoKey {key_id} is not supported")
+        if location == 0:
+            keys[key_id] = value
+    if keys.get(RASTER_TYPE_KEY, 1) != 1:
+        raise GeoTIFFHeaderError("PixelIsPoint rasters are shifted by GDAL")
+    epsg = keys.get(PROJECTED_CS_TYPE_KEY) if keys.get(MODEL_TYPE_KEY) == 1 else keys.get(GEOGRAPHIC_TYPE_KEY)
+    if epsg is None or epsg >= 32767:
+        raise GeoTIFFHeaderError("The CRS has no EPSG code")
+
+    a, _, c, _, e, f = transform[:6]
+    return {
+        "res": [a, -e],
+        "shape": [height, width],
+        "transform": transform,
+        "bounds": [c, f + e * height, c + a * width, f],
+        "wkt": CRS.from_epsg(epsg).to_wkt(),
+        "datetime": gdal_metadata_item(tags.get(GDAL_METADATA), "ACQUISITIONDATETIME", "IMAGERY") or tags.get(DATE_TIME) or None
+    }
+
+def gdal_metadata_item(metadata, name, domain=None):
+
+    """
+        Returns the value of an item of the GDAL_METADATA tag, e.g. <Item name="ACQUISITIONDATETIME" domain="IMAGERY">, None if it is not there
+
+        metadata - XML of the tag, None if the file has no GDAL metadata
+    """
+
+    if not metadata:
+        return None
+    try:
+        root = ElementTree.fromstring(metadata)
+    except ElementTree.ParseError:
+        raise GeoTIFFHeaderError("Invalid GDAL metadata")
+    for item in root.iter("Item"):
+        if item.get("name") == name and item.get("domain") == domain and item.get("band") is None:
+            return item.text
+    return None
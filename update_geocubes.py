@@ -1,158 +1,56 @@
 import pystac
-import rasterio
 import requests
 import datetime
 import pandas as pd
 import re
+import sys
+import json
 import time
 import getpass
+import contextlib
 import argparse
 import pystac_client
-from bs4 import BeautifulSoup
-from rio_stac.stac import create_stac_item
 from urllib.parse import urljoin
+from geocubes_harvest import harvest_headers, harvest_fingerprints, create_record
+from geocubes_cache import RasterCache, DEFAULT_CACHE
+from geocubes_listing import fetch_listing
+from geocubes_filenames import index_listing, group_items
+from geocubes_extent import ExtentAccumulator
+from geoserver_convert import json_convert
+from geoserver_catalog import fetch_item_ids
+from geocubes_state import CatalogState, DEFAULT_STATE, add_state_arguments, state_max_age
+from geoserver_upload import Uploader
+from geocubes_journal import Journal
+from geocubes_registry import add_registry_arguments, datasets_from_args
+from geocubes_metrics import metrics, add_metrics_arguments, start_metrics
+from geocubes_throttle import add_throttle_arguments, configure_throttle
+
+DEFAULT_JOURNAL = "update_geocubes.journal"
+
+def plan_updates(csc_catalog_client, geocubes_datasets, state=None, cache=None, workers=1, detect_changes=True, check_all=False):
 
-def get_datasets():
     """
-        Datasets can be obtained from an API endpoint.
-        Returns a dictionary containing the GeoCubes datasets and their relevant information.
-    """
-
-    data = requests.get("https://vm0160.kaj.pouta.csc.fi/geocubes/info/getDatasets")
-    const_url = "https://vm0160.kaj.pouta.csc.fi"
-    raw_datasets = data.text.split(";")
-    split_datasets = [x.split(",") for x in raw_datasets]
-
-    dataset_dict = {}
-    for split in split_datasets:
-        dataset_dict[split[0]] = dict(zip(["name", "layername", "years", "folder", "file_prefix", "max_resolution", "bit_depth", "producer", "metadata_URL"], split))
-
-    for d in dataset_dict:
-        year_split = dataset_dict[d]['years'].split(".")
-        dataset_dict[d]['paths'] = []
-        if len(year_split) == 1:
-            dataset_dict[d]['paths'].append(f"{const_url}{dataset_dict[d]['folder']}{year_split[0]}/")
-        else:
-            for year in year_split:
-                dataset_dict[d]['paths'].append(f"{const_url}{dataset_dict[d]['folder']}{year}/")
-    
-    return dataset_dict
-
-def json_convert(content):
-
-    """ 
-    A function to map the STAC dictionaries into the GeoServer database layout.
-    There are different json layouts for Collections and Items. The function checks if the dictionary is of type "Collection",
-    or of type "Feature" (=Item).
-
-    content - STAC dictionary from where the modified JSON will be made
-    """
-    
-    if content["type"] == "Collection":
-
-        new_json = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": [
-                    [
-                        [
-                            content["extent"]["spatial"]["bbox"][0][2],
-                            content["extent"]["spatial"]["bbox"][0][1]
-                        ],
-                        [
-                            content["extent"]["spatial"]["bbox"][0][2],
-                            content["extent"]["spatial"]["bbox"][0][3]
-                        ],
-                        [
-                            content["extent"]["spatial"]["bbox"][0][0],
-                            content["extent"]["spatial"]["bbox"][0][3]
-                        ],
-                        [
-                            content["extent"]["spatial"]["bbox"][0][0],
-                            content["extent"]["spatial"]["bbox"][0][1]
-                        ],
-                        [
-                            content["extent"]["spatial"]["bbox"][0][2],
-                            content["extent"]["spatial"]["bbox"][0][1]
-                        ]
-
-                    ]
-                ]
-            },
-            "properties": {
-                "name": content["id"],
-                "title": content["title"],
-                "eo:identifier": content["id"],
-                "description": content["description"],
-                "timeStart": content["extent"]["temporal"]["interval"][0][0],
-                "timeEnd": content["extent"]["temporal"]["interval"][0][1],
-                "primary": True,
-                "license": content["license"],
-                "providers": content["providers"], # Providers added
-                "licenseLink": None,
-                "summaries": content["summaries"],
-                "queryables": [
-                    "eo:identifier"
-                ]
-            }
-        }
-
-        if "assets" in content:
-            new_json["properties"]["assets"] = content["assets"]
-
-        for link in content["links"]:
-            if link["rel"] == "license":
-                new_json["properties"]["licenseLink"] = { #New License URL link
-                    "href": link["href"],
-                    "rel": "license",
-                    "type": "application/json"
-                }
-            elif link["rel"] == "derived_from":
-                derived_href = link["href"]
-                new_json["properties"]["derivedFrom"] = {
-                    "href": derived_href,
-                    "rel": "derived_from",
-                    "type": "application/json"
-                }
-
-    if content["type"] == "Feature":
-
-        new_json = {
-            "type": "Feature",
-            "geometry": content["geometry"],
-            "properties": {
-                "eop:identifier": content["id"],
-                "eop:parentIdentifier": content["collection"],
-                "timeStart": content["properties"]["start_datetime"],
-                "timeEnd": content["properties"]["end_datetime"],
-                "eop:resolution": content["gsd"],
-                # "opt:cloudCover": int(content["properties"]["eo:cloud_cover"]),
-                "crs": content["properties"]["proj:epsg"],
-                "projTransform": content["properties"]["proj:transform"],
-                # "thumbnailURL": content["links"]["thumbnail"]["href"],
-                "assets": content["assets"]
-            }
-        }
-
-        if content["properties"]["start_datetime"] is None and content["properties"]["end_datetime"] is None and content["properties"]["datetime"] is not None:
-            new_json["properties"]["timeStart"] = content["properties"]["datetime"]
-            new_json["properties"]["timeEnd"] = content["properties"]["datetime"]
-
-    return new_json
-
-def update_catalog(app_host, csc_catalog_client):
+    Plans the update without opening any rasters or writing to the host. The year folders of each GeoCubes dataset are listed,
+    the item IDs are derived from the file names and compared to the ones in CSC catalog.
+    With the state, the files of the existing items in changed folders are compared to the dates and sizes of the folder listing,
+    and only the items whose listing differs from the recorded one are checked with HEAD requests. The items whose fingerprints
+    differ from the recorded ones are planned to be updated. The first check only records the listing or the fingerprints.
+    Nothing is written while planning: the listings and fingerprints to record are kept in the plan for apply_plan.
+    Returns the plan as a dictionary that can be saved as JSON and executed with apply_plan
 
-    """
-    The main updating function of the script. Checks the collection items in the Geocubes and compares the to the ones in CSC catalog.
-
-    app_host - The REST API path for updating the collections
     csc_catalog_client - The STAC API path for checking which items are already in the collections
+    geocubes_datasets - DatasetRegistry of the GeoCubes datasets
+    state - Optional CatalogState, the item IDs are taken from the local snapshot instead of listing every remote item
+    cache - Optional RasterCache for the folder listings, an unchanged folder is not downloaded again
+    workers - Number of concurrent HEAD requests for the fingerprints
+    detect_changes - Check the existing items for changed files
+    check_all - Check the existing items also in the folders whose listing has not changed
     """
     title_regex_pattern = r" \(GeoCubes\)"
-    session = requests.Session()
-    session.auth = ("admin", pwd)
     log_headers = {"User-Agent": "update-script"} # Added for easy log-filtering
+    stac_session = requests.Session()
+    stac_session.headers.update(log_headers)
+    stac_url = csc_catalog_client.get_self_href()
 
     # Get all Geocubes collections from the app_host
     csc_collections = [col for col in csc_catalog_client.get_collections() if col.id.endswith("at_geocubes")]
@@ -166,7 +64,12 @@ def update_catalog(app_host, csc_catalog_client):
         fixed_title = re.sub(title_regex_pattern, '', title)
         titles_and_ids[fixed_title] = csc_title_id_map[title]
 
-    geocubes_datasets = get_datasets()
+    plan = {
+        "stac_url": stac_url,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "collections": []
+    }
+
     for dataset in geocubes_datasets:
         try: # If there's more datasets in GeoCubes than in CSC STAC, skip them in this update script
             translated_name = collection_csv[dataset]["Name"]
@@ -174,147 +77,278 @@ def update_catalog(app_host, csc_catalog_client):
             continue
 
         collection_id = titles_and_ids[translated_name]
-        csc_collection = csc_catalog_client.get_child(collection_id)
-        csc_collection_item_ids = [item.id for item in csc_collection.get_items()]
+        if state is not None:
+            state.refresh(stac_url, collection_id, stac_session)
+            csc_collection_item_ids = state.item_ids(collection_id)
+            recorded_fingerprints = state.item_fingerprints(collection_id)
+            recorded_listings = state.item_listings(collection_id)
+        else:
+            csc_collection_item_ids = fetch_item_ids(stac_url, collection_id, stac_session)
 
-        paths = geocubes_datasets[dataset]['paths']
-        print(f"Checking new items for {csc_collection.id}: ", end="")
+        paths = geocubes_datasets[dataset].paths
+        print(f"Checking new items for {collection_id}: ", end="")
 
-        number_of_items_in_geocubes = 0
-        number_of_items_added = 0
+        collection_plan = {"dataset": dataset, "collection": collection_id, "add": [], "update": [], "skip": 0, "unchanged_folders": 0, "folders": []}
         for year_path in paths:
 
-            #TIFs through BeautifulSoup
-            page = requests.get(year_path)
-            data = page.text
-            soup = BeautifulSoup(data, features="html.parser")
-
-            links = [link for link in soup.find_all("a")]
-
-            item_links = [link.get("href") for link in links if link.get("href").endswith("tif")]
-            item_sets = [item.split(".")[0] for item in item_links]
-                
-            grouped_dict = {}
-            for item in item_sets:
-                prefix = "_".join(item.split("_")[:4])
-                if prefix not in grouped_dict:
-                    grouped_dict[prefix] = []
-                    grouped_dict[prefix].append(item)
-            
-            number_of_items_in_geocubes = number_of_items_in_geocubes + len(grouped_dict.keys())
-            for key in grouped_dict.keys():
-                
-                # Takes the year from the path
-                item_starttime = datetime.datetime.strptime(f"{year_path.split('/')[-2]}-01-01", "%Y-%m-%d")
-                item_endtime = datetime.datetime.strptime(f"{year_path.split('/')[-2]}-12-31", "%Y-%m-%d")
-                    
-                # The sentinel and NDVI items are named a bit differently from the rest
-                item_year = year_path.split("/")[-1]
-                if "sentinel" in key:
-                    name = key.split("_")[0].replace('-', '_')
-                    item_info = "_".join(key.split(".")[0].split("_")[1:])
-                    item_id = f"{name.lower().replace(' ', '_').replace(',', '')}_{item_info}"
-                elif "ndvi" in key:
-                    name = key.split("_")[0]
-                    item_info = "_".join(key.split(".")[0].split("_")[1:])
-                    item_id = f"{name.lower()}_{item_info}"
+            # The .tif links of the folder, a cached listing is revalidated with a conditional GET. Nothing is stored while planning,
+            # the listing and the fingerprints are recorded by apply_plan once the items of the folder have been sent.
+            # An unchanged folder is still compared to the remote IDs, which needs no requests and retries the items that failed before
+            check = state is not None and detect_changes
+            item_links, details, validators, downloaded = fetch_listing(year_path, cache, details=check)
+            if state is not None:
+                # The folder has changed since its items were last all sent
+                changed = validators == (None, None) or state.folder_validators(collection_id, year_path) != validators
+            else:
+                changed = downloaded
+            if not changed:
+                collection_plan["unchanged_folders"] += 1
+            folder = {"year_path": year_path, "validators": list(validators), "checked": check, "fingerprints": {}, "listed": {}}
+            if downloaded and cache is not None:
+                folder["hrefs"] = item_links
+            added = []
+            existing = []
+
+            # The files grouped into items with their item IDs, in the same way as geocubes_stac.py groups them
+            for key, (item_id, files) in group_items(index_listing(item_links, year_path, translated_name)).items():
+
+                entry = {"id": item_id, "year_path": year_path, "key": key, "files": files}
+                if item_id not in csc_collection_item_ids:
+                    added.append(entry)
+                elif check and (changed or check_all):
+                    existing.append(entry)
                 else:
-                    item_info = "_".join(key.split(".")[0].split("_")[1:])
-                    item_id = f"{translated_name.lower().replace(' ', '_').replace(',', '')}_{item_info}"
-
-                if item_id in csc_collection_item_ids:
-                    continue
+                    collection_plan["skip"] += 1
+
+            # The listing of a folder shows the sizes and dates of its files, so by default only the folders whose listing changed are checked
+            if existing and details is None:
+                # The cached listing has no details, the page is downloaded once without the cache
+                _, details, _, _ = fetch_listing(year_path, details=True)
+            for entry in added:
+                if details is not None:
+                    entry["listed"] = item_listing(entry, details)
+            collection_plan["add"] += added
+
+            # Only the items whose files differ from the recorded listing details are checked with HEAD requests
+            heads = []
+            for entry in existing:
+                listed = item_listing(entry, details)
+                complete = all(listed.values())
+                if complete and recorded_listings.get(entry["id"]) == listed:
+                    collection_plan["skip"] += 1
+                elif complete and entry["id"] not in recorded_fingerprints:
+                    # The first check records the listing details as they are, without HEAD requests
+                    folder["fingerprints"][entry["id"]] = {href: None for href in listed}
+                    folder["listed"][entry["id"]] = listed
+                    collection_plan["skip"] += 1
                 else:
-                    number_of_items_added = number_of_items_added + 1
-                    with rasterio.open(year_path+grouped_dict[key][0]+".tif") as src:
-                        assets = {
-                            "COG": pystac.Asset(
-                                href=year_path+grouped_dict[key][0]+".tif", 
-                                media_type="image/tiff; application=geotiff; profile=cloud-optimized", 
-                                title="COG",
-                                roles=["data"],
-                                extra_fields={
-                                    "gsd": int(src.res[0]),
-                                    "proj:shape": src.shape,
-                                    "proj:transform": [
-                                        src.transform.a,
-                                        src.transform.b,
-                                        src.transform.c,
-                                        src.transform.d,
-                                        src.transform.e,
-                                        src.transform.f,
-                                        src.transform.g,
-                                        src.transform.h,
-                                        src.transform.i
-                                    ]
-                                }
-                            )
-                        }
-                    min_gsd = assets["COG"].extra_fields["gsd"]
-                    for asset in grouped_dict[key][1:]:
-                        with rasterio.open(year_path+asset+".tif") as src:
-                            asset_id = asset.split("_")[-1]
-                            assets[asset_id] = pystac.Asset(
-                                href=year_path+asset+".tif",
-                                media_type="image/tiff; application=geotiff", 
-                                title=asset.split('_')[-1],
-                                roles=["data"],
-                                extra_fields={
-                                    "gsd": int(src.res[0]),
-                                    "proj:shape": src.shape,
-                                    "proj:transform": [
-                                        src.transform.a,
-                                        src.transform.b,
-                                        src.transform.c,
-                                        src.transform.d,
-                                        src.transform.e,
-                                        src.transform.f,
-                                        src.transform.g,
-                                        src.transform.h,
-                                        src.transform.i
-                                    ]
-                                }
-                            )
-                        
-                        # Add the GSD into the Collection Summaries if not in it
-                        if assets[asset_id].extra_fields["gsd"] not in csc_collection.summaries.lists["gsd"]:
-                            csc_collection.summaries.lists["gsd"].append(assets[asset_id].extra_fields["gsd"])
-                        min_gsd = min(min_gsd, assets[asset_id].extra_fields["gsd"])
-
-                    item = create_stac_item(
-                        source=year_path+key+".tif",
-                        id=item_id,
-                        assets=assets, 
-                        asset_media_type=pystac.MediaType.TIFF, 
-                        with_proj=True,
-                    )
-                    item.common_metadata.start_datetime = item_starttime
-                    item.common_metadata.end_datetime = item_endtime
-                    item.extra_fields["gsd"] = min_gsd
-                    item.properties["proj:epsg"] = 3067
-                    csc_collection.add_item(item)
-
-                    item_dict = item.to_dict()
-                    converted_item = json_convert(item_dict)
-                    request_point = f"collections/{csc_collection.id}/products"
-                    r = session.post(urljoin(app_host, request_point), headers=log_headers, json=converted_item)
-                    r.raise_for_status()
-
-        print(f"{len(csc_collection_item_ids)}/{number_of_items_in_geocubes}")
-        if number_of_items_added:
-            # Update the extents from the GeoCubes Items
-            csc_collection.update_extent_from_items()
-            collection_dict = csc_collection.to_dict()
-            converted_collection = json_convert(collection_dict)
-            request_point = f"collections/{csc_collection.id}/"
-
-            r = session.put(urljoin(app_host, request_point), headers=log_headers, json=converted_collection)
-            r.raise_for_status()
-            print(f" + Number of items added: {number_of_items_added}")
-            print(" + Updated Collection Extents.")
-        else:
+                    entry["listed"] = listed
+                    heads.append(entry)
+
+            if heads:
+                fingerprints = harvest_fingerprints([href for entry in heads for href in item_hrefs(entry)], workers)
+                for entry in heads:
+                    current = {href: fingerprints[href] for href in item_hrefs(entry)}
+                    if entry["id"] in recorded_fingerprints and recorded_fingerprints[entry["id"]] != current:
+                        collection_plan["update"].append(entry)
+                    else:
+                        folder["fingerprints"][entry["id"]] = current
+                        folder["listed"][entry["id"]] = entry.pop("listed")
+                        collection_plan["skip"] += 1
+
+            if changed or downloaded:
+                collection_plan["folders"].append(folder)
+
+        geocubes_items = collection_plan["skip"] + len(collection_plan["add"]) + len(collection_plan["update"])
+        print(f"{len(csc_collection_item_ids)}/{geocubes_items}", end="")
+        print(" (folders unchanged)" if collection_plan["unchanged_folders"] == len(paths) else "")
+        if collection_plan["add"]:
+            print(f" + Items to add: {len(collection_plan['add'])}")
+        if collection_plan["update"]:
+            print(f" + Items with changed files: {len(collection_plan['update'])}")
+        if not collection_plan["add"] and not collection_plan["update"]:
             print(" * All items present.")
+        plan["collections"].append(collection_plan)
+
+    plan["totals"] = {
+        "add": sum(len(c["add"]) for c in plan["collections"]),
+        "update": sum(len(c["update"]) for c in plan["collections"]),
+        "skip": sum(c["skip"] for c in plan["collections"]),
+        "files": sum(len(entry["files"]) for c in plan["collections"] for entry in c["add"] + c["update"])
+    }
+    return plan
+
+def item_hrefs(entry):
+
+    """
+    Returns the hrefs of the files of a planned item entry
+    """
+
+    return list(dict.fromkeys(entry["year_path"]+item+".tif" for item in [entry["key"]]+entry["files"]))
+
+def item_listing(entry, details):
+
+    """
+    Returns a dictionary from the hrefs of a planned item entry to the details of the files in the folder listing, None for a file the listing has no details for
+    """
+
+    return {href: details.get(href[len(entry["year_path"]):]) or None for href in item_hrefs(entry)}
+
+def apply_plan(plan, app_host, csc_catalog_client, uploader, workers=1, cache=None, range_reader=True, state=None, journal=None, batch_size=None):
+
+    """
+    Executes a plan made by plan_updates. The raster headers of each collection are fetched concurrently and the items are uploaded concurrently.
+    The new items are added with POST and the changed ones updated with PUT. The collection extents are updated once all of its items have been sent,
+    or once for each batch with a batch size.
+
+    plan - The plan dictionary
+    app_host - The REST API path for updating the collections
+    csc_catalog_client - The STAC API path for reading the current collection extents
+    uploader - Uploader for the REST API requests
+    workers - Number of raster headers fetched concurrently
+    cache - Optional RasterCache for the raster headers, the planned folder listings are stored into it once the items of their folder have all been sent
+    range_reader - Parse the raster headers from range requests instead of opening them with GDAL
+    state - Optional CatalogState, the sent items and the fingerprints of their files are recorded into it, and the planned folder listings
+            and fingerprints once the items of their folder have all been sent
+    journal - Optional Journal of the finished uploads and collections. The uploads it has are not sent again,
+              but their extents are still added to the collection.
+    batch_size - Number of items in a batch, None sends each collection as one batch. The next batch is harvested while the previous one is uploaded.
+    """
+
+    for collection_plan in plan["collections"]:
+        entries = collection_plan["add"] + collection_plan["update"]
+        if not entries or (journal is not None and journal.done("collection", collection_plan["collection"])):
+            record_folders(collection_plan, set(), cache, state)
+            continue
+
+        csc_collection = csc_catalog_client.get_child(collection_plan["collection"])
+        extent = ExtentAccumulator.from_collection(csc_collection)
+        print(f"Adding {len(collection_plan['add'])} and updating {len(collection_plan['update'])} items in {csc_collection.id}")
+
+        resumed = 0
+        if journal is not None:
+            for entry in entries:
+                record = journal.get("upload", csc_collection.id, entry["id"])
+                if record is not None:
+                    resumed += 1
+                    extent.add_bbox(record["bbox"])
+                    extent.add_interval(pystac.utils.str_to_datetime(record["start_datetime"]), pystac.utils.str_to_datetime(record["end_datetime"]))
+                    for gsd in record["gsd"]:
+                        extent.add_gsd(gsd)
+            entries = [entry for entry in entries if not journal.done("upload", csc_collection.id, entry["id"])]
+
+        # With a batch size the entries are sent in batches: the headers of the next batch are fetched and its items converted
+        # while the previous batch is still being uploaded, and the collection extents are sent once for each finished batch
+        # A resumed run with all of its uploads done still has the extents of the collection to send
+        size = batch_size or len(entries) or 1
+        batches = [entries[i:i + size] for i in range(0, len(entries), size)] or [[]]
+        updated_ids = {entry["id"] for entry in collection_plan["update"]}
+        pending = None
+        added = resumed
+        failed = set()
+        for n, batch in enumerate(batches + [None]):
+            if batch is not None:
+                # The item source is usually the first file of its group, so its header is read only once
+                hrefs = [href for entry in batch for href in item_hrefs(entry)]
+                # The fingerprints are read before the headers, so a file changing in between is found on the next run
+                fingerprints = harvest_fingerprints(hrefs, workers) if state is not None else {}
+                headers = harvest_headers(hrefs, workers, cache, range_reader)
+                sent = submit_batch(batch, headers, csc_collection.id, updated_ids, app_host, uploader, extent, journal)
+
+            if pending is not None:
+                # The previous batch is finished before its extents are sent
+                batch_added, batch_failed = finish_batch(*pending, csc_collection.id, app_host, uploader, state)
+                added += batch_added
+                failed |= batch_failed
+                if len(batches) > 1:
+                    print(f" + Batch of {len(pending[0])} items sent, {batch_added} added or updated")
+
+            if batch is not None:
+                # The extents of the collection up to this batch. The extents of the resumed uploads are sent with the first batch
+                # even if none of its items succeed.
+                extent.apply(csc_collection)
+                pending = (batch, sent, fingerprints, json_convert(csc_collection.to_dict()), n == 0 and resumed > 0)
+
+        if added and journal is not None and not failed:
+            journal.record("collection", csc_collection.id)
+        record_folders(collection_plan, failed, cache, state)
+        if added:
+            print(f" + Number of items added or updated: {added}")
+            print(" + Updated Collection Extents.")
+        if failed:
+            print(f" - Number of failed items: {len(failed)}")
+
+def record_folders(collection_plan, failed, cache=None, state=None):
 
+    """
+    Records the planned listings and fingerprints of the folders of a collection whose items were all sent. A folder with a failed item
+    is left as it was, so the next run finds it changed and checks its items again.
+
+    collection_plan - Collection of the plan made by plan_updates
+    failed - Set of the IDs of the items that failed
+    """
+
+    failed_paths = {entry["year_path"] for entry in collection_plan["add"] + collection_plan["update"] if entry["id"] in failed}
+    for folder in collection_plan.get("folders", []):
+        if folder["year_path"] in failed_paths:
+            continue
+        if cache is not None and "hrefs" in folder:
+            cache.store_listing(folder["year_path"], folder["hrefs"], tuple(folder["validators"]))
+        if state is not None and folder["checked"]:
+            for item_id, fingerprints in folder["fingerprints"].items():
+                fingerprints = {href: fingerprint or (None, None, None) for href, fingerprint in fingerprints.items()}
+                state.record_fingerprints(collection_plan["collection"], item_id, fingerprints, folder["listed"][item_id])
+            state.record_folder(collection_plan["collection"], folder["year_path"], folder["validators"])
+
+def submit_batch(batch, headers, collection_id, updated_ids, app_host, uploader, extent, journal=None):
+
+    """
+    Makes the items of a batch, adds them to the extents and queues their uploads. The new items are added with POST and the changed ones updated with PUT.
+    Returns a dictionary from item ID to the upload future
+    """
+
+    sent = {}
+    for entry in batch:
+        item = create_record(entry["id"], entry["year_path"], entry["key"], entry["files"], headers)
+        for asset in item.assets[1:]:
+            # Add the GSD into the Collection Summaries if not in it
+            extent.add_gsd(asset.gsd)
+        extent.add_item(item)
+
+        converted_item = json_convert(item.to_dict(collection_id))
+        future = uploader.submit_product(app_host, collection_id, item.id, converted_item, exists=item.id in updated_ids)
+        if journal is not None:
+            # The extents of the item are kept in the journal, so a resumed run can update the collection without the item
+            record = {
+                "bbox": list(item.bbox),
+                "start_datetime": pystac.utils.datetime_to_str(item.start_datetime),
+                "end_datetime": pystac.utils.datetime_to_str(item.end_datetime),
+                "gsd": [asset.gsd for asset in item.assets[1:]]
+            }
+            future.add_done_callback(lambda f, item_id=item.id, record=record: f.result() and journal.record("upload", collection_id, item_id, **record))
+        sent[item.id] = future
+    return sent
+
+def finish_batch(batch, sent, fingerprints, converted_collection, send_collection, collection_id, app_host, uploader, state=None):
+
+    """
+    Waits for the uploads of a batch, records the sent items into the state and sends the collection with the extents up to this batch.
+    The collection is sent if any item of the batch succeeded or send_collection is set.
+    Returns the number of items sent successfully and the set of the failed item IDs
+    """
+
+    failed = {item_id for item_id, future in sent.items() if not future.result()}
+    if state is not None:
+        for entry in batch:
+            if entry["id"] not in failed:
+                state.record_item(collection_id, entry["id"])
+                state.record_fingerprints(collection_id, entry["id"], {href: fingerprints[href] for href in item_hrefs(entry)}, entry.get("listed"))
+
+    if len(sent) > len(failed) or send_collection:
+        # Update the extents from the existing extents and the added Items
+        request_point = f"collections/{collection_id}/"
+        uploader.request("PUT", urljoin(app_host, request_point), converted_collection)
+    return len(sent) - len(failed), failed
 
 if __name__ == "__main__":
 
@@ -325,8 +359,64 @@ if __name__ == "__main__":
     pw_filename = 'passwords.txt'
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, help="Hostname of the selected STAC API", required=True)
-    
+    parser.add_argument("--cache", type=str, default=DEFAULT_CACHE, help=f"Cache of the raster headers and folder listings, revalidated against the server on every run (default {DEFAULT_CACHE})")
+    parser.add_argument("--no-cache", action="store_true", help="Read every raster header with GDAL without the cache")
+    parser.add_argument("--gdal-headers", action="store_true", help="Open the rasters with GDAL instead of parsing the header from a single range request")
+    parser.add_argument("--state", type=str, default=DEFAULT_STATE, help=f"Local snapshot of the remote item IDs, refreshed incrementally on every run (default {DEFAULT_STATE})")
+    add_state_arguments(parser)
+    parser.add_argument("--no-state", action="store_true", help="List the item IDs of every collection from the STAC API without the snapshot")
+    parser.add_argument("--plan", type=str, help="Only plan the update and write the plan as JSON to this file ('-' for stdout). No rasters are opened and nothing is sent.")
+    parser.add_argument("--apply", type=str, help="Execute a plan file written with --plan instead of planning again")
+    parser.add_argument("--workers", type=int, default=8, help="Number of raster headers and fingerprints fetched and items uploaded concurrently (default 8)")
+    parser.add_argument("--new-only", action="store_true", help="Only add new items, the existing items are not checked for changed files")
+    parser.add_argument("--check-all", action="store_true", help="Check the files of the existing items also in the folders whose listing has not changed")
+    parser.add_argument("--retries", type=int, default=5, help="Number of retries for connection errors and 5xx responses (default 5)")
+    parser.add_argument("--journal", type=str, default=DEFAULT_JOURNAL, help=f"Journal of the plan and the finished uploads (default {DEFAULT_JOURNAL})")
+    parser.add_argument("--resume", action="store_true", help="Continue a stopped update with the plan and the finished uploads of the journal")
+    parser.add_argument("--batch-size", type=int, help="Send the items in batches of this size, the next batch is harvested while the previous one is uploaded and the collection extents are sent after each batch (default one batch per collection)")
+
+    add_registry_arguments(parser)
+    add_throttle_arguments(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    start_metrics(args)
+    configure_throttle(args)
+
+    start = time.time()
+
+    app_host = f"{args.host}/geoserver/rest/oseo/"
+    csc_catalog_client = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/", headers={"User-Agent":"update-script"})
+    state = None if args.no_state else CatalogState(args.state, state_max_age(args))
+    cache = None if args.no_cache else RasterCache(args.cache)
+
+    if args.resume:
+        journal = Journal(args.journal, resume=True)
+        if not journal.done("plan"):
+            parser.error(f"No plan to resume in {args.journal}")
+        plan = journal.get("plan")["plan"]
+    elif args.apply:
+        with open(args.apply) as f:
+            plan = json.load(f)
+    else:
+        # With --plan -, the progress is printed to stderr so that stdout has only the plan
+        with contextlib.redirect_stdout(sys.stderr if args.plan == "-" else sys.stdout):
+            print(f"Planning the update of STAC Catalog at {args.host}")
+            with metrics.timer("plan"):
+                plan = plan_updates(csc_catalog_client, datasets_from_args(args), state, cache, args.workers, not args.new_only, args.check_all)
+
+    if args.plan:
+        if args.plan == "-":
+            json.dump(plan, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.plan, "w") as f:
+                json.dump(plan, f, indent=2)
+            print(f"Plan written to {args.plan}: {plan['totals']['add']} items to add, {plan['totals']['update']} to update, {plan['totals']['skip']} to skip")
+        if state is not None:
+            state.close()
+        if cache is not None:
+            cache.close()
+        sys.exit(0)
 
     try:
         pw_file = pd.read_csv(pw_filename, header=None)
@@ -334,14 +424,25 @@ if __name__ == "__main__":
     except FileNotFoundError:
         print("Password not given as an argument and no password file found")
         pwd = getpass.getpass()
-        
-    start = time.time()
 
-    app_host = f"{args.host}/geoserver/rest/oseo/"
-    csc_catalog_client = pystac_client.Client.open(f"{args.host}/geoserver/ogc/stac/v1/", headers={"User-Agent":"update-script"})
+    if not args.resume:
+        # The plan is the first record, so that a stopped update can be resumed with the same plan
+        journal = Journal(args.journal)
+        journal.record("plan", plan=plan)
 
     print(f"Updating STAC Catalog at {args.host}")
-    update_catalog(app_host, csc_catalog_client)
+    uploader = Uploader(("admin", pwd), workers=args.workers, retries=args.retries, headers={"User-Agent": "update-script"})
+    with metrics.timer("apply"):
+        apply_plan(plan, app_host, csc_catalog_client, uploader, args.workers, cache, not args.gdal_headers, state, journal, args.batch_size)
+    uploader.close()
+    journal.close()
+    if cache is not None:
+        cache.close()
+    if state is not None:
+        state.close()
 
     end = time.time()
-    print(f"Script took {end-start:.2f} seconds")
\ No newline at end of file
+    print(f"Script took {end-start:.2f} seconds")
+    if uploader.failures:
+        print(uploader.summary())
+        sys.exit(1)